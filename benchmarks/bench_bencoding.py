@@ -0,0 +1,65 @@
+import os
+import timeit
+
+from guit_torrent.bencoding import benencode, benencode_into
+
+
+def reference_benencode(data) -> bytes:
+    # recursive implementation benencode used to have
+    if isinstance(data, dict):
+        return b"d" + b"".join([
+            b"".join((reference_benencode(key), reference_benencode(value))) for key, value in data.items()
+        ]) + b"e"
+    if isinstance(data, bool):
+        data = 1 if data else 0
+    if isinstance(data, int):
+        return str.encode(f"i{data}e", "utf-8")
+    if isinstance(data, str):
+        return str.encode(f"{len(data)}:{data}", "utf-8")
+    if isinstance(data, bytes):
+        return str.encode(str(len(data)), 'utf-8') + b":" + data
+    return b"l" + b"".join(map(reference_benencode, iter(data))) + b"e"
+
+
+def make_info(nr_files):
+    return {
+        "files": [{"length": 1000 + i, "path": ["some", "dir", f"file_{i}.bin"]} for i in range(nr_files)],
+        "name": "benchmark",
+        "piece length": 2 ** 18,
+        "pieces": os.urandom(20 * nr_files),
+    }
+
+
+def make_tracker_response(nr_peers):
+    return {
+        "complete": 120,
+        "incomplete": 31,
+        "interval": 1800,
+        "peers": [{"ip": f"10.0.{i // 256}.{i % 256}", "peer id": os.urandom(20), "port": 6881} for i in
+                  range(nr_peers)],
+    }
+
+
+def bench(name, data, number):
+    assert reference_benencode(data) == benencode(data)
+    buffer = bytearray()
+
+    def into_reused_buffer():
+        del buffer[:]
+        benencode_into(data, buffer)
+
+    results = []
+    for label, fn in (("recursive", lambda: reference_benencode(data)), ("benencode", lambda: benencode(data)),
+                      ("benencode_into (reused buffer)", into_reused_buffer)):
+        results.append((label, min(timeit.repeat(fn, number=number, repeat=5)) / number))
+    print(name)
+    for label, elapsed in results:
+        print(f"  {label:<32} {elapsed * 1e6:12.1f} us  ({results[0][1] / elapsed:.2f}x)")
+
+
+if __name__ == "__main__":
+    # keys are already sorted, so both implementations produce the same output
+    bench("info dict, 100k files", make_info(100_000), 3)
+    bench("info dict, 100 files", make_info(100), 2000)
+    bench("tracker response, 50 peers", make_tracker_response(50), 5000)
+    bench("request message", {"msg_type": 0, "piece": 12}, 100_000)
@@ -0,0 +1,80 @@
+import asyncio
+import os
+import time
+from argparse import ArgumentParser
+
+from guit_torrent.peer.messages import PieceMessage, read_msg
+from guit_torrent.peer.protocol import PeerProtocol
+from guit_torrent.torrentdata import BLOCK_SIZE
+
+argparser = ArgumentParser("Compare parsing piece messages with a StreamReader and with PeerProtocol")
+argparser.add_argument("--size", help="MiB of blocks received", type=int, default=512)
+argparser.add_argument("--chunk", help="KiB received from the socket at once", type=int, default=64)
+
+
+class _Transport:
+    def __init__(self):
+        self.paused = False
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+
+async def receive(data: bytes, nr_blocks: int, chunk_size: int, stream: bool):
+    """
+        Receive data in chunks, as from a socket, and copy the block of each message into a piece buffer
+        returns the cpu time spent
+    """
+    view = memoryview(data)
+    piece = bytearray(BLOCK_SIZE * 16)
+    if stream:
+        reader = asyncio.StreamReader(limit=2 ** 30)
+        protocol = None
+    else:
+        reader = None
+        protocol = PeerProtocol()
+        transport = _Transport()
+        protocol.connection_made(transport)
+
+    async def feed():
+        pos = 0
+        while pos < len(data):
+            if stream:
+                # a new bytes object per recv(), which the StreamReader appends to its buffer
+                reader.feed_data(bytes(view[pos: pos + chunk_size]))
+                pos += chunk_size
+            elif not transport.paused:
+                # recv_into() the protocol's buffer
+                buffer = protocol.get_buffer(-1)
+                n = min(len(buffer), chunk_size, len(data) - pos)
+                buffer[:n] = view[pos: pos + n]
+                pos += n
+                protocol.buffer_updated(n)
+            await asyncio.sleep(0)
+
+    start = time.process_time()
+    feeding = asyncio.create_task(feed())
+    for _ in range(nr_blocks):
+        msg = await read_msg(reader) if stream else await protocol.read_msg()
+        piece[msg.begin: msg.begin + len(msg.block)] = msg.block
+    await feeding
+    return time.process_time() - start
+
+
+async def main():
+    args = argparser.parse_args()
+    nr_blocks = args.size * 2 ** 20 // BLOCK_SIZE
+    block = os.urandom(BLOCK_SIZE)
+    data = b"".join(PieceMessage(index=i // 16, begin=i % 16 * BLOCK_SIZE, block=block).encode()
+                    for i in range(nr_blocks))
+    print(f"{args.size} MiB in {BLOCK_SIZE // 2 ** 10} KiB blocks, received {args.chunk} KiB at a time")
+    for name, stream in (("StreamReader", True), ("PeerProtocol", False)):
+        cpu_time = await receive(data, nr_blocks, args.chunk * 2 ** 10, stream)
+        print(f"  {name:<12} {args.size / cpu_time:8.1f} MiB/s per core")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
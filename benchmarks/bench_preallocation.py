@@ -0,0 +1,86 @@
+import asyncio
+import os
+import random
+import re
+import subprocess
+import time
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+
+from guit_torrent.storage import PREALLOCATE_MODES
+from guit_torrent.torrentdata import get_torrentdata_from_metainfo
+
+from bench_storage import make_metainfo
+
+argparser = ArgumentParser("Compare the preallocation modes: write throughput and fragmentation of the written files")
+argparser.add_argument("--size", help="Torrent size in MiB", type=int, default=256)
+argparser.add_argument("--files", help="Number of files", type=int, default=4)
+argparser.add_argument("--piece-length", help="Piece length in KiB", type=int, default=256)
+argparser.add_argument("--write-cache", help="Write cache in MiB. Defaults to 0, so that pieces are written in the "
+                                             "order they complete", type=int, default=0)
+argparser.add_argument("--folder", help="Where to write, to benchmark another filesystem. Defaults to a temporary "
+                                        "folder", type=str)
+
+
+def count_extents(path: str) -> int | None:
+    # filefrag (e2fsprogs) reports the extents of a file on most linux filesystems
+    try:
+        output = subprocess.run(["filefrag", path], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.search(r"(\d+) extents? found", output)
+    return int(match.group(1)) if match else None
+
+
+def read_back(paths: list[str]) -> float:
+    start = time.perf_counter()
+    size = 0
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        # read from the disk, not from the page cache
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        while chunk := os.read(fd, 2 ** 20):
+            size += len(chunk)
+        os.close(fd)
+    return size / (time.perf_counter() - start)
+
+
+async def bench(metainfo, data: bytes, mode: str, write_cache_size: int, folder: str):
+    view = memoryview(data)
+    with TemporaryDirectory(dir=folder) as tmpdir:
+        start = time.perf_counter()
+        torrent = get_torrentdata_from_metainfo(metainfo, tmpdir, write_cache_size=write_cache_size,
+                                                preallocate_mode=mode)
+        open_time = time.perf_counter() - start
+        # pieces complete in random order, as when downloading from a swarm
+        piece_ids = list(range(torrent.nr_pieces))
+        random.Random(0).shuffle(piece_ids)
+        start = time.perf_counter()
+        for piece_id in piece_ids:
+            for block in torrent.pieces[piece_id].blocks:
+                await torrent.receive_block(block, view[block.absolute_begin: block.absolute_begin + block.length])
+        await torrent.sync()
+        write_time = time.perf_counter() - start
+        assert all(torrent.piece_confirmed)
+        paths = [file.path for file in torrent.files]
+        torrent.close()
+        extents = [count_extents(path) for path in paths]
+        read_rate = read_back(paths)
+    size = len(data) / 2 ** 20
+    extents = sum(extents) if None not in extents else "?"
+    print(f"  {mode:<6} preallocate {open_time * 1000:7.1f} ms   write {size / write_time:8.1f} MiB/s   "
+          f"read back {read_rate / 2 ** 20:8.1f} MiB/s   extents {extents}")
+
+
+async def main():
+    args = argparser.parse_args()
+    data = os.urandom(args.size * 2 ** 20)
+    metainfo = make_metainfo(data, args.piece_length * 2 ** 10, args.files)
+    print(f"{args.files} files, {args.size} MiB, pieces of {args.piece_length} KiB, "
+          f"{args.write_cache} MiB write cache")
+    for mode in PREALLOCATE_MODES:
+        await bench(metainfo, data, mode, args.write_cache * 2 ** 20, args.folder)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
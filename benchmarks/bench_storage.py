@@ -0,0 +1,71 @@
+import asyncio
+import os
+import time
+from argparse import ArgumentParser
+from hashlib import sha1
+from tempfile import TemporaryDirectory
+
+from guit_torrent.metainfo import TorrentMetaInfo, SingleFileInfo, MultiFileInfo, IndividualFileInfo
+from guit_torrent.torrentdata import get_torrentdata_from_metainfo, STORAGE_BACKENDS, BLOCK_SIZE
+
+argparser = ArgumentParser("Compare the pread/pwrite and mmap storage backends")
+argparser.add_argument("--size", help="Torrent size in MiB", type=int, default=256)
+argparser.add_argument("--files", help="Number of files of the many-file torrent", type=int, default=2000)
+argparser.add_argument("--piece-length", help="Piece length in KiB", type=int, default=256)
+
+
+def make_metainfo(data: bytes, piece_length: int, nr_files: int) -> TorrentMetaInfo:
+    pieces = b"".join(sha1(data[begin: begin + piece_length]).digest()
+                      for begin in range(0, len(data), piece_length))
+    if nr_files == 1:
+        info = SingleFileInfo(name="single", length=len(data), piece_length=piece_length, pieces=pieces)
+    else:
+        file_length = len(data) // nr_files
+        files = [IndividualFileInfo(name=f"dir_{i % 10}/file_{i}", length=file_length) for i in range(nr_files - 1)]
+        files.append(IndividualFileInfo(name="last", length=len(data) - file_length * (nr_files - 1)))
+        info = MultiFileInfo(name="many", files=files, piece_length=piece_length, pieces=pieces)
+    return TorrentMetaInfo(info=info, info_hash=b"", announce="")
+
+
+async def bench(metainfo: TorrentMetaInfo, data: bytes, storage: str):
+    view = memoryview(data)
+    with TemporaryDirectory() as tmpdir:
+        torrent = get_torrentdata_from_metainfo(metainfo, tmpdir, storage)
+        start = time.perf_counter()
+        for piece in torrent.pieces:
+            # whole pieces are received one block at a time, as from a fast peer
+            for block in piece.blocks:
+                await torrent.receive_block(block, view[block.absolute_begin: block.absolute_begin + block.length])
+        await torrent.sync()
+        write_time = time.perf_counter() - start
+        assert all(torrent.piece_confirmed)
+        torrent.close()
+
+        torrent = get_torrentdata_from_metainfo(metainfo, tmpdir, storage)
+        start = time.perf_counter()
+        assert await torrent.check_existing_data()
+        verify_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # as when serving peers
+        for piece_id in range(torrent.nr_pieces):
+            await torrent.read_piece(piece_id)
+        read_time = time.perf_counter() - start
+        torrent.close()
+    size = len(data) / 2 ** 20
+    print(f"  {storage:<6} receive+write {size / write_time:8.1f} MiB/s   verify {size / verify_time:8.1f} MiB/s   "
+          f"read pieces {size / read_time:8.1f} MiB/s")
+
+
+async def main():
+    args = argparser.parse_args()
+    data = os.urandom(args.size * 2 ** 20)
+    for name, nr_files in (("single file", 1), (f"{args.files} files", args.files)):
+        metainfo = make_metainfo(data, args.piece_length * 2 ** 10, nr_files)
+        print(f"{name}, {args.size} MiB, pieces of {args.piece_length} KiB ({BLOCK_SIZE // 2 ** 10} KiB blocks)")
+        for storage in STORAGE_BACKENDS:
+            await bench(metainfo, data, storage)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
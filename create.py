@@ -0,0 +1,28 @@
+from argparse import ArgumentParser
+
+from guit_torrent.creator import create_torrent
+
+argparser = ArgumentParser("Create a .torrent file from a file or a directory")
+argparser.add_argument("path", help="File or directory to share", type=str)
+argparser.add_argument("-a", "--announce", help="Tracker announce URL. Can be given multiple times", type=str,
+                       action="append", required=True)
+argparser.add_argument("-o", "--output", help="Path of the .torrent file. Defaults to (name).torrent", type=str)
+argparser.add_argument("-p", "--piece-length", help="Piece length in bytes. Picked from the total size by default",
+                       type=int)
+argparser.add_argument("-w", "--workers", help="Number of hashing processes. Defaults to the number of cpus",
+                       type=int)
+argparser.add_argument("-c", "--comment", help="Free-form comment", type=str)
+argparser.add_argument("--private", help="Only get peers from the trackers", action="store_true")
+
+
+if __name__ == "__main__":
+    args = argparser.parse_args()
+    meta_info = create_torrent(
+        args.path, args.announce[0],
+        announce_list=[[url] for url in args.announce] if len(args.announce) > 1 else None,
+        piece_length=args.piece_length, comment=args.comment, private=args.private, workers=args.workers
+    )
+    output = args.output or meta_info.info.name + ".torrent"
+    with open(output, "wb") as f:
+        f.write(meta_info.encode())
+    print(f"Created \"{output}\": {meta_info.info.nr_pieces} pieces of {meta_info.info.piece_length} bytes")
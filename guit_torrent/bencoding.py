@@ -46,33 +46,183 @@ class _BencodingReader:
         return value
 
 
+class _BencodingViewReader:
+    def __init__(self, data, decode_strings: bool = False):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            raise ValueError("data to decode must be a bytes-like object")
+        self.view = memoryview(data).cast("B")
+        # searching for separators is done on the underlying object, which must cover the whole view
+        self.raw = data
+        if isinstance(data, memoryview):
+            self.raw = data.obj if self.view.nbytes == len(data.obj) else data.tobytes()
+        self.decode_strings = decode_strings
+        self.i = 0
+        # raw byte range of each value of the top level dict
+        self.spans: dict[str | bytes, tuple[int, int]] = {}
+
+    def _read_int(self, end_marker: bytes) -> tuple[int, int]:
+        end = self.raw.find(end_marker, self.i)
+        if end == -1:
+            raise ValueError(f"missing {end_marker} at position {self.i}")
+        return int(self.raw[self.i: end]), end
+
+    def decode(self):
+        if self.i == len(self.view):
+            return None
+        return self.decode_next(top_level=True)
+
+    def decode_next(self, top_level: bool = False):
+        match self.view[self.i]:
+            # int
+            case 0x69:  # i
+                self.i += 1
+                value, end = self._read_int(b'e')
+                self.i = end + 1
+            # list
+            case 0x6c:  # l
+                self.i += 1
+                value = []
+                while self.view[self.i] != 0x65:  # e
+                    value.append(self.decode_next())
+                self.i += 1
+            # dict
+            case 0x64:  # d
+                self.i += 1
+                value = OrderedDict()
+                while self.view[self.i] != 0x65:  # e
+                    key = _decode_str(self.decode_next())
+                    start = self.i
+                    value[key] = self.decode_next()
+                    if top_level:
+                        self.spans[key] = (start, self.i)
+                self.i += 1
+            # str
+            case _:
+                wlen, sep = self._read_int(b':')
+                value = self.view[sep + 1: sep + 1 + wlen]
+                if len(value) != wlen:
+                    raise ValueError(f"string at position {self.i} exceeds data")
+                if self.decode_strings:
+                    value = _decode_str(value)
+                self.i = sep + 1 + wlen
+        return value
+
+
+def _decode_str(value):
+    if isinstance(value, memoryview):
+        value = value.tobytes()
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        # keep it as bytes
+        return value
+
+
 def bendecode(data):
     return _BencodingReader(data).decode_next()
 
 
-def benencode(data) -> bytes:
-    # dict
+def bendecode_view(data, decode_strings: bool = False):
+    """
+        Decode data without copying its strings, which are returned as memoryviews over data (unless decode_strings
+        is set, see decode_bytestrings to decode them later).
+        returns the decoded value and the raw [start, end[ byte range of each value in the top level dict
+    """
+    reader = _BencodingViewReader(data, decode_strings)
+    return reader.decode(), reader.spans
+
+
+def decode_bytestrings(data, raw_keys=()):
+    """
+        Recursively decode the memoryviews returned by bendecode_view into str (or bytes, if not valid utf-8).
+        Values of the dict keys in raw_keys are kept as memoryviews.
+    """
+    if isinstance(data, memoryview):
+        return _decode_str(data)
     if isinstance(data, dict):
-        return b"d" + b"".join([
-            b"".join((benencode(key), benencode(value))) for key, value in data.items()
-        ]) + b"e"
-    # bool
-    if isinstance(data, bool):
-        data = 1 if data else 0
-    # int
-    if isinstance(data, int):
-        return str.encode(f"i{data}e", "utf-8")
-    # str
-    if isinstance(data, str):
-        return str.encode(f"{len(data)}:{data}", "utf-8")
-    # bytes
-    if isinstance(data, bytes):
-        return str.encode(str(len(data)), 'utf-8') + b":" + data
-    # list
+        return OrderedDict(
+            (key, value if key in raw_keys else decode_bytestrings(value, raw_keys)) for key, value in data.items()
+        )
+    if isinstance(data, list):
+        return [decode_bytestrings(value, raw_keys) for value in data]
+    return data
+
+
+def benencode(data) -> bytes:
+    return bytes(benencode_into(data))
+
+
+def benencode_into(data, buffer: bytearray = None) -> bytearray:
+    """
+        Encode data at the end of buffer (a new bytearray if not given), using an explicit stack of iterators instead
+        of recursion and without intermediate bytes objects. Dict keys are sorted as required by the specification.
+        bytes-like values (bytearray, memoryview) are copied straight into the buffer.
+        returns the buffer
+    """
+    if buffer is None:
+        buffer = bytearray()
+    stack = [iter((data,))]
+    while stack:
+        for item in stack[-1]:
+            item_type = type(item)
+            if item_type is str:
+                item = item.encode("utf-8")
+                buffer += b"%d:" % len(item)
+                buffer += item
+            elif item_type is int:
+                buffer += b"i%de" % item
+            elif item_type is bytes:
+                buffer += b"%d:" % len(item)
+                buffer += item
+            elif item_type is list or item_type is tuple:
+                buffer += b"l"
+                stack.append(iter(item))
+                break
+            elif isinstance(item, dict):
+                buffer += b"d"
+                stack.append(_iter_sorted_dict(item))
+                break
+            # less common types
+            elif isinstance(item, (bytes, bytearray, memoryview)):
+                buffer += b"%d:" % (item.nbytes if isinstance(item, memoryview) else len(item))
+                buffer += item
+            elif isinstance(item, int):
+                # also bool
+                buffer += b"i%de" % item
+            elif isinstance(item, str):
+                item = str(item).encode("utf-8")
+                buffer += b"%d:" % len(item)
+                buffer += item
+            else:
+                try:
+                    iterator = iter(item)
+                except TypeError:
+                    raise ValueError(f"Unsupported type {type(item)}")
+                buffer += b"l"
+                stack.append(iterator)
+                break
+        else:
+            stack.pop()
+            # the outermost iterator is not a bencoded list
+            if stack:
+                buffer += b"e"
+    return buffer
+
+
+def _iter_sorted_dict(data: dict):
     try:
-        iterator = iter(data)
+        keys = sorted(data)
     except TypeError:
-        raise ValueError(f"Unsupported type {type(data)}")
-    else:
-        # iterable
-        return b"l" + b"".join(map(benencode, iterator)) + b"e"
+        # mixed str and bytes keys
+        keys = sorted(data, key=_encode_key)
+    flat = []
+    for key in keys:
+        if not isinstance(key, (str, bytes)):
+            raise ValueError(f"Unsupported dict key type {type(key)}")
+        flat.append(key)
+        flat.append(data[key])
+    return iter(flat)
+
+
+def _encode_key(key) -> bytes:
+    return key.encode("utf-8") if isinstance(key, str) else key
@@ -0,0 +1,234 @@
+import asyncio
+import time
+from bisect import bisect_right, insort
+from collections import OrderedDict
+
+# bytes of verified data held in memory before being written. 0 disables the cache
+WRITE_CACHE_SIZE = 64 * 2 ** 20
+# seconds data can stay in the cache
+WRITE_CACHE_MAX_AGE = 10
+# bytes of pieces kept in memory to serve requests from peers
+READ_CACHE_SIZE = 32 * 2 ** 20
+
+
+class WriteBackCache:
+    """Holds data before it is written to disk, by position in the "continuous stream" of data. When flushed,
+    contiguous entries (across pieces and files) are merged into runs, each written with as few large sequential
+    writes as possible instead of one write per piece or block and file.
+    It is flushed when it holds more than max_size bytes, when its oldest entry is older than max_age seconds (see
+    maybe_flush) and on flush()."""
+
+    def __init__(self, write_range_cb, max_size: int = WRITE_CACHE_SIZE, max_age: float = WRITE_CACHE_MAX_AGE):
+        # async write_range_cb(begin, buffers) writes the buffers one after the other, from begin
+        self.write_range_cb = write_range_cb
+        self.max_size = max_size
+        self.max_age = max_age
+        # absolute begin -> data, and the sorted begins
+        self.entries: dict[int, bytes] = {}
+        self._begins: list[int] = []
+        # entries being written, still served to readers until they are on disk
+        self._flushing: dict[int, bytes] = {}
+        # set whenever a flush is over
+        self._flushed = asyncio.Event()
+        self.size = 0
+        self.oldest: float | None = None
+        # stats
+        self.writes = 0
+        self.read_hits = 0
+        self.read_misses = 0
+        self.flushes = 0
+        self.runs_written = 0
+        self.bytes_flushed = 0
+
+    async def write(self, begin: int, data: bytes):
+        """data is kept as is: it must not be modified afterwards"""
+        while self._overlapping_flushing(begin, begin + len(data)):
+            # older data of the range is being written: it must not land on disk after this one
+            self._flushed.clear()
+            await self._flushed.wait()
+        if self._overlapping_entries(begin, begin + len(data)):
+            # entries never overlap, so that runs can be written in any order
+            await self.flush()
+        self.entries[begin] = data
+        insort(self._begins, begin)
+        self.size += len(data)
+        self.writes += 1
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if self.size >= self.max_size:
+            await self.flush()
+
+    def read_into(self, begin: int, buffer: bytearray) -> bool:
+        """
+            Copy the cached data of [begin, begin + len(buffer)[ into buffer
+            returns whether all of it was cached
+        """
+        hit = self.overlay(begin, buffer) == len(buffer)
+        if hit:
+            self.read_hits += 1
+        else:
+            self.read_misses += 1
+        return hit
+
+    def overlay(self, begin: int, buffer: bytearray) -> int:
+        """
+            Copy the cached parts of [begin, begin + len(buffer)[ over buffer
+            returns the number of bytes copied
+        """
+        end = begin + len(buffer)
+        copied = 0
+        # entries being flushed first: the live ones are newer
+        overlapping = [(entry_begin, self._flushing[entry_begin])
+                       for entry_begin in self._overlapping_flushing(begin, end)]
+        overlapping += [(entry_begin, self.entries[entry_begin])
+                        for entry_begin in self._overlapping_entries(begin, end)]
+        for entry_begin, data in overlapping:
+            start, stop = max(begin, entry_begin), min(end, entry_begin + len(data))
+            buffer[start - begin: stop - begin] = memoryview(data)[start - entry_begin: stop - entry_begin]
+            copied += stop - start
+        return copied
+
+    def overlaps(self, begin: int, end: int) -> bool:
+        return bool(self._overlapping_entries(begin, end) or self._overlapping_flushing(begin, end))
+
+    def _overlapping_flushing(self, begin: int, end: int) -> list[int]:
+        return [entry_begin for entry_begin, data in self._flushing.items()
+                if entry_begin < end and begin < entry_begin + len(data)]
+
+    def _overlapping_entries(self, begin: int, end: int) -> list[int]:
+        i = max(bisect_right(self._begins, begin) - 1, 0)
+        overlapping = []
+        while i < len(self._begins) and self._begins[i] < end:
+            entry_begin = self._begins[i]
+            if begin < entry_begin + len(self.entries[entry_begin]):
+                overlapping.append(entry_begin)
+            i += 1
+        return overlapping
+
+    async def maybe_flush(self):
+        if self.oldest is not None and time.monotonic() - self.oldest >= self.max_age:
+            await self.flush()
+
+    async def flush(self):
+        if not self.entries:
+            return
+        entries, begins = self.entries, self._begins
+        self.entries, self._begins = {}, []
+        self._flushing.update(entries)
+        self.size = 0
+        self.oldest = None
+        self.flushes += 1
+        # merge contiguous entries into runs of [begin, length, buffers]
+        runs = []
+        for begin in begins:
+            data = entries[begin]
+            if runs and runs[-1][0] + runs[-1][1] == begin:
+                runs[-1][1] += len(data)
+                runs[-1][2].append(data)
+            else:
+                runs.append([begin, len(data), [data]])
+        try:
+            for begin, length, buffers in runs:
+                await self.write_range_cb(begin, buffers)
+                self.runs_written += 1
+                self.bytes_flushed += length
+        finally:
+            for begin in begins:
+                self._flushing.pop(begin, None)
+            self._flushed.set()
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "writes": self.writes,
+            "read_hits": self.read_hits,
+            "read_misses": self.read_misses,
+            "flushes": self.flushes,
+            "runs_written": self.runs_written,
+            "bytes_flushed": self.bytes_flushed,
+            # cached writes merged into each sequential run
+            "coalescing": (self.writes - len(self.entries)) / self.runs_written if self.runs_written else 0,
+        }
+
+
+class PieceReadCache:
+    """LRU cache of whole pieces read from disk to upload them: peers request the same (rarest) pieces, one block at a
+    time. Concurrent requests for a piece that is being read wait for that read instead of starting another one."""
+
+    def __init__(self, read_piece_cb, max_size: int = READ_CACHE_SIZE):
+        # async read_piece_cb(piece_id) returns the data of the piece, which must not be modified afterwards
+        self.read_piece_cb = read_piece_cb
+        self.max_size = max_size
+        # least recently used first
+        self.pieces: OrderedDict[int, bytes] = OrderedDict()
+        self._reading: dict[int, asyncio.Future] = {}
+        self.size = 0
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_read = 0
+
+    async def get(self, piece_id: int) -> bytes:
+        data = self.pieces.get(piece_id)
+        if data is not None:
+            self.hits += 1
+            self.pieces.move_to_end(piece_id)
+            return data
+        reading = self._reading.get(piece_id)
+        if reading is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            reading = self._reading[piece_id] = asyncio.ensure_future(self._read(piece_id))
+        # the read goes on for the other requesters if this one is cancelled
+        return await asyncio.shield(reading)
+
+    async def _read(self, piece_id: int) -> bytes:
+        try:
+            data = await self.read_piece_cb(piece_id)
+        finally:
+            del self._reading[piece_id]
+        self.bytes_read += len(data)
+        if len(data) <= self.max_size:
+            self.pieces[piece_id] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, evicted = self.pieces.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+        return data
+
+    def invalidate(self, piece_id: int):
+        data = self.pieces.pop(piece_id, None)
+        if data is not None:
+            self.size -= len(data)
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes_read": self.bytes_read,
+        }
+
+
+def split_buffers(buffers: list, lengths: list[int]) -> list[list[memoryview]]:
+    """
+        Split the concatenation of buffers into consecutive groups of the given lengths, without copying
+    """
+    groups = []
+    buffer_index, buffer_offset = 0, 0
+    for length in lengths:
+        group = []
+        while length:
+            buffer = memoryview(buffers[buffer_index])
+            take = min(length, len(buffer) - buffer_offset)
+            group.append(buffer[buffer_offset: buffer_offset + take])
+            length -= take
+            buffer_offset += take
+            if buffer_offset == len(buffer):
+                buffer_index, buffer_offset = buffer_index + 1, 0
+        groups.append(group)
+    return groups
@@ -1,21 +1,43 @@
 import asyncio
 import os
+import time
 from asyncio import InvalidStateError
 from collections import deque
 
+from guit_torrent.cache import WRITE_CACHE_SIZE
 from guit_torrent.metainfo import load_torrent_metadata
 from guit_torrent.peer.messages import PieceMessage
-from guit_torrent.peer.peer import Peer, BLOCKS_TO_QUEUE
-from guit_torrent.torrentdata import TorrentBlock, TorrentPiece, get_torrentdata_from_metainfo
+from guit_torrent.peer.peer import Peer, MIN_REQUEST_WINDOW, MAX_REQUEST_WINDOW
+from guit_torrent.peer.protocol import PeerProtocol
+from guit_torrent.peer.server import PeerServer, DEFAULT_PORT
+from guit_torrent.picker import PiecePicker
+from guit_torrent.resume import get_resume_path, load_resume_data, save_resume_data, ResumeData, \
+    RESUME_SAVE_INTERVAL
+from guit_torrent.scheduler import RequestScheduler
+from guit_torrent.storage import MAX_OPEN_FILES
+from guit_torrent.torrentdata import TorrentBlock, TorrentPiece, get_torrentdata_from_metainfo, match_file_priorities
 from guit_torrent.tracker.manager import TrackerManager
 from guit_torrent.ui import ui_update_files_progress, console, ui_view, ui_update_overall
 
 MAX_PEERS = 50
 CLIENT_UPDATES_INTERVAL = 5
+# fraction of the wanted bytes after which the time to complete the download is measured
+TAIL_FRACTION = 0.99
 
 
 class TorrentClient:
-    def __init__(self, torrent_path, base_output_folder):
+    def __init__(self, torrent_path, base_output_folder, verify_workers: int = None, storage: str = "pread",
+                 write_cache_size: int = WRITE_CACHE_SIZE, preallocate_mode: str = "none",
+                 max_open_files: int = MAX_OPEN_FILES, priority_patterns: list[tuple[str, int]] = None,
+                 seed: bool = False, server: PeerServer = None,
+                 request_window: tuple[int, int] = (MIN_REQUEST_WINDOW, MAX_REQUEST_WINDOW)):
+        """
+            priority_patterns: (glob pattern, priority) pairs setting the priority of the files whose names match,
+            see match_file_priorities
+            seed: keep uploading to peers once the download is complete
+            server: accepts connections from peers, its port is announced to the trackers
+            request_window: bounds of the number of blocks requested at once from a peer, sized from its rate
+        """
         self.torrent_path = torrent_path
         self.torrent_metadata = load_torrent_metadata(torrent_path)
         console.log(f"Loaded torrent \"{torrent_path}\"")
@@ -24,55 +46,154 @@ class TorrentClient:
         # peers
         self.peers = []
         self.dead_peers = set()
+        # bytes uploaded to peers that were removed
+        self.uploaded = 0
         # tracker
         self.tracker_updates = asyncio.Event()
-        self.tracker_manager = TrackerManager(self.torrent_metadata, self.get_downloaded_bytes, self.tracker_updates)
+        self.tracker_manager = TrackerManager(self.torrent_metadata, self.get_downloaded_bytes, self.tracker_updates,
+                                              self.get_left_bytes, self.get_uploaded_bytes,
+                                              server.port if server else DEFAULT_PORT)
+        self.server = server
         # torrent data
         self.torrent = None
+        self.picker = None
+        self.scheduler = None
         self.running = False
+        self.verify_workers = verify_workers
+        self.storage = storage
+        self.write_cache_size = write_cache_size
+        self.preallocate_mode = preallocate_mode
+        self.max_open_files = max_open_files
+        self.seed = seed
+        self.request_window = request_window
+        self.file_priorities = match_file_priorities([file.name for file in self.torrent_metadata.info.get_files()],
+                                                     priority_patterns or [])
+        # time.monotonic() when TAIL_FRACTION of the wanted bytes were confirmed, and the download completed
+        self.tail_started = None
+        self.completed_at = None
+        # bytes received more than once
+        self.duplicate_bytes = 0
+        # fast resume
+        self.resume_path = get_resume_path(base_output_folder, self.torrent_metadata.info_hash)
+        self.last_resume_save = None
 
     def get_downloaded_bytes(self):
         return self.torrent.confirmed_downloaded_bytes if self.torrent else 0
 
+    def get_left_bytes(self):
+        return self.torrent.left_bytes if self.torrent else self.torrent_metadata.info.total_length
+
+    def get_uploaded_bytes(self):
+        return self.uploaded + sum(peer.uploaded for peer in self.peers)
+
+    def get_pieces(self) -> set[int]:
+        return {piece_id for piece_id, confirmed in enumerate(self.torrent.piece_confirmed) if confirmed}
+
+    async def save_resume_data(self):
+        if not self.torrent or self.torrent.closed:
+            return
+        # the recorded modification times must come after our last write
+        await self.torrent.sync()
+        save_resume_data(self.resume_path, ResumeData.from_torrent(self.torrent, self.torrent_metadata.info_hash))
+        self.last_resume_save = time.time()
+
     async def close(self):
         self.running = False
+        if self.scheduler:
+            self.scheduler.close()
+        if self.server:
+            self.server.unregister(self.torrent_metadata.info_hash)
         await self.tracker_manager.close()
         for peer in self.peers:
             await peer.close()
-        if self.torrent:
+        if self.torrent and not self.torrent.closed:
+            await self.torrent.flush_piece_buffers()
+            await self.save_resume_data()
+            console.log(f"Disk I/O: {self.torrent.disk_io.stats()}")
+            console.log(f"Open files: {self.torrent.file_pool.stats()}")
+            if self.torrent.write_cache is not None:
+                console.log(f"Write cache: {self.torrent.write_cache.stats()}")
+            console.log(f"Read cache: {self.torrent.read_cache.stats()}, uploaded {self.get_uploaded_bytes()} bytes")
             self.torrent.close()
         ui_view.close()
 
     async def block_received(self, msg: PieceMessage):
-        block: TorrentBlock = self.torrent.pieces[msg.index].get_block(msg.begin)
+        piece: TorrentPiece = self.torrent.pieces[msg.index]
+        block: TorrentBlock = piece.get_block(msg.begin)
         if block and len(msg.block) == block.length:
-            await self.torrent.write_block(block, msg.block)
-            block.downloaded = True
-            block.data = msg.block
-            piece: TorrentPiece = self.torrent.pieces[block.piece_id]
-            piece.bytes_downloaded += block.length
-            if piece.downloaded:
-                verified = await self.torrent.verify_piece(block.piece_id)
-                if verified:
-                    piece.confirmed = True
-                    if all([piece.confirmed for piece in self.torrent.pieces]):
-                        self.torrent.downloaded = True
-                        self.running = False
-                else:
-                    for block in piece.blocks:
-                        block.downloaded = False
-                        piece.bytes_downloaded -= block.length
+            if block.downloaded:
+                # already received from another peer
+                self.duplicate_bytes += block.length
+                return
+            if self.scheduler.endgame:
+                # the other peers should not send it anymore
+                for peer in self.peers:
+                    peer.cancel_request(block.piece_id, block.begin, block.length)
+            verified = await self.torrent.receive_block(block, msg.block)
+            if verified is False:
+                # its blocks are requested again
+                self.scheduler.piece_failed(msg.index)
+            if verified:
+                self.picker.piece_confirmed(msg.index)
+                for peer in self.peers:
+                    peer.send_have(msg.index)
+            if verified and self.tail_started is None and \
+                    self.torrent.wanted_confirmed_bytes >= TAIL_FRACTION * self.torrent.wanted_length:
+                self.tail_started = time.monotonic()
+            if verified and self.torrent.complete:
+                self.torrent.downloaded = True
+                self.running = self.seed
+                self.completed_at = time.monotonic()
+                console.log(f"Download complete: {self.endgame_stats()}")
             ui_update_files_progress(self.torrent)
         else:
             raise RuntimeError("SIZE MISMATCH ON BLOCK")
 
     async def stop(self):
+        if self.server:
+            self.server.unregister(self.torrent_metadata.info_hash)
         await self.tracker_manager.close()
         for peer in self.peers:
             await peer.close()
+        if self.torrent and not self.torrent.closed:
+            await self.torrent.flush_piece_buffers()
+            await self.save_resume_data()
+
+    def endgame_stats(self) -> dict:
+        endgame_started = self.scheduler.endgame_started
+        return {
+            "endgame": self.scheduler.endgame,
+            "endgame_duration": (self.completed_at or time.monotonic()) - endgame_started
+            if endgame_started is not None else None,
+            # time from TAIL_FRACTION to 100% of the wanted bytes
+            "tail_latency": (self.completed_at or time.monotonic()) - self.tail_started
+            if self.tail_started is not None else None,
+            "duplicate_bytes": self.duplicate_bytes,
+            "cancelled": sum(peer.cancelled for peer in self.peers),
+        }
+
+    def _new_peer(self, host: tuple[str, int]) -> Peer:
+        return Peer(self.torrent_metadata, self.tracker_manager.peer_id, host, self.block_received,
+                    self.torrent.read_block, self.get_pieces, *self.request_window,
+                    requests_released_cb=self.scheduler.blocks_released,
+                    pieces_available_cb=self._pieces_available, can_request_cb=self.scheduler.peer_ready)
+
+    def _pieces_available(self, peer: Peer, pieces):
+        self.picker.add_pieces(pieces)
+        self.scheduler.peer_ready(peer)
+
+    def peer_connected(self, host: tuple[str, int], connection: PeerProtocol) -> Peer | None:
+        if not self.running or len(self.peers) >= MAX_PEERS:
+            return None
+        peer = self._new_peer(host)
+        peer.start(connection)
+        self.peers.append(peer)
+        return peer
 
     async def start(self):
         await self._init_torrent()
+        if self.server:
+            self.server.register(self.torrent_metadata.info_hash, self.peer_connected)
         self.tracker_manager.start()
         ui_view.start(refresh=True)
         self.running = True
@@ -85,6 +206,8 @@ class TorrentClient:
                     except (asyncio.CancelledError, InvalidStateError):
                         pass
                     self.dead_peers.add(peer.host)
+                    self.uploaded += peer.uploaded
+                    self.picker.remove_pieces(peer.available_pieces)
             self.peers = [peer for peer in self.peers if peer.alive or peer.starting]
             active_peer_hosts = set([peer.host for peer in self.peers])
             # try the ones we haven't just removed first
@@ -94,32 +217,30 @@ class TorrentClient:
             )
             while len(self.peers) < MAX_PEERS and len(peers_to_try) > 0:
                 # create new peer
-                peer = Peer(self.torrent_metadata, self.tracker_manager.peer_id, peers_to_try.popleft(),
-                            self.block_received)
+                peer = self._new_peer(peers_to_try.popleft())
                 peer.start()
                 self.peers.append(peer)
-            # decide what to request next
-            pieces_and_availability = [(piece, []) for piece in self.torrent.pieces]
-            for peer in self.peers:
-                for available_piece in peer.available_pieces:
-                    pieces_and_availability[available_piece][1].append(peer)
-            pieces_and_availability.sort(key=lambda x: len(x[1]), reverse=True)  # sort by rarity (rarest one first)
-            available_pieces = sum(len(peers) > 0 for piece, peers in pieces_and_availability)
-            ui_update_overall(self, available_pieces)
-            # request them!
-            for piece, peers in pieces_and_availability:
-                if piece.confirmed:
-                    continue
-                blocks_left = deque(
-                    [block for block in piece.blocks if not block.downloaded and block.request_timedout])
-                peers.sort(key=lambda peer: peer.blocks_to_request.qsize(), reverse=True)
-                for peer in peers:
-                    while blocks_left and peer.blocks_to_request.qsize() < BLOCKS_TO_QUEUE:
-                        peer.blocks_to_request.put_nowait(blocks_left.popleft())
+            ui_update_overall(self, self.picker.available_pieces)
+            # blocks are requested as peers unchoke us, announce pieces or make room in their window, see
+            # RequestScheduler. what scans the pieces left is left to the updates
+            self.scheduler.update()
+            if time.time() - self.last_resume_save >= RESUME_SAVE_INTERVAL:
+                await self.save_resume_data()
+            elif self.torrent.write_cache is not None:
+                await self.torrent.write_cache.maybe_flush()
             await asyncio.sleep(CLIENT_UPDATES_INTERVAL)
         await self.close()
 
     async def _init_torrent(self):
-        self.torrent = get_torrentdata_from_metainfo(self.torrent_metadata, self.output_folder)
-        if await self.torrent.check_existing_data():
+        self.torrent = get_torrentdata_from_metainfo(self.torrent_metadata, self.output_folder, self.storage,
+                                                     self.write_cache_size, self.preallocate_mode,
+                                                     self.max_open_files, self.file_priorities)
+        # only verify the pieces of files that changed since the resume data was saved
+        resume_data = load_resume_data(self.resume_path)
+        piece_ids = resume_data.apply(self.torrent, self.torrent_metadata.info_hash) if resume_data else None
+        if await self.torrent.check_existing_data(piece_ids, workers=self.verify_workers):
             self.torrent.downloaded = True
+        self.picker = PiecePicker(self.torrent)
+        self.scheduler = RequestScheduler(self.torrent, self.picker, lambda: self.peers)
+        console.log(f"Verified existing data at {self.torrent.verify_rate / 2 ** 20:.1f} MiB/s")
+        await self.save_resume_data()
@@ -0,0 +1,126 @@
+import os
+import time
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha1
+
+from guit_torrent.bencoding import benencode
+from guit_torrent.metainfo import TorrentMetaInfo, MultiFileInfo, SingleFileInfo, FileTable
+
+MIN_PIECE_LENGTH = 2 ** 14
+MAX_PIECE_LENGTH = 2 ** 24
+TARGET_NR_PIECES = 1500
+# amount of data hashed by each task sent to the process pool
+HASH_TASK_SIZE = 2 ** 26
+READ_BUFFER_SIZE = 2 ** 22
+
+
+def choose_piece_length(total_length: int) -> int:
+    piece_length = MIN_PIECE_LENGTH
+    while piece_length < MAX_PIECE_LENGTH and total_length > piece_length * TARGET_NR_PIECES:
+        piece_length *= 2
+    return piece_length
+
+
+def list_files(path: str) -> list[tuple[str, int]]:
+    """
+        List (relative name, length) of all files under path, in a stable order
+    """
+    files = []
+    for root, dirs, filenames in os.walk(path):
+        dirs.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.join(root, filename)
+            if os.path.isfile(file_path):
+                files.append((os.path.relpath(file_path, path), os.path.getsize(file_path)))
+    return files
+
+
+def hash_pieces(paths: list[str], lengths: list[int], piece_length: int, workers: int = None) -> bytes:
+    """
+        SHA1 of every piece of the concatenation of the given files, hashed in parallel over a process pool.
+        returns the concatenated 20-byte hashes
+    """
+    offsets = [0]
+    for length in lengths:
+        offsets.append(offsets[-1] + length)
+    total_length = offsets[-1]
+    task_length = max(1, HASH_TASK_SIZE // piece_length) * piece_length
+    tasks = []
+    for begin in range(0, total_length, task_length):
+        end = min(begin + task_length, total_length)
+        # only send the files overlapping this range
+        first_file = bisect_right(offsets, begin) - 1
+        files = []
+        for i in range(first_file, len(paths)):
+            if offsets[i] >= end:
+                break
+            if lengths[i]:
+                files.append((paths[i], offsets[i], lengths[i]))
+        tasks.append((files, piece_length, begin, end))
+    if workers == 1 or len(tasks) <= 1:
+        return b"".join(_hash_range(*task) for task in tasks)
+    with ProcessPoolExecutor(workers) as pool:
+        return b"".join(pool.map(_hash_range, *zip(*tasks)))
+
+
+def _hash_range(files: list[tuple[str, int, int]], piece_length: int, begin: int, end: int) -> bytes:
+    # hashes [begin, end[ of the data. begin must be at a piece boundary. pieces may span several files
+    hashes = bytearray()
+    piece = bytearray(piece_length)
+    view = memoryview(piece)
+    filled = 0
+    for path, file_begin, file_length in files:
+        start = max(begin, file_begin) - file_begin
+        remaining = min(end, file_begin + file_length) - file_begin - start
+        with open(path, "rb", buffering=READ_BUFFER_SIZE) as f:
+            f.seek(start)
+            while remaining:
+                read = f.readinto(view[filled: filled + min(piece_length - filled, remaining)])
+                if not read:
+                    raise OSError(f"{path} is shorter than expected")
+                filled += read
+                remaining -= read
+                if filled == piece_length:
+                    hashes += sha1(view).digest()
+                    filled = 0
+    if filled:
+        # last piece
+        hashes += sha1(view[:filled]).digest()
+    return bytes(hashes)
+
+
+def create_torrent(path: str, announce: str, announce_list: list[list[str]] = None, piece_length: int = None,
+                   comment: str = None, private: bool = False, workers: int = None) -> TorrentMetaInfo:
+    """
+        Build the metainfo for a file or a directory. piece_length is picked from the total size if not given, and
+        pieces are hashed on `workers` processes (defaults to the number of cpus)
+    """
+    path = os.path.normpath(path)
+    name = os.path.basename(path)
+    if os.path.isdir(path):
+        files = list_files(path)
+        paths = [os.path.join(path, file_name) for file_name, _ in files]
+        lengths = [length for _, length in files]
+    else:
+        paths = [path]
+        lengths = [os.path.getsize(path)]
+    piece_length = piece_length or choose_piece_length(sum(lengths))
+    pieces = hash_pieces(paths, lengths, piece_length, workers)
+    if os.path.isdir(path):
+        table = FileTable()
+        for file_name, length in files:
+            table.append(file_name, length)
+        info = MultiFileInfo(name=name, files=table, piece_length=piece_length, pieces=pieces, private=private)
+    else:
+        info = SingleFileInfo(name=name, length=lengths[0], piece_length=piece_length, pieces=pieces,
+                              private=private)
+    return TorrentMetaInfo(
+        info=info,
+        info_hash=sha1(benencode(info.to_dict())).digest(),
+        announce=announce,
+        announce_list=announce_list,
+        creation_date=int(time.time()),
+        comment=comment,
+        created_by="guitTorrent"
+    )
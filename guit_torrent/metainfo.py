@@ -2,10 +2,12 @@ import dataclasses
 import itertools
 import os.path
 from abc import ABC, abstractmethod
+from array import array
+from collections.abc import Sequence, Iterable
 from dataclasses import dataclass, field
 from hashlib import sha1
 
-from guit_torrent.bencoding import benencode, bendecode
+from guit_torrent.bencoding import benencode, bendecode_view, decode_bytestrings
 from guit_torrent.utils import _format_keys
 
 
@@ -19,13 +21,89 @@ class IndividualFileInfo:
     md5sum: str | None = None
 
 
+class FileTable(Sequence):
+    """Compact list of the files of a torrent: lengths and cumulative offsets are kept in arrays and the names in a
+    single utf-8 blob. IndividualFileInfo objects are only created when indexing."""
+
+    def __init__(self):
+        self.lengths = array("q")
+        """offsets[i] is the position of file i in the "continuous stream" of data. offsets[-1] is the total length"""
+        self.offsets = array("q", [0])
+        self._names = bytearray()
+        self._name_offsets = array("q", [0])
+        # md5sums are rarely present
+        self._md5sums: dict[int, str] = {}
+
+    @classmethod
+    def from_files(cls, files: Iterable[IndividualFileInfo]) -> "FileTable":
+        table = cls()
+        for file in files:
+            table.append(file.name, file.length, file.md5sum)
+        return table
+
+    @classmethod
+    def from_dicts(cls, files: Iterable[dict]) -> "FileTable":
+        table = cls()
+        for file in files:
+            table.append(os.path.join(*file["path"]), file["length"], file.get("md5sum"))
+        return table
+
+    def append(self, name: str, length: int, md5sum: str | None = None):
+        if md5sum is not None:
+            self._md5sums[len(self.lengths)] = md5sum
+        self.lengths.append(length)
+        self.offsets.append(self.offsets[-1] + length)
+        self._names += name.encode("utf-8")
+        self._name_offsets.append(len(self._names))
+
+    @property
+    def total_length(self) -> int:
+        return self.offsets[-1]
+
+    def name(self, index: int) -> str:
+        return self._names[self._name_offsets[index]: self._name_offsets[index + 1]].decode("utf-8")
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("file index out of range")
+        return IndividualFileInfo(name=self.name(index), length=self.lengths[index],
+                                  md5sum=self._md5sums.get(index))
+
+    def __eq__(self, other):
+        if isinstance(other, FileTable):
+            return (self.lengths == other.lengths and self._names == other._names and
+                    self._name_offsets == other._name_offsets and self._md5sums == other._md5sums)
+        if isinstance(other, Sequence):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return f"FileTable({len(self)} files, {self.total_length} bytes)"
+
+    def to_list(self) -> list[dict]:
+        files = []
+        for i in range(len(self)):
+            file = {"path": self.name(i).split("/"), "length": self.lengths[i]}
+            if i in self._md5sums:
+                file["md5sum"] = self._md5sums[i]
+            files.append(file)
+        return files
+
+
 @dataclass
 class FileInfo(ABC):
     """number of bytes in each piece"""
     piece_length: int
     """string consisting of the concatenation of all 20-byte SHA1 hash values, one per piece (byte string, 
-    i.e. not urlencoded)"""
-    pieces: bytes = field(repr=False)
+    i.e. not urlencoded). Can be a memoryview over the original .torrent data"""
+    pieces: bytes | memoryview = field(repr=False)
     """(optional) this field is an integer. If it is set to "1", the client MUST publish its presence to get other 
     peers ONLY via the trackers explicitly described in the metainfo file. If this field is set to "0" or is not 
     present, the client may obtain peer from other means, e.g. PEX peer exchange, dht. Here, "private" may be read as 
@@ -36,24 +114,26 @@ class FileInfo(ABC):
     def total_length(self) -> int:
         return 0
 
+    @property
+    def nr_pieces(self) -> int:
+        return len(self.pieces) // 20
+
+    def piece_hash(self, piece_id: int) -> memoryview:
+        return memoryview(self.pieces)[piece_id * 20: (piece_id + 1) * 20]
+
     @abstractmethod
-    def get_files(self) -> list["SingleFileInfo"]:
+    def get_files(self) -> Sequence[IndividualFileInfo]:
         return []
 
     def to_dict(self):
+        # shallow: the file table and the pieces view are encoded as they are
         info = {
-            key.replace("_", " "): val for key, val in dataclasses.asdict(self).items() if val is not None
+            key.replace("_", " "): val for key, val in _shallow_asdict(self).items() if val is not None
         }
         if "private" in info:
             info["private"] = 1 if info["private"] else 0
         if "files" in info:
-            info["files"] = [
-                {
-                    "path": file["name"].split("/"),
-                    "length": file["length"]
-                }
-                for file in info["files"]
-            ]
+            info["files"] = self.files.to_list()
         return info
 
 
@@ -63,7 +143,7 @@ class SingleFileInfo(IndividualFileInfo, FileInfo):
     def total_length(self) -> int:
         return self.length
 
-    def get_files(self) -> list["IndividualFileInfo"]:
+    def get_files(self) -> Sequence[IndividualFileInfo]:
         return [self]
 
 
@@ -71,14 +151,18 @@ class SingleFileInfo(IndividualFileInfo, FileInfo):
 class MultiFileInfo(FileInfo):
     """the name of the directory in which to store all the files. This is purely advisory."""
     name: str = ""
-    """a list of dictionaries, one for each file"""
-    files: list[IndividualFileInfo] = None
+    """a list of dictionaries, one for each file. Stored as a FileTable"""
+    files: FileTable | list[IndividualFileInfo] = None
+
+    def __post_init__(self):
+        if not isinstance(self.files, FileTable):
+            self.files = FileTable.from_files(self.files or [])
 
     @property
     def total_length(self) -> int:
-        return sum([file.length for file in self.files])
+        return self.files.total_length
 
-    def get_files(self) -> list["IndividualFileInfo"]:
+    def get_files(self) -> FileTable:
         return self.files
 
 
@@ -112,30 +196,48 @@ class TorrentMetaInfo:
         return [self.announce]
 
     @classmethod
-    def from_dict(cls, data):
-        info_hash = sha1(benencode(data.get("info"))).digest()
+    def from_dict(cls, data, info_hash: bytes = None):
+        if info_hash is None:
+            info_hash = sha1(benencode(data.get("info"))).digest()
         info = _format_keys(data.pop("info"))
         if "private" in info:
             info["private"] = info["private"] == 1
         if "files" in info:
-            info["files"] = [IndividualFileInfo(
-                name=os.path.join(*file.pop("path")),
-                **file
-            ) for file in info["files"]]
+            info["files"] = FileTable.from_dicts(info["files"])
             info = MultiFileInfo(**info)
         else:
             info = SingleFileInfo(**info)
         return cls(info=info, info_hash=info_hash, **_format_keys(data, cls))
 
+    @classmethod
+    def from_bytes(cls, data):
+        decoded, spans = bendecode_view(data)
+        if "info" not in spans:
+            raise ValueError("metainfo has no info dict")
+        # hash the info dict as it was encoded, not as we would re-encode it
+        info_start, info_end = spans["info"]
+        info_hash = sha1(memoryview(data)[info_start: info_end]).digest()
+        # pieces stays a view over data
+        decoded = decode_bytestrings(decoded, raw_keys=("pieces",))
+        return cls.from_dict(decoded, info_hash=info_hash)
+
     def encode(self):
-        data = dataclasses.asdict(self)
+        data = _shallow_asdict(self)
+        # info_hash is not part of the file, it is computed from the info dict
+        data.pop("info_hash")
         to_encode = {
             key.replace("_", " "): val for key, val in data.items() if val is not None
         }
+        if "announce list" in to_encode:
+            to_encode["announce-list"] = to_encode.pop("announce list")
         to_encode["info"] = self.info.to_dict()
         return benencode(to_encode)
 
 
 def load_torrent_metadata(torrent_path):
     with open(torrent_path, "rb") as f:
-        return TorrentMetaInfo.from_dict(bendecode(f.read()))
+        return TorrentMetaInfo.from_bytes(f.read())
+
+
+def _shallow_asdict(obj) -> dict:
+    return {f.name: getattr(obj, f.name) for f in dataclasses.fields(obj)}
@@ -6,19 +6,57 @@ from typing import ClassVar
 
 PSTR = b"BitTorrent protocol"
 PSTR_PREFIX = struct.pack("!B", len(PSTR)) + PSTR
+# initial size of an Outbox
+OUTBOX_SIZE = 2 ** 16
+
+# length prefix and id, then the fields
+_HAVE = struct.Struct("!IBI")
+_REQUEST = struct.Struct("!IB3I")
+_PIECE_HEADER = struct.Struct("!IB2I")
 
 
 async def read_msg(reader: StreamReader) -> "PeerMessage":
     length = struct.unpack("!I", await reader.readexactly(4))[0]
     if length:
-        data = await reader.readexactly(length)
-        msg_type_id, data = struct.unpack("!B", data[:1])[0], data[1:]
-        msg_type = id_to_msg_class(msg_type_id)
-        msg = msg_type.decode(data)
-        return msg
+        return decode_msg(await reader.readexactly(length))
     return KeepAliveMessage()
 
 
+def decode_msg(data: bytes) -> "PeerMessage":
+    """
+        Decode a message from its id and payload (without the length prefix), without copying them: the block of a
+        PieceMessage is a view of data
+    """
+    data = memoryview(data)
+    return id_to_msg_class(data[0]).decode(data[1:])
+
+
+class Outbox:
+    """Messages encoded one after the other into a reusable buffer, to be sent together"""
+
+    def __init__(self, size: int = OUTBOX_SIZE):
+        self.buffer = bytearray(size)
+        self.length = 0
+
+    def reserve(self, size: int) -> int:
+        """
+            Make room for size more bytes
+            returns their offset in buffer
+        """
+        offset = self.length
+        if offset + size > len(self.buffer):
+            self.buffer.extend(bytes(max(len(self.buffer), offset + size - len(self.buffer))))
+        self.length += size
+        return offset
+
+    def append(self, data: bytes):
+        offset = self.reserve(len(data))
+        self.buffer[offset: offset + len(data)] = data
+
+    def clear(self):
+        self.length = 0
+
+
 def id_to_msg_class(id: int):
     match id:
         case ChokeMessage.id:
@@ -56,6 +94,9 @@ class PeerMessage(ABC):
         data = (struct.pack("!B", self.id) if self.id else b"") + self.encoded_data()
         return struct.pack("!I", len(data)) + data
 
+    def encode_into(self, outbox: Outbox):
+        outbox.append(self.encode())
+
     @classmethod
     def decode(cls, data: bytes):
         return cls()
@@ -116,6 +157,9 @@ class HaveMessage(PeerMessage):
     def encoded_data(self) -> bytes:
         return struct.pack("!I", self.piece_index)
 
+    def encode_into(self, outbox: Outbox):
+        _HAVE.pack_into(outbox.buffer, outbox.reserve(_HAVE.size), 5, self.id, self.piece_index)
+
     @classmethod
     def decode(cls, data: bytes):
         return cls(piece_index=struct.unpack("!I", data)[0])
@@ -160,12 +204,17 @@ class RequestMessage(PeerMessage):
     def encoded_data(self) -> bytes:
         return struct.pack("!3I", self.index, self.begin, self.length)
 
+    def encode_into(self, outbox: Outbox):
+        _REQUEST.pack_into(outbox.buffer, outbox.reserve(_REQUEST.size), 13, self.id, self.index, self.begin,
+                           self.length)
+
 
 @dataclass
 class PieceMessage(PeerMessage):
     index: int
     begin: int
-    block: bytes = field(repr=False)
+    # a view of the received data when decoded
+    block: bytes | memoryview = field(repr=False)
     id = 7
 
     @classmethod
@@ -176,6 +225,13 @@ class PieceMessage(PeerMessage):
     def encoded_data(self) -> bytes:
         return struct.pack("!2I", self.index, self.begin) + self.block
 
+    def encode_into(self, outbox: Outbox):
+        # the block is copied once, into the outbox
+        length = len(self.block)
+        offset = outbox.reserve(_PIECE_HEADER.size + length)
+        _PIECE_HEADER.pack_into(outbox.buffer, offset, 9 + length, self.id, self.index, self.begin)
+        outbox.buffer[offset + _PIECE_HEADER.size: offset + _PIECE_HEADER.size + length] = self.block
+
 
 @dataclass
 class CancelMessage(RequestMessage):
@@ -1,27 +1,70 @@
 import asyncio
 import time
+from collections import deque
+from math import ceil
 
 from guit_torrent.metainfo import TorrentMetaInfo
 from guit_torrent.peer.messages import ChokeMessage, UnchokeMessage, InterestedMessage, NotInterestedMessage, \
     HaveMessage, BitfieldMessage, RequestMessage, PieceMessage, CancelMessage, PortMessage, KeepAliveMessage, \
-    HandshakeMessage, read_msg
+    HandshakeMessage
+from guit_torrent.peer.protocol import PeerProtocol, PeerProtocolError, open_connection
+from guit_torrent.torrentdata import BLOCK_SIZE, REQUEST_TIMEOUT, TorrentBlock
 from guit_torrent.ui import console
 
 KEEP_ALIVE_INTERVAL = 2 * 60
-BLOCKS_TO_QUEUE = 50
+# blocks requested from a peer at once (its window): enough to keep its link busy for its round trip time plus
+# WINDOW_QUEUE_TIME seconds, at the rate it delivers
+MIN_REQUEST_WINDOW = 2
+MAX_REQUEST_WINDOW = 500
+INITIAL_REQUEST_WINDOW = 8
+WINDOW_QUEUE_TIME = 2
+# seconds over which the download rate is measured
+RATE_SAMPLE_INTERVAL = 1
+# weight of a new sample in the moving averages of the rate and round trip time
+RATE_SMOOTHING = 0.3
+RTT_SMOOTHING = 0.125
+# requests not answered after REQUEST_TIMEOUT_RTTS round trip times (bounded) are given to other peers
+REQUEST_TIMEOUT_RTTS = 4
+MIN_REQUEST_TIMEOUT = 5
+INITIAL_REQUEST_TIMEOUT = 30
+REQUEST_CHECK_INTERVAL = 1
+# more blocks are asked for once this fraction of the window is free, rather than on every block received
+REFILL_WINDOW_FRACTION = 0.25
+# requests from a peer waiting to be served. more are ignored
+MAX_QUEUED_REQUESTS = 250
 
 class PeerConnectError(Exception):
     pass
 
 
 class Peer:
-    def __init__(self, torrent: TorrentMetaInfo, our_peer_id: str, host: tuple[str, int], block_received_cb):
+    def __init__(self, torrent: TorrentMetaInfo, our_peer_id: str, host: tuple[str, int], block_received_cb,
+                 read_block_cb=None, get_pieces_cb=None, min_window: int = MIN_REQUEST_WINDOW,
+                 max_window: int = MAX_REQUEST_WINDOW, requests_released_cb=None, pieces_available_cb=None,
+                 can_request_cb=None):
+        """
+            read_block_cb: async (piece index, begin, length) -> data of a block requested by the peer, or None if we
+            can not serve it
+            get_pieces_cb: () -> set of the pieces we have, sent in a bitfield after the handshake
+            min_window, max_window: bounds of the number of blocks requested at once
+            requests_released_cb: (peer, blocks) -> None, called with the blocks requested from the peer, or queued to
+            be, that can be requested from others (choked, disconnected or timed out)
+            pieces_available_cb: (peer, pieces) -> None, called with the pieces the peer announces it has, that it did
+            not have before
+            can_request_cb: (peer) -> None, called when more blocks can be requested from the peer (unchoked us, or
+            REFILL_WINDOW_FRACTION of its window is free)
+        """
         self.torrent = torrent
         self.our_peer_id = our_peer_id
 
         self.address, self.port = host
 
         self.block_received_cb = block_received_cb
+        self.read_block_cb = read_block_cb
+        self.get_pieces_cb = get_pieces_cb
+        self.requests_released_cb = requests_released_cb
+        self.pieces_available_cb = pieces_available_cb
+        self.can_request_cb = can_request_cb
 
         self.alive = False
         self.starting = True
@@ -33,14 +76,39 @@ class Peer:
 
         self.available_pieces = set()
         self.blocks_to_request = asyncio.Queue()
-        self.blocks_requested = asyncio.Semaphore(BLOCKS_TO_QUEUE)
+        # taken from blocks_to_request, waiting for an unchoke or room in the window
+        self.next_block: TorrentBlock | None = None
+        # (piece index, begin) -> (block, when it was requested), oldest first
+        self.requested: dict[tuple[int, int], tuple[TorrentBlock, float]] = {}
+        self.request_slot_available = asyncio.Event()
+        self.min_window = min_window
+        self.max_window = max_window
+        self.window = max(min_window, min(max_window, INITIAL_REQUEST_WINDOW))
+        # bytes per second and seconds, moving averages
+        self.rate = 0.0
+        self.rtt: float | None = None
+        self.min_rtt: float | None = None
+        self._rate_sample_start = time.monotonic()
+        self._rate_sample_bytes = 0
+        self.downloaded = 0
+        self.timeouts = 0
+        self.released = 0
+        self.cancelled = 0
 
-        self.writer = None
-        self.reader = None
+        # uploads
+        self.requests_to_serve: deque[RequestMessage] = deque()
+        self.requests_available = asyncio.Event()
+        # request being read, None if it was cancelled
+        self.serving: RequestMessage | None = None
+        self.uploaded = 0
+
+        self.connection: PeerProtocol | None = None
 
         self.main_task = None
         self.request_future = None
+        self.serve_future = None
         self.keep_alive_future = None
+        self.watch_requests_future = None
 
     @property
     def host(self):
@@ -51,34 +119,222 @@ class Peer:
         self.alive = False
         if self.request_future:
             self.request_future.cancel()
+        if self.serve_future:
+            self.serve_future.cancel()
         if self.keep_alive_future:
             self.keep_alive_future.cancel()
-        if self.writer:
-            self.writer.close()
+        if self.watch_requests_future:
+            self.watch_requests_future.cancel()
+        self.release_requests()
+        if self.connection:
+            self.connection.close()
             try:
-                await self.writer.wait_closed()
+                await self.connection.wait_closed()
             except Exception:
                 pass
         if self.main_task:
             self.main_task.cancel()
 
-    def start(self):
+    def start(self, connection: PeerProtocol = None):
+        """connection: opened by the peer, whose handshake was read (see PeerServer)"""
+        self.connection = connection
         self.main_task = asyncio.create_task(self._start())
 
     def __str__(self):
         return f"{self.address}:{self.port}"
 
     async def send_message(self, msg):
-        console.log(f"{msg} -> {self}")
-        self.writer.write(msg.encode())
-        await self.writer.drain()
+        self.connection.send(msg)
+        await self.connection.drain()
+
+    def express_interest(self):
+        """tell the peer we want pieces it has, so that it unchokes us"""
+        if self.alive and not self.am_interested:
+            self.am_interested = True
+            self.connection.send(InterestedMessage())
+
+    def send_have(self, piece_index: int):
+        # small enough not to wait for the write buffer to drain, sent with the other messages of this iteration
+        if self.alive:
+            self.connection.send(HaveMessage(piece_index))
+
+    async def serve_requests(self):
+        while True:
+            if not self.requests_to_serve:
+                self.requests_available.clear()
+                await self.requests_available.wait()
+                continue
+            request = self.serving = self.requests_to_serve.popleft()
+            try:
+                data = await self.read_block_cb(request.index, request.begin, request.length)
+            except OSError as e:
+                # only this request is dropped, the others may be readable
+                console.log(f"[red]Could not read block [{request.index}, {request.begin}] for {self}: {e}")
+                data = None
+            if self.serving is None or data is None:
+                # cancelled while reading, or invalid
+                continue
+            self.serving = None
+            await self.send_message(PieceMessage(index=request.index, begin=request.begin, block=data))
+            self.uploaded += len(data)
+
+    def block_arrived(self, piece_index: int, begin: int, length: int):
+        request = self.requested.pop((piece_index, begin), None)
+        if request is None:
+            # not requested, or not anymore (timed out)
+            return
+        _, requested_at = request
+        now = time.monotonic()
+        rtt = now - requested_at
+        self.rtt = rtt if self.rtt is None else self.rtt + RTT_SMOOTHING * (rtt - self.rtt)
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.downloaded += length
+        self._rate_sample_bytes += length
+        elapsed = now - self._rate_sample_start
+        if elapsed >= RATE_SAMPLE_INTERVAL:
+            rate = self._rate_sample_bytes / elapsed
+            self.rate = rate if not self.rate else self.rate + RATE_SMOOTHING * (rate - self.rate)
+            self._rate_sample_start, self._rate_sample_bytes = now, 0
+            self._update_window()
+        self._slots_freed()
+
+    @property
+    def request_room(self) -> int:
+        """blocks that can be queued: requests in flight and blocks queued both count in the window"""
+        return self.window - len(self.requested) - self.blocks_to_request.qsize()
+
+    @property
+    def request_timeout(self) -> float:
+        if self.rtt is None:
+            return INITIAL_REQUEST_TIMEOUT
+        return max(MIN_REQUEST_TIMEOUT, min(REQUEST_TIMEOUT, self.rtt * REQUEST_TIMEOUT_RTTS))
+
+    def release_requests(self):
+        """
+            Give the blocks requested from the peer, or queued to be, back to the picker
+        """
+        released = [block for block, _ in self.requested.values()]
+        if self.next_block is not None:
+            released.append(self.next_block)
+            self.next_block = None
+        while not self.blocks_to_request.empty():
+            released.append(self.blocks_to_request.get_nowait())
+        self.requested.clear()
+        self._release(released)
+
+    def expire_requests(self) -> int:
+        """
+            Release the requests older than the request timeout, and shrink the window
+            returns the number of requests released
+        """
+        now = time.monotonic()
+        timeout = self.request_timeout
+        expired = []
+        for key, (block, requested_at) in self.requested.items():
+            if now - requested_at < timeout:
+                # the others are more recent
+                break
+            expired.append(key)
+        if not expired:
+            return 0
+        released = [self.requested.pop(key)[0] for key in expired]
+        self.timeouts += len(expired)
+        self._reset_window(self.min_window)
+        self._release(released + self._trim_queue())
+        return len(expired)
+
+    def cancel_request(self, piece_index: int, begin: int, length: int) -> bool:
+        """
+            Cancel a request, when the block was received from another peer
+            returns whether the block was requested
+        """
+        if self.requested.pop((piece_index, begin), None) is None:
+            return False
+        if self.alive:
+            self.connection.send(CancelMessage(index=piece_index, begin=begin, length=length))
+        self.cancelled += 1
+        self._slots_freed()
+        return True
+
+    def _slots_freed(self):
+        self.request_slot_available.set()
+        if self.can_request_cb and self.request_room >= max(1, int(self.window * REFILL_WINDOW_FRACTION)):
+            self.can_request_cb(self)
+
+    def _release(self, blocks: list[TorrentBlock]):
+        for block in blocks:
+            if not block.downloaded:
+                # requestable right away
+                block.last_requested = None
+        self.released += len(blocks)
+        self.request_slot_available.set()
+        if blocks and self.requests_released_cb:
+            self.requests_released_cb(self, blocks)
+
+    async def watch_requests(self):
+        while True:
+            await asyncio.sleep(REQUEST_CHECK_INTERVAL)
+            self.expire_requests()
+
+    def _reset_window(self, window: int):
+        self.window = max(self.min_window, min(self.max_window, window))
+        self.rate = 0.0
+        self._rate_sample_start = time.monotonic()
+        self._rate_sample_bytes = 0
+
+    def _update_window(self):
+        # bandwidth-delay product, in blocks. min_rtt leaves out the time requests wait in the peer's queue
+        target = self.rate * (self.min_rtt + WINDOW_QUEUE_TIME) / BLOCK_SIZE
+        window = max(self.min_window, min(self.max_window, ceil(target)))
+        shrunk = window < self.window
+        self.window = window
+        if shrunk:
+            trimmed = self._trim_queue()
+            if trimmed:
+                self._release(trimmed)
+
+    def queued_blocks(self) -> list[TorrentBlock]:
+        """the blocks waiting to be requested, in order"""
+        queued = [self.blocks_to_request.get_nowait() for _ in range(self.blocks_to_request.qsize())]
+        for block in queued:
+            self.blocks_to_request.put_nowait(block)
+        if self.next_block is not None:
+            queued.insert(0, self.next_block)
+        return queued
+
+    def _trim_queue(self) -> list[TorrentBlock]:
+        """
+            Take the queued blocks that do not fit in the window anymore out of the queue
+            returns them, to be released
+        """
+        keep = max(0, self.window - len(self.requested))
+        if self.blocks_to_request.qsize() <= keep:
+            return []
+        queued = [self.blocks_to_request.get_nowait() for _ in range(self.blocks_to_request.qsize())]
+        for block in queued[:keep]:
+            self.blocks_to_request.put_nowait(block)
+        return queued[keep:]
+
+    def stats(self) -> dict:
+        return {
+            "window": self.window,
+            "in_flight": len(self.requested),
+            "rate": self.rate,
+            "rtt": self.rtt,
+            "min_rtt": self.min_rtt,
+            "downloaded": self.downloaded,
+            "uploaded": self.uploaded,
+            "request_timeout": self.request_timeout,
+            "timeouts": self.timeouts,
+            "released": self.released,
+            "cancelled": self.cancelled,
+        }
 
     async def request_blocks(self):
         await self.send_message(UnchokeMessage())
         self.peer_choking = False
         while True:
-            block = await self.blocks_to_request.get()
-            block.last_requested = time.time()
+            block = self.next_block = await self.blocks_to_request.get()
             # console.log(f"Block ready to be requested to {self}")
             if not self.am_interested:
                 self.am_interested = True
@@ -87,59 +343,105 @@ class Peer:
             # wait for unchoke
             await self.am_not_choking.wait()
             # console.log(f"{self} unchoked! proceeding")
-            # can we request it? - acquire space in requested queue
+            # can we request it? - wait for room in the window
             # console.log(f"waiting for queue space in {self}")
-            await self.blocks_requested.acquire()
-            # send the message!
-            await self.send_message(RequestMessage(
+            while len(self.requested) >= self.window:
+                self.request_slot_available.clear()
+                await self.request_slot_available.wait()
+            if block is not self.next_block or block.downloaded or (block.piece_id, block.begin) in self.requested:
+                # released (choked), received from another peer in the meantime, or queued twice (endgame)
+                continue
+            self.next_block = None
+            if not self.requested:
+                # the time the peer had nothing to send us does not count in its rate
+                self._rate_sample_start = time.monotonic()
+                self._rate_sample_bytes = 0
+            block.last_requested = time.time()
+            self.requested[(block.piece_id, block.begin)] = (block, time.monotonic())
+            # send the message! requests are written together, and drained once none are left to queue
+            self.connection.send(RequestMessage(
                 index=block.piece_id,
                 begin=block.begin,
                 length=block.length
             ))
+            if self.blocks_to_request.empty():
+                await self.connection.drain()
             # console.log(f"Requesting block [{block.piece_id}, {block.begin}] from {self}")
 
     async def connect(self):
         self.starting = True
-        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.address, self.port), 15)
+        self.connection = await asyncio.wait_for(open_connection(self.address, self.port), 15)
         # handshake
         handshake_msg = HandshakeMessage(info_hash=self.torrent.info_hash, peer_id=self.our_peer_id)
         await self.send_message(handshake_msg)
 
-        handshake_res = HandshakeMessage.decode(await self.reader.read(HandshakeMessage.len()))
+        handshake_res = HandshakeMessage.decode(await self.connection.readexactly(HandshakeMessage.len()))
         # check if info_hash matches
         if handshake_res.info_hash != self.torrent.info_hash:
             raise PeerConnectError("Handshake mismatch")
+        await self._connected()
+
+    async def accept(self):
+        self.starting = True
+        # the peer's handshake was already read
+        await self.send_message(HandshakeMessage(info_hash=self.torrent.info_hash, peer_id=self.our_peer_id))
+        await self._connected()
+
+    async def _connected(self):
         self.starting = False
         self.alive = True
         console.log(f"Connected to peer {self} {self.alive=}")
+        if self.get_pieces_cb:
+            pieces = self.get_pieces_cb()
+            if pieces:
+                await self.send_message(BitfieldMessage(pieces=pieces, nr_bytes=(self.torrent.info.nr_pieces + 7) // 8))
 
     async def handle_message(self):
-        msg = await read_msg(self.reader)
-        console.log(f"{self} -> {msg}")
+        # msg is only valid until the next message is read
+        msg = await self.connection.read_msg()
+        # console.log(f"{self} -> {msg}")
         match msg:
             case ChokeMessage():
                 # console.log(f"{self} choked us!")
                 self.am_not_choking.clear()
+                # the peer discards our requests
+                self.release_requests()
+                self._reset_window(INITIAL_REQUEST_WINDOW)
             case UnchokeMessage():
                 # console.log(f"{self} unchoked us!")
                 self.am_not_choking.set()
+                if self.can_request_cb:
+                    self.can_request_cb(self)
             case InterestedMessage():
                 self.peer_interested = True
             case NotInterestedMessage():
                 self.peer_interested = False
             case HaveMessage():
-                self.available_pieces.add(msg.piece_index)
+                if msg.piece_index < self.torrent.info.nr_pieces and msg.piece_index not in self.available_pieces:
+                    self.available_pieces.add(msg.piece_index)
+                    if self.pieces_available_cb:
+                        self.pieces_available_cb(self, [msg.piece_index])
             case BitfieldMessage():
-                self.available_pieces |= msg.pieces
+                # without the spare bits at the end
+                pieces = {piece for piece in msg.pieces if piece < self.torrent.info.nr_pieces} - self.available_pieces
+                self.available_pieces |= pieces
+                if pieces and self.pieces_available_cb:
+                    self.pieces_available_cb(self, pieces)
+            case CancelMessage():
+                request = RequestMessage(index=msg.index, begin=msg.begin, length=msg.length)
+                if self.serving == request:
+                    self.serving = None
+                elif request in self.requests_to_serve:
+                    self.requests_to_serve.remove(request)
             case RequestMessage():
-                raise NotImplementedError
+                if self.read_block_cb and len(self.requests_to_serve) < MAX_QUEUED_REQUESTS:
+                    self.requests_to_serve.append(msg)
+                    self.requests_available.set()
             case PieceMessage():
-                console.log(f"[red]{self} sent us block [{msg.index}, {msg.begin}]")
+                # console.log(f"[red]{self} sent us block [{msg.index}, {msg.begin}]")
+                self.block_arrived(msg.index, msg.begin, len(msg.block))
                 if self.block_received_cb:
                     await self.block_received_cb(msg)
-                self.blocks_requested.release()
-            case CancelMessage():
-                raise NotImplementedError
             case PortMessage():
                 raise NotImplementedError
             case KeepAliveMessage():
@@ -154,16 +456,22 @@ class Peer:
 
     async def _start(self):
         try:
-            await self.connect()
+            if self.connection:
+                await self.accept()
+            else:
+                await self.connect()
             self.keep_alive_future = asyncio.create_task(self.keep_alive())
             self.request_future = asyncio.create_task(self.request_blocks())
+            self.watch_requests_future = asyncio.create_task(self.watch_requests())
+            if self.read_block_cb:
+                self.serve_future = asyncio.create_task(self.serve_requests())
             # self.request_future.add_done_callback(lambda future: future.exception())
             while self.alive:
                 await self.handle_message()
-        except (PeerConnectError, ConnectionResetError, ConnectionRefusedError,
+        except (PeerConnectError, PeerProtocolError, ConnectionResetError, ConnectionRefusedError,
                 asyncio.TimeoutError, OSError, asyncio.IncompleteReadError):
             if not self.starting:
-                console.log(f"[red]Connection with {self} dropped.")
+                console.log(f"[red]Connection with {self} dropped. {self.stats()}")
         except Exception as e:
             raise e
         finally:
@@ -0,0 +1,207 @@
+import asyncio
+import struct
+
+from guit_torrent.peer.messages import PeerMessage, KeepAliveMessage, Outbox, decode_msg
+
+# bytes received at once, enough for many blocks
+BUFFER_SIZE = 2 ** 18
+# longest message accepted: a bitfield of 2 ** 25 pieces
+MAX_MESSAGE_LENGTH = 2 ** 22
+
+_LENGTH = struct.Struct("!I")
+
+
+class PeerProtocolError(Exception):
+    pass
+
+
+class PeerProtocol(asyncio.BufferedProtocol):
+    """Connection to a peer, reading length prefixed messages straight from a reusable receive buffer instead of
+    through a StreamReader (which copies each message into new bytes objects).
+    Messages returned by read_msg may refer to that buffer: the block of a PieceMessage is a memoryview that is only
+    valid until the next call to read_msg.
+    Messages sent are encoded into an outbox, written to the socket at once at the next iteration of the event loop:
+    all the messages sent by the peer's tasks in between make a single write. drain applies backpressure to the
+    senders, that call it once per batch of messages."""
+
+    def __init__(self, connection_made_cb=None, buffer_size: int = BUFFER_SIZE):
+        # connection_made_cb(protocol) is called once connected
+        self.connection_made_cb = connection_made_cb
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        # data received and not parsed yet is in [_start, _end[
+        self._start = 0
+        self._end = 0
+        self.transport: asyncio.Transport | None = None
+        self._read_waiter: asyncio.Future | None = None
+        self._reading_paused = False
+        self._drain_waiter: asyncio.Future | None = None
+        self._writing_paused = False
+        self.outbox = Outbox()
+        self._flush_handle: asyncio.Handle | None = None
+        self._closed = asyncio.get_running_loop().create_future()
+        self._exception: Exception | None = None
+        self._eof = False
+        # stats
+        self.bytes_received = 0
+        self.messages_received = 0
+        self.messages_sent = 0
+        self.writes = 0
+
+    # asyncio.BufferedProtocol
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        if self.connection_made_cb:
+            self.connection_made_cb(self)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        # never where messages returned by read_msg may still be used
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        self._end += nbytes
+        self.bytes_received += nbytes
+        if self._end == len(self._buffer):
+            # until read_msg makes room
+            self.transport.pause_reading()
+            self._reading_paused = True
+        self._wake_reader()
+
+    def eof_received(self):
+        self._eof = True
+        self._wake_reader()
+        # close the transport
+        return False
+
+    def connection_lost(self, exc: Exception | None):
+        self._eof = True
+        self._exception = exc
+        self._wake_reader()
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_exception(exc or ConnectionResetError("connection lost"))
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    def _wake_reader(self):
+        if self._read_waiter is not None and not self._read_waiter.done():
+            self._read_waiter.set_result(None)
+
+    # reading
+
+    async def read_msg(self) -> PeerMessage:
+        """the messages returned before must not be used anymore"""
+        while True:
+            available = self._end - self._start
+            if available >= 4:
+                length = _LENGTH.unpack_from(self._buffer, self._start)[0]
+                if length > MAX_MESSAGE_LENGTH:
+                    raise PeerProtocolError(f"message of {length} bytes")
+                if available >= 4 + length:
+                    begin = self._start + 4
+                    self._start = begin + length
+                    self.messages_received += 1
+                    return decode_msg(self._view[begin: self._start]) if length else KeepAliveMessage()
+                await self._wait_for_data(4 + length)
+            else:
+                await self._wait_for_data(4)
+
+    async def readexactly(self, n: int) -> bytes:
+        while self._end - self._start < n:
+            await self._wait_for_data(n)
+        data = bytes(self._view[self._start: self._start + n])
+        self._start += n
+        return data
+
+    async def _wait_for_data(self, needed: int):
+        """wait until more data is received, with room in the buffer for `needed` bytes from _start"""
+        if self._eof:
+            if self._exception is not None:
+                raise self._exception
+            raise asyncio.IncompleteReadError(bytes(self._view[self._start: self._end]), needed)
+        self._make_room(needed)
+        self._read_waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self._read_waiter
+        finally:
+            self._read_waiter = None
+
+    def _make_room(self, needed: int):
+        if self._start + needed <= len(self._buffer):
+            return
+        pending = self._end - self._start
+        if needed > len(self._buffer):
+            # a message longer than the buffer (large bitfield)
+            buffer = bytearray(needed)
+            buffer[:pending] = self._view[self._start: self._end]
+            self._buffer, self._view = buffer, memoryview(buffer)
+        elif pending:
+            # move the partial message to the front
+            self._buffer[:pending] = bytes(self._view[self._start: self._end])
+        self._start, self._end = 0, pending
+        if self._reading_paused:
+            self._reading_paused = False
+            self.transport.resume_reading()
+
+    # writing
+
+    def send(self, msg: PeerMessage):
+        msg.encode_into(self.outbox)
+        self.messages_sent += 1
+        self._schedule_flush()
+
+    def write(self, data: bytes):
+        self.outbox.append(data)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self.outbox.length and not self.transport.is_closing():
+            # a copy: the transport may keep what the socket does not take at once, and the outbox is reused
+            self.transport.write(bytes(memoryview(self.outbox.buffer)[:self.outbox.length]))
+            self.writes += 1
+        self.outbox.clear()
+
+    async def drain(self):
+        """send the queued messages now, and wait while the transport's write buffer is full"""
+        self._flush()
+        if self._exception is not None:
+            raise self._exception
+        if self.transport.is_closing():
+            raise ConnectionResetError("connection lost")
+        if self._writing_paused:
+            self._drain_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._drain_waiter
+            finally:
+                self._drain_waiter = None
+
+    def get_extra_info(self, name: str, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def close(self):
+        if self.transport is not None:
+            self._flush()
+            self.transport.close()
+
+    async def wait_closed(self):
+        await self._closed
+
+
+async def open_connection(host: str, port: int) -> PeerProtocol:
+    _, protocol = await asyncio.get_running_loop().create_connection(PeerProtocol, host, port)
+    return protocol
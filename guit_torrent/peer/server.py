@@ -0,0 +1,119 @@
+import asyncio
+
+from guit_torrent.peer.messages import HandshakeMessage, PSTR_PREFIX
+from guit_torrent.peer.protocol import PeerProtocol
+from guit_torrent.ui import console
+
+# port announced to the trackers
+DEFAULT_PORT = 6888
+DEFAULT_BIND = "0.0.0.0"
+# incoming connections kept at once, over all torrents
+MAX_INCOMING = 200
+# incoming connections kept at once for a torrent
+MAX_INCOMING_PER_TORRENT = 50
+# seconds a new connection has to send its handshake
+HANDSHAKE_TIMEOUT = 10
+
+
+class PeerServer:
+    """Listens for connections from peers, and hands them to the torrent whose info_hash they ask for in their
+    handshake (see register). The torrent answers the handshake and runs the connection like one it opened."""
+
+    def __init__(self, host: str = DEFAULT_BIND, port: int = DEFAULT_PORT, max_connections: int = MAX_INCOMING):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        # info_hash -> (accept_cb, max connections)
+        self._torrents: dict[bytes, tuple] = {}
+        # info_hash -> peers accepted for the torrent
+        self._peers: dict[bytes, list] = {}
+        self._server: asyncio.AbstractServer | None = None
+        # connections whose handshake is being read
+        self._handshakes: set[asyncio.Task] = set()
+        # stats
+        self.accepted = 0
+        self.refused = 0
+
+    def register(self, info_hash: bytes, accept_cb, max_connections: int = MAX_INCOMING_PER_TORRENT):
+        """
+            accept_cb: (host, connection: PeerProtocol) -> the started Peer running the connection, or None to refuse
+            it. The handshake of the peer has been read, ours is not sent yet
+        """
+        self._torrents[info_hash] = (accept_cb, max_connections)
+        self._peers.setdefault(info_hash, [])
+
+    def unregister(self, info_hash: bytes):
+        self._torrents.pop(info_hash, None)
+        self._peers.pop(info_hash, None)
+
+    @property
+    def nr_connections(self) -> int:
+        return sum(len(self._connected_peers(info_hash)) for info_hash in self._peers)
+
+    def _connected_peers(self, info_hash: bytes) -> list:
+        peers = self._peers[info_hash] = [peer for peer in self._peers[info_hash] if peer.alive or peer.starting]
+        return peers
+
+    async def start(self):
+        self._server = await asyncio.get_running_loop().create_server(
+            lambda: PeerProtocol(self._connection_made), self.host, self.port)
+        # the port picked by the system if it was 0
+        self.port = self._server.sockets[0].getsockname()[1]
+        console.log(f"Listening for peers on {self.host}:{self.port}")
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+        # their connections are closed
+        for task in list(self._handshakes):
+            task.cancel()
+        await asyncio.gather(*self._handshakes, return_exceptions=True)
+        if self._server:
+            await self._server.wait_closed()
+            self._server = None
+
+    def _connection_made(self, connection: PeerProtocol):
+        task = asyncio.create_task(self._handle_connection(connection))
+        self._handshakes.add(task)
+        task.add_done_callback(self._handshake_done)
+
+    def _handshake_done(self, task: asyncio.Task):
+        self._handshakes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            console.log(f"[red]Error handling an incoming connection: {task.exception()!r}")
+
+    async def _handle_connection(self, connection: PeerProtocol):
+        host = connection.get_extra_info("peername")[:2]
+        try:
+            if self.nr_connections >= self.max_connections:
+                raise ConnectionRefusedError("too many connections")
+            data = await asyncio.wait_for(connection.readexactly(HandshakeMessage.len()), HANDSHAKE_TIMEOUT)
+            if not data.startswith(PSTR_PREFIX):
+                raise ConnectionRefusedError("not a bittorrent handshake")
+            handshake = HandshakeMessage.decode(data)
+            if handshake.info_hash not in self._torrents:
+                raise ConnectionRefusedError("unknown torrent")
+            accept_cb, max_connections = self._torrents[handshake.info_hash]
+            if len(self._connected_peers(handshake.info_hash)) >= max_connections:
+                raise ConnectionRefusedError("too many connections for the torrent")
+            peer = accept_cb(host, connection)
+            if peer is None:
+                raise ConnectionRefusedError("refused by the torrent")
+        except (ConnectionRefusedError, asyncio.TimeoutError, asyncio.IncompleteReadError, OSError) as e:
+            self.refused += 1
+            console.log(f"[yellow]Refused connection from {host[0]}:{host[1]}: {e}")
+            connection.close()
+            return
+        except asyncio.CancelledError:
+            # server closed
+            connection.close()
+            raise
+        self.accepted += 1
+        self._peers[handshake.info_hash].append(peer)
+
+    def stats(self) -> dict:
+        return {
+            "connections": self.nr_connections,
+            "accepted": self.accepted,
+            "refused": self.refused,
+        }
@@ -0,0 +1,183 @@
+import random
+from array import array
+from collections.abc import Iterable, Iterator
+
+from guit_torrent.torrentdata import Torrent, TorrentBlock, PRIORITY_HIGH, PRIORITY_SKIP
+
+
+class PiecePicker:
+    """Chooses the blocks to request: pieces already started first, then by priority, then rarest first (the
+    pieces the fewest peers have), in random order among pieces as rare, so that peers do not all go for the same
+    ones.
+    The number of peers having each piece is updated as peers send their bitfield, have messages and disconnect.
+    Wanted pieces that are not confirmed are kept in buckets by priority and availability, so that picking does not
+    sort or scan every piece. Pieces whose blocks are all requested leave the buckets until some are released, so
+    that picking does not go through the blocks in flight either."""
+
+    def __init__(self, torrent: Torrent, rng: random.Random = None):
+        self.torrent = torrent
+        self.rng = rng or random.Random()
+        # number of peers having each piece
+        self.availability = array("I", bytes(4 * torrent.nr_pieces))
+        # pieces at least one peer has
+        self.available_pieces = 0
+        # priority -> availability -> pieces, and the position of each piece in its bucket
+        self._buckets: list[list[list[int]]] = [[] for _ in range(PRIORITY_HIGH + 1)]
+        self._positions: dict[int, int] = {}
+        # wanted pieces some blocks were picked from, not confirmed yet, with blocks left to request
+        self.partial: set[int] = set()
+        # wanted pieces not confirmed, whose blocks are all requested or downloaded. not in the buckets
+        self.exhausted: set[int] = set()
+        self.rebuild()
+
+    def rebuild(self):
+        """
+            Index the wanted pieces that are not confirmed, after priorities or confirmations changed
+        """
+        self._buckets = [[] for _ in range(PRIORITY_HIGH + 1)]
+        self._positions.clear()
+        # looked at again by the next picks
+        self.exhausted.clear()
+        for piece_id in range(self.torrent.nr_pieces):
+            if self._indexed(piece_id):
+                self._add(piece_id)
+        self.partial = {piece_id for piece_id in self.partial if piece_id in self._positions}
+
+    def _indexed(self, piece_id: int) -> bool:
+        return self.torrent.piece_priority[piece_id] != PRIORITY_SKIP and not self.torrent.piece_confirmed[piece_id]
+
+    def _bucket(self, piece_id: int) -> list[int]:
+        buckets = self._buckets[self.torrent.piece_priority[piece_id]]
+        count = self.availability[piece_id]
+        while len(buckets) <= count:
+            buckets.append([])
+        return buckets[count]
+
+    def _add(self, piece_id: int):
+        bucket = self._bucket(piece_id)
+        self._positions[piece_id] = len(bucket)
+        bucket.append(piece_id)
+
+    def _remove(self, piece_id: int):
+        bucket = self._bucket(piece_id)
+        position = self._positions.pop(piece_id)
+        # swap with the last one
+        last = bucket.pop()
+        if last != piece_id:
+            bucket[position] = last
+            self._positions[last] = position
+
+    def _set_availability(self, piece_id: int, count: int):
+        indexed = piece_id in self._positions
+        if indexed:
+            self._remove(piece_id)
+        if not self.availability[piece_id] and count:
+            self.available_pieces += 1
+        elif self.availability[piece_id] and not count:
+            self.available_pieces -= 1
+        self.availability[piece_id] = count
+        if indexed:
+            self._add(piece_id)
+
+    def add_pieces(self, piece_ids: Iterable[int]):
+        """a peer has these pieces (bitfield or have message), which it did not have before"""
+        for piece_id in piece_ids:
+            self._set_availability(piece_id, self.availability[piece_id] + 1)
+
+    def remove_pieces(self, piece_ids: Iterable[int]):
+        """a peer having these pieces disconnected"""
+        for piece_id in piece_ids:
+            self._set_availability(piece_id, self.availability[piece_id] - 1)
+
+    def piece_confirmed(self, piece_id: int):
+        if piece_id in self._positions:
+            self._remove(piece_id)
+        self.partial.discard(piece_id)
+        self.exhausted.discard(piece_id)
+
+    def blocks_released(self, piece_ids: Iterable[int]):
+        """blocks of these pieces can be requested again (released by a peer, timed out or the piece was invalid)"""
+        for piece_id in piece_ids:
+            if piece_id in self.exhausted:
+                self.exhausted.discard(piece_id)
+                self._add(piece_id)
+            if piece_id in self._positions:
+                # started: finished first
+                self.partial.add(piece_id)
+
+    def recheck_exhausted(self) -> list[int]:
+        """
+            Put back the exhausted pieces with blocks whose request timed out without being released
+            returns these pieces
+        """
+        pieces = [piece_id for piece_id in list(self.exhausted)
+                  if any(not block.downloaded and block.request_timedout
+                         for block in self.torrent.pieces[piece_id].blocks)]
+        self.blocks_released(pieces)
+        return pieces
+
+    def _exhaust(self, piece_id: int):
+        if piece_id in self._positions:
+            self._remove(piece_id)
+            self.exhausted.add(piece_id)
+        self.partial.discard(piece_id)
+
+    def pieces_left(self) -> Iterator[int]:
+        """the wanted pieces that are not confirmed, in no particular order"""
+        return iter(list(self._positions) + list(self.exhausted))
+
+    def pick_pieces(self, peer_pieces: set[int]) -> Iterator[int]:
+        """
+            The pieces to download from a peer having peer_pieces, best first. The buckets must not change until
+            the iteration is over
+        """
+        for piece_id in list(self.partial):
+            if piece_id in peer_pieces:
+                yield piece_id
+        if len(peer_pieces) < len(self._positions):
+            # cheaper to sort the pieces of the peer than to go through the buckets
+            priority, availability = self.torrent.piece_priority, self.availability
+            pieces = [piece_id for piece_id in peer_pieces
+                      if piece_id in self._positions and availability[piece_id] and piece_id not in self.partial]
+            pieces.sort(key=lambda piece_id: (-priority[piece_id], availability[piece_id], self.rng.random()))
+            yield from pieces
+            return
+        for buckets in reversed(self._buckets):
+            # pieces no peer has cannot be requested
+            for bucket in buckets[1:]:
+                if not bucket:
+                    continue
+                # from a random position, so that ties are broken randomly. buckets do not change while picking
+                size = len(bucket)
+                start = self.rng.randrange(size)
+                for i in range(size):
+                    piece_id = bucket[(start + i) % size]
+                    if piece_id in peer_pieces and piece_id not in self.partial:
+                        yield piece_id
+
+    def pick_blocks(self, peer_pieces: set[int], nr_blocks: int) -> list[TorrentBlock]:
+        """
+            Up to nr_blocks blocks to request from a peer having peer_pieces: not downloaded, and not requested (or
+            the request timed out)
+        """
+        picked = []
+        if nr_blocks <= 0:
+            return picked
+        # taken out of the buckets once the pick is over
+        exhausted = []
+        for piece_id in self.pick_pieces(peer_pieces):
+            left = False
+            for block in self.torrent.pieces[piece_id].blocks:
+                if not block.downloaded and block.request_timedout:
+                    if len(picked) == nr_blocks:
+                        left = True
+                        break
+                    picked.append(block)
+                    self.partial.add(piece_id)
+            if not left:
+                exhausted.append(piece_id)
+            if len(picked) == nr_blocks:
+                break
+        for piece_id in exhausted:
+            self._exhaust(piece_id)
+        return picked
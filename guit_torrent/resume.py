@@ -0,0 +1,161 @@
+import os
+from dataclasses import dataclass, field
+
+from guit_torrent.bencoding import benencode, bendecode_view
+from guit_torrent.torrentdata import Torrent
+
+RESUME_SAVE_INTERVAL = 60
+RESUME_FOLDER = ".resume"
+
+
+@dataclass
+class ResumeFileState:
+    """size on disk"""
+    length: int
+    """modification time, in nanoseconds"""
+    mtime_ns: int
+
+
+@dataclass
+class ResumeData:
+    """State of a torrent, saved to avoid verifying unchanged files again on restart"""
+    info_hash: bytes
+    piece_length: int
+    """bitfield of the confirmed pieces"""
+    confirmed: bytes = field(repr=False)
+    """piece_id -> bitfield of the downloaded blocks of pieces that are not confirmed yet"""
+    partial: dict[int, bytes] = field(default_factory=dict, repr=False)
+    """state of each file (in the order of the torrent) when this was saved. None if it did not exist"""
+    files: list[ResumeFileState | None] = field(default_factory=list)
+    """bitfield of the files that were skipped. their parts were in the part file"""
+    skipped: bytes = field(default=b"", repr=False)
+    """state of the part file, holding the parts of skipped files in wanted pieces. None if it did not exist"""
+    part_file: ResumeFileState | None = None
+
+    @classmethod
+    def from_torrent(cls, torrent: Torrent, info_hash: bytes) -> "ResumeData":
+        partial = {}
+        for piece_id in range(torrent.nr_pieces):
+            # blocks of pieces in buffers are not on disk (see Torrent.flush_piece_buffers)
+            if (not torrent.piece_confirmed[piece_id] and torrent.piece_bytes_downloaded[piece_id] and
+                    piece_id not in torrent.piece_buffers):
+                begin = torrent.block_index(piece_id, 0)
+                partial[piece_id] = pack_bits(torrent.block_downloaded[begin: begin + torrent.blocks_per_piece])
+        return cls(
+            info_hash=info_hash,
+            piece_length=torrent.piece_length,
+            confirmed=pack_bits(torrent.piece_confirmed),
+            partial=partial,
+            files=[_get_file_state(file.path) for file in torrent.files],
+            skipped=pack_bits([not file.wanted for file in torrent.files]),
+            part_file=_get_file_state(torrent.part_file.path) if torrent.part_file is not None else None
+        )
+
+    def apply(self, torrent: Torrent, info_hash: bytes) -> list[int] | None:
+        """
+            Restore the state of the pieces that are only in files that have not changed since this was saved.
+            returns the pieces that still have to be verified, or None if this does not match the torrent
+        """
+        if (info_hash != self.info_hash or torrent.piece_length != self.piece_length or
+                len(torrent.files) != len(self.files)):
+            return None
+        to_verify = set()
+        skipped = unpack_bits(self.skipped, len(self.files))
+        part_file_changed = (torrent.part_file is not None and
+                             _get_file_state(torrent.part_file.path) != self.part_file)
+        for file, saved_state, was_skipped in zip(torrent.files, self.files, skipped):
+            is_skipped = not file.wanted
+            if is_skipped and was_skipped:
+                # never created, its parts are still in the part file
+                if part_file_changed:
+                    to_verify.update(range(file.first_piece, file.end_piece))
+                continue
+            if is_skipped != was_skipped or saved_state is None or _get_file_state(file.path) != saved_state:
+                to_verify.update(range(file.first_piece, file.end_piece))
+        confirmed = unpack_bits(self.confirmed, torrent.nr_pieces)
+        for piece_id in range(torrent.nr_pieces):
+            if piece_id in to_verify:
+                continue
+            if confirmed[piece_id]:
+                torrent.set_piece_confirmed(piece_id, True)
+                torrent.set_piece_blocks_downloaded(piece_id, True)
+            elif piece_id in self.partial:
+                nr_blocks = torrent.pieces[piece_id].nr_blocks
+                for block_id, downloaded in enumerate(unpack_bits(self.partial[piece_id], nr_blocks)):
+                    torrent.set_block_downloaded(piece_id, block_id, downloaded)
+        return sorted(to_verify)
+
+    def encode(self) -> bytes:
+        return benencode({
+            "info hash": self.info_hash,
+            "piece length": self.piece_length,
+            "confirmed": self.confirmed,
+            "partial": {str(piece_id): blocks for piece_id, blocks in self.partial.items()},
+            "files": [{"length": state.length, "mtime": state.mtime_ns} if state else {} for state in self.files],
+            "skipped": self.skipped,
+            "part file": {"length": self.part_file.length, "mtime": self.part_file.mtime_ns} if self.part_file else {}
+        })
+
+    @classmethod
+    def decode(cls, data: bytes) -> "ResumeData":
+        decoded, _ = bendecode_view(data)
+        return cls(
+            info_hash=bytes(decoded["info hash"]),
+            piece_length=decoded["piece length"],
+            confirmed=bytes(decoded["confirmed"]),
+            partial={int(piece_id): bytes(blocks) for piece_id, blocks in decoded["partial"].items()},
+            files=[ResumeFileState(length=state["length"], mtime_ns=state["mtime"]) if state else None
+                   for state in decoded["files"]],
+            skipped=bytes(decoded.get("skipped", b"")),
+            part_file=ResumeFileState(length=decoded["part file"]["length"], mtime_ns=decoded["part file"]["mtime"])
+            if decoded.get("part file") else None
+        )
+
+
+def get_resume_path(base_output_folder: str, info_hash: bytes) -> str:
+    return os.path.join(base_output_folder, RESUME_FOLDER, info_hash.hex() + ".resume")
+
+
+def load_resume_data(path: str) -> ResumeData | None:
+    try:
+        with open(path, "rb") as f:
+            return ResumeData.decode(f.read())
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError, IndexError):
+        # corrupted, everything will be verified
+        return None
+
+
+def save_resume_data(path: str, resume_data: ResumeData):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first so that a crash never leaves a truncated resume file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(resume_data.encode())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def pack_bits(values) -> bytes:
+    packed = bytearray((len(values) + 7) // 8)
+    for i, value in enumerate(values):
+        if value:
+            packed[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(packed)
+
+
+def unpack_bits(packed: bytes, length: int) -> bytearray:
+    values = bytearray(length)
+    for i in range(min(length, len(packed) * 8)):
+        values[i] = (packed[i >> 3] >> (7 - (i & 7))) & 1
+    return values
+
+
+def _get_file_state(path: str) -> ResumeFileState | None:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return ResumeFileState(length=stat.st_size, mtime_ns=stat.st_mtime_ns)
@@ -0,0 +1,170 @@
+import asyncio
+import time
+
+from guit_torrent.peer.peer import Peer
+from guit_torrent.picker import PiecePicker
+from guit_torrent.torrentdata import Torrent, TorrentBlock
+from guit_torrent.ui import console
+
+# in endgame, a block is requested from at most this many peers at once
+ENDGAME_MAX_REQUESTS = 3
+
+
+def outstanding_requests(peer: Peer) -> set[tuple[int, int]]:
+    """(piece index, begin) of the blocks requested from peer, or queued to be"""
+    keys = set(peer.requested)
+    keys.update((block.piece_id, block.begin) for block in peer.queued_blocks())
+    return keys
+
+
+class RequestScheduler:
+    """Queues blocks to request from a peer as soon as it can take more: when it unchokes us, announces pieces, or
+    gets enough room in its window (blocks arrived, requests were cancelled or timed out). Blocks released by a peer
+    (choked, disconnected) are offered to all the others.
+    Events only mark peers to refill: the refills run once per iteration of the event loop, whatever the number of
+    events, fastest peers first."""
+
+    def __init__(self, torrent: Torrent, picker: PiecePicker, get_peers_cb):
+        # get_peers_cb() returns the connected peers
+        self.torrent = torrent
+        self.picker = picker
+        self.get_peers_cb = get_peers_cb
+        self._pending: set[Peer] = set()
+        self._handle: asyncio.Handle | None = None
+        # endgame: once every block left is requested, blocks are requested from several peers at once
+        self.endgame = False
+        self.endgame_started: float | None = None
+        # stats
+        self.refills = 0
+        self.blocks_queued = 0
+
+    def peer_ready(self, peer: Peer):
+        self._pending.add(peer)
+        self._schedule()
+
+    def all_peers_ready(self):
+        self._pending.update(self.get_peers_cb())
+        self._schedule()
+
+    def blocks_released(self, peer: Peer, blocks: list[TorrentBlock]):
+        """
+            Blocks requested from peer, or queued to be, can be requested from the others
+        """
+        # in endgame, blocks may still be requested from other peers: not requestable again
+        elsewhere = set()
+        if self.endgame:
+            for other in self.get_peers_cb():
+                if other is not peer and other.alive:
+                    elsewhere |= outstanding_requests(other)
+        pieces = set()
+        for block in blocks:
+            if block.downloaded:
+                continue
+            if (block.piece_id, block.begin) in elsewhere:
+                # cleared by the peer, but still reserved by the others
+                block.last_requested = time.time()
+            else:
+                pieces.add(block.piece_id)
+        self.picker.blocks_released(pieces)
+        self.all_peers_ready()
+
+    def piece_failed(self, piece_id: int):
+        """
+            The piece was invalid: its blocks can be requested again
+        """
+        self.picker.blocks_released([piece_id])
+        self.all_peers_ready()
+
+    def _schedule(self):
+        if self._handle is None:
+            self._handle = asyncio.get_running_loop().call_soon(self._refill)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._pending.clear()
+
+    def _refill(self):
+        self._handle = None
+        pending, self._pending = self._pending, set()
+        if self.torrent.closed or self.torrent.complete:
+            return
+        for peer in sorted(pending, key=lambda peer: peer.rate, reverse=True):
+            self.fill(peer)
+
+    def fill(self, peer: Peer):
+        """
+            Queue the best blocks to request from peer, up to its window
+        """
+        if not peer.alive or not peer.available_pieces:
+            return
+        if not peer.am_not_choking.is_set():
+            # blocks queued for a peer choking us would wait for nothing
+            peer.express_interest()
+            return
+        room = peer.request_room
+        if room <= 0:
+            return
+        self.refills += 1
+        blocks = self.picker.pick_blocks(peer.available_pieces, room)
+        for block in blocks:
+            # not given to another peer until the request times out or is released
+            block.last_requested = time.time()
+            peer.blocks_to_request.put_nowait(block)
+        self.blocks_queued += len(blocks)
+        if self.endgame and len(blocks) < room:
+            self._request_endgame_blocks(peer, room - len(blocks))
+
+    def update(self):
+        """
+            Periodic checks, that scan the pieces left: blocks whose request timed out without being released, and
+            the start of the endgame
+        """
+        if self.picker.recheck_exhausted():
+            self.all_peers_ready()
+        self.check_endgame()
+
+    def check_endgame(self):
+        """
+            Start the endgame once every block left is requested
+        """
+        if self.endgame or self.torrent.complete:
+            return
+        for piece_id in self.picker.pieces_left():
+            for block in self.torrent.pieces[piece_id].blocks:
+                if not block.downloaded and block.request_timedout:
+                    return
+        self.endgame = True
+        self.endgame_started = time.monotonic()
+        console.log("Every block left is requested: endgame")
+        self.all_peers_ready()
+
+    def _request_endgame_blocks(self, peer: Peer, room: int):
+        """
+            Request blocks outstanding with other peers from peer too
+        """
+        own = outstanding_requests(peer)
+        # copies of each block requested or queued, by all the peers
+        requests = {}
+        for other in self.get_peers_cb():
+            for key in own if other is peer else outstanding_requests(other):
+                requests[key] = requests.get(key, 0) + 1
+        for piece_id in self.picker.pieces_left():
+            if piece_id not in peer.available_pieces:
+                continue
+            for block in self.torrent.pieces[piece_id].blocks:
+                key = (block.piece_id, block.begin)
+                if block.downloaded or key in own or requests.get(key, 0) >= ENDGAME_MAX_REQUESTS:
+                    continue
+                peer.blocks_to_request.put_nowait(block)
+                room -= 1
+                if not room:
+                    return
+
+    def stats(self) -> dict:
+        return {
+            "refills": self.refills,
+            "blocks_queued": self.blocks_queued,
+            "endgame": self.endgame,
+        }
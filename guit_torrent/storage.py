@@ -0,0 +1,375 @@
+import asyncio
+import os
+import queue
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from contextlib import contextmanager
+
+DISK_IO_THREADS = 4
+# file descriptors kept open by a FilePool
+MAX_OPEN_FILES = 512
+# maximum number of queued operations a thread picks up at once, so that adjacent writes can be merged
+MAX_BATCH = 64
+
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
+_READ, _WRITE, _SYNC = range(3)
+
+"""how output files are allocated before downloading:
+    - none: files grow as data is written
+    - sparse: files are extended to their full length (ftruncate), without allocating blocks
+    - full: all blocks are allocated (posix_fallocate), which avoids fragmentation and running out of space later"""
+PREALLOCATE_MODES = ("none", "sparse", "full")
+
+
+class StorageError(Exception):
+    pass
+
+
+def check_free_space(folder: str, needed: int):
+    """
+        Raise a StorageError if the filesystem of folder has less than `needed` bytes available
+    """
+    # the folder itself may not be created yet. absolute, so that walking up a relative path ends at the root
+    folder = os.path.abspath(folder)
+    while not os.path.exists(folder) and os.path.dirname(folder) != folder:
+        folder = os.path.dirname(folder)
+    free = shutil.disk_usage(folder).free
+    if needed > free:
+        raise StorageError(f"not enough free space in \"{folder}\": {needed} bytes needed, {free} available")
+
+
+def allocated_bytes(path: str) -> int:
+    try:
+        return os.stat(path).st_blocks * 512
+    except FileNotFoundError:
+        return 0
+
+
+def preallocate(fd: int, length: int, mode: str):
+    if mode == "none" or not length:
+        return
+    if mode == "full" and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, length)
+            return
+        except OSError as e:
+            raise StorageError(f"could not preallocate {length} bytes: {e}") from e
+    # sparse, or full where posix_fallocate is not available
+    if os.fstat(fd).st_size < length:
+        os.ftruncate(fd, length)
+
+
+class FilePool:
+    """Opens files on first use and keeps at most max_open of them open, closing the least recently used ones.
+    Files (and their folders) are only created when opened for writing. Thread safe: a file in use (see open) is
+    never closed by another thread, even if that means going over max_open for a while."""
+
+    def __init__(self, max_open: int = MAX_OPEN_FILES):
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        # path -> [fd, number of users], least recently used first
+        self._files: OrderedDict[str, list[int]] = OrderedDict()
+        # path -> called when the file is closed, to release what was made from it (memory mappings)
+        self._close_callbacks: dict[str, Callable[[], None]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @contextmanager
+    def open(self, path: str, create: bool = True):
+        """
+            Use the file descriptor of path, opening it if needed
+            yields None if the file does not exist and create is False
+        """
+        fd = self._acquire(path, create)
+        try:
+            yield fd
+        finally:
+            if fd is not None:
+                self._release(path)
+
+    def _acquire(self, path: str, create: bool) -> int | None:
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is not None:
+                self.hits += 1
+                self._files.move_to_end(path)
+                entry[1] += 1
+                return entry[0]
+            self.misses += 1
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT if create else os.O_RDWR)
+            except FileNotFoundError:
+                if not create:
+                    return None
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd = os.open(path, os.O_RDWR | os.O_CREAT)
+            self._files[path] = [fd, 1]
+            self._evict()
+            return fd
+
+    def on_close(self, path: str, callback: Callable[[], None]):
+        """
+            Call callback when path, which must be in use, is closed (evicted or closed)
+        """
+        with self._lock:
+            self._close_callbacks[path] = callback
+
+    def _close(self, path: str, fd: int):
+        os.close(fd)
+        callback = self._close_callbacks.pop(path, None)
+        if callback is not None:
+            callback()
+
+    def _release(self, path: str):
+        with self._lock:
+            self._files[path][1] -= 1
+            self._evict()
+
+    def _evict(self):
+        if len(self._files) <= self.max_open:
+            return
+        for path, (fd, users) in list(self._files.items()):
+            if users == 0:
+                del self._files[path]
+                self._close(path, fd)
+                self.evictions += 1
+                if len(self._files) <= self.max_open:
+                    return
+
+    def close(self, path: str = None):
+        """close path if it is open and unused, or all unused files"""
+        with self._lock:
+            for file_path in [path] if path is not None else list(self._files):
+                entry = self._files.get(file_path)
+                if entry is not None and entry[1] == 0:
+                    del self._files[file_path]
+                    self._close(file_path, entry[0])
+
+    def stats(self) -> dict:
+        return {
+            "open": len(self._files),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class _DiskOperation:
+    __slots__ = ("kind", "path", "offset", "data", "future", "loop", "submitted_at")
+
+    def __init__(self, kind, path, offset, data, future, loop):
+        self.kind = kind
+        self.path = path
+        self.offset = offset
+        self.data = data
+        self.future = future
+        self.loop = loop
+        self.submitted_at = time.monotonic()
+
+
+class DiskIO:
+    """Runs blocking file operations (pread, pwritev, fsync) on dedicated threads, so that disk stalls never block
+    the event loop. Files are designated by their path and opened by the threads through a FilePool.
+    All operations on a file go to the same thread (its lane): they run in submission order, and writes queued back
+    to back at adjacent offsets are merged into a single pwritev."""
+
+    def __init__(self, threads: int = DISK_IO_THREADS, files: FilePool = None):
+        self.nr_threads = threads
+        self.files = files if files is not None else FilePool()
+        self._lanes: list[queue.SimpleQueue] = []
+        self._threads: list[threading.Thread] = []
+        # metrics, only updated on the event loop thread
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.completed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.writes = 0
+        # updated by the lanes
+        self.write_syscalls = 0
+
+    def _start(self):
+        for i in range(self.nr_threads):
+            lane = queue.SimpleQueue()
+            thread = threading.Thread(target=self._run_lane, args=(lane,), name=f"disk-io-{i}", daemon=True)
+            thread.start()
+            self._lanes.append(lane)
+            self._threads.append(thread)
+
+    def _submit(self, kind, path, offset=0, data=None) -> asyncio.Future:
+        if not self._lanes:
+            self._start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        self._lanes[hash(path) % self.nr_threads].put(_DiskOperation(kind, path, offset, data, future, loop))
+        return future
+
+    def read(self, path: str, offset: int, length: int) -> asyncio.Future:
+        """the result is empty if the file does not exist, it is not created"""
+        return self._submit(_READ, path, offset, length)
+
+    def write(self, path: str, offset: int, data: bytes) -> asyncio.Future:
+        """data must not be modified until the future is done"""
+        return self.writev(path, offset, [data])
+
+    def writev(self, path: str, offset: int, buffers: list) -> asyncio.Future:
+        """write buffers one after the other, starting at offset. they must not be modified until the future is done"""
+        self.writes += 1
+        return self._submit(_WRITE, path, offset, buffers)
+
+    def sync(self, path: str) -> asyncio.Future:
+        """fsync, once the writes submitted before it for the same file are done"""
+        return self._submit(_SYNC, path)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "completed": self.completed,
+            "avg_latency": self.total_latency / self.completed if self.completed else 0,
+            "max_latency": self.max_latency,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "writes": self.writes,
+            "write_syscalls": self.write_syscalls,
+        }
+
+    def close(self):
+        for lane in self._lanes:
+            lane.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._lanes.clear()
+        self._threads.clear()
+
+    def _run_lane(self, lane: queue.SimpleQueue):
+        while True:
+            operation = lane.get()
+            if operation is None:
+                return
+            batch = [operation]
+            while len(batch) < MAX_BATCH:
+                try:
+                    operation = lane.get_nowait()
+                except queue.Empty:
+                    break
+                if operation is None:
+                    # stop after this batch
+                    lane.put(None)
+                    break
+                batch.append(operation)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch: list[_DiskOperation]):
+        i = 0
+        while i < len(batch):
+            operation = batch[i]
+            if operation.kind != _WRITE:
+                self._run_single(operation)
+                i += 1
+                continue
+            # merge following writes to the same file that start where the previous one ended
+            end = i + 1
+            next_offset = operation.offset + _total_length(operation.data)
+            while (end < len(batch) and batch[end].kind == _WRITE and batch[end].path == operation.path and
+                   batch[end].offset == next_offset):
+                next_offset += _total_length(batch[end].data)
+                end += 1
+            writes = batch[i: end]
+            try:
+                with self.files.open(operation.path) as fd:
+                    _pwritev_all(fd, [buffer for write in writes for buffer in write.data], operation.offset)
+                self.write_syscalls += 1
+                for write in writes:
+                    self._complete(write, None, None)
+            except Exception as e:
+                # not only OSError (e.g. ValueError on a negative offset): the lane thread must keep running
+                for write in writes:
+                    self._complete(write, None, e)
+            i = end
+
+    def _run_single(self, operation: _DiskOperation):
+        try:
+            # missing files are not created to be read or synced
+            with self.files.open(operation.path, create=False) as fd:
+                if fd is None:
+                    result = b"" if operation.kind == _READ else None
+                elif operation.kind == _READ:
+                    result = _pread_all(fd, operation.data, operation.offset)
+                else:
+                    result = os.fsync(fd)
+        except Exception as e:
+            self._complete(operation, None, e)
+        else:
+            self._complete(operation, result, None)
+
+    def _complete(self, operation: _DiskOperation, result, exception):
+        try:
+            operation.loop.call_soon_threadsafe(self._set_result, operation, result, exception)
+        except RuntimeError:
+            # event loop closed
+            pass
+
+    def _set_result(self, operation: _DiskOperation, result, exception):
+        latency = time.monotonic() - operation.submitted_at
+        self.queue_depth -= 1
+        self.completed += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if operation.kind == _READ and result is not None:
+            self.bytes_read += len(result)
+        elif operation.kind == _WRITE and exception is None:
+            self.bytes_written += _total_length(operation.data)
+        if operation.future.done():
+            return
+        if exception is not None:
+            operation.future.set_exception(exception)
+        else:
+            operation.future.set_result(result)
+
+
+def _total_length(buffers: list) -> int:
+    return sum(len(buffer) for buffer in buffers)
+
+
+def _pread_all(fd: int, length: int, offset: int) -> bytes:
+    data = os.pread(fd, length, offset)
+    if len(data) == length or not data:
+        return data
+    # short read (not at the end of the file)
+    chunks = [data]
+    read = len(data)
+    while read < length:
+        chunk = os.pread(fd, length - read, offset + read)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        read += len(chunk)
+    return b"".join(chunks)
+
+
+def _pwritev_all(fd: int, buffers: list, offset: int):
+    written = 0
+    total = _total_length(buffers)
+    # at most IOV_MAX buffers per call
+    for i in range(0, len(buffers), IOV_MAX):
+        chunk = buffers[i: i + IOV_MAX]
+        chunk_written = os.pwritev(fd, chunk, offset + written)
+        written += chunk_written
+        if chunk_written != _total_length(chunk):
+            break
+    if written == total:
+        return
+    # short write: finish the rest
+    data = memoryview(b"".join(buffers))
+    while written < total:
+        written += os.pwrite(fd, data[written:], offset + written)
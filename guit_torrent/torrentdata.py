@@ -1,118 +1,273 @@
 import asyncio
+import mmap
 import os
 import time
+from array import array
+from bisect import bisect_right
+from collections import deque
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from fnmatch import fnmatch
 from hashlib import sha1
 from math import ceil
 
 from tqdm import tqdm
 
+from guit_torrent.cache import WriteBackCache, PieceReadCache, WRITE_CACHE_SIZE, READ_CACHE_SIZE, split_buffers
+from guit_torrent.storage import DiskIO, FilePool, MAX_OPEN_FILES, check_free_space, preallocate, allocated_bytes
 from guit_torrent.ui import get_progress_task_for_file
 
 REQUEST_TIMEOUT = 2 * 60
 BLOCK_SIZE = 2 ** 14
-
-
-def get_torrentdata_from_metainfo(torrent_metadata, output_folder):
-    # for file in self.torrent_metadata.info.get_files():
-    # length/size calculations
-    nr_pieces = ceil(torrent_metadata.info.total_length / torrent_metadata.info.piece_length)
-    last_piece_length = torrent_metadata.info.total_length % torrent_metadata.info.piece_length
-
-    # init all pieces
-    pieces = []
-    for piece_id in range(nr_pieces):
-        piece_length = torrent_metadata.info.piece_length if piece_id != nr_pieces - 1 else last_piece_length
-        last_block_length = piece_length % BLOCK_SIZE
-        # add piece
-        pieces.append(
-            TorrentPiece(
-                piece_id=piece_id,
-                begin=torrent_metadata.info.piece_length * piece_id,
-                length=piece_length,
-                sha1_hash=torrent_metadata.info.pieces[piece_id * 20: (piece_id + 1) * 20],
-                blocks=[
-                    TorrentBlock(
-                        piece_id=piece_id,
-                        block_id=block_id,
-                        begin=begin,
-                        length=BLOCK_SIZE if begin + BLOCK_SIZE <= piece_length else last_block_length,
-                        absolute_begin=torrent_metadata.info.piece_length * piece_id + begin
-                    )
-                    for block_id, begin in enumerate(range(0, piece_length, BLOCK_SIZE))
-                ]
-            )
-        )
-
+# largest block we upload. most clients reject requests of more than 16 KiB, we tolerate up to 128 KiB
+MAX_REQUEST_LENGTH = 2 ** 17
+# threads hashing existing data. hashlib releases the GIL on large buffers
+VERIFY_WORKERS = os.cpu_count() or 4
+# pieces read ahead by each verify worker
+VERIFY_READ_AHEAD = 4
+
+# file priorities. pieces that are only in skipped files are never downloaded
+PRIORITY_SKIP = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+# stores the parts of skipped files that are in the same pieces as wanted files, so that skipped files are never
+# created
+PART_FILE_NAME = ".parts"
+
+
+def get_torrentdata_from_metainfo(torrent_metadata, output_folder, storage: str = "pread",
+                                  write_cache_size: int = WRITE_CACHE_SIZE, preallocate_mode: str = "none",
+                                  max_open_files: int = MAX_OPEN_FILES, file_priorities: list[int] = None):
+    """
+        storage: "pread" to access files through positional reads/writes on the disk I/O threads, "mmap" to map them
+        in memory
+        write_cache_size: bytes of verified pieces kept in memory to be written in large sequential writes. 0 to write
+        each piece as soon as it is verified. Not used with mmap
+        preallocate_mode: one of PREALLOCATE_MODES. Raises a StorageError if the files do not fit on the disk
+        max_open_files: file descriptors kept open. Files are opened, and created, when they are first written
+        file_priorities: priority of each file (PRIORITY_*), defaults to PRIORITY_NORMAL for all
+    """
+    file_class = STORAGE_BACKENDS[storage]
     # init files
     files = []
     file_begin = 0
-    run_pre_check = False
     for file in torrent_metadata.info.get_files():
-        file_path = os.path.join(output_folder, file.name)
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        file = TorrentFile(
+        file = file_class(
             name=file.name,
             length=file.length,
             begin=file_begin,
-            fd=os.open(file_path, os.O_RDWR | os.O_CREAT)
+            path=os.path.join(output_folder, file.name)
         )
         file.progress_task = get_progress_task_for_file(file)
         files.append(file)
         file_begin += file.length
 
-    return Torrent(
+    torrent = Torrent(
         name=torrent_metadata.info.name,
         length=torrent_metadata.info.total_length,
         piece_length=torrent_metadata.info.piece_length,
-        pieces=pieces,
-        files=files
+        piece_hashes=torrent_metadata.info.pieces,
+        files=files,
+        write_cache_size=write_cache_size if file_class is TorrentFile else 0,
+        max_open_files=max_open_files,
+        part_file_path=os.path.join(output_folder, PART_FILE_NAME)
     )
+    if file_priorities is not None:
+        torrent.set_file_priorities(file_priorities)
+    wanted_files = [file for file in files if file.wanted]
+    try:
+        check_free_space(output_folder, sum(max(file.length - allocated_bytes(file.path), 0) for file in wanted_files))
+        if preallocate_mode != "none":
+            for file in wanted_files:
+                file.preallocate(preallocate_mode)
+    except BaseException:
+        torrent.close()
+        raise
+    return torrent
+
+
+def match_file_priorities(file_names: list[str], patterns: list[tuple[str, int]]) -> list[int]:
+    """
+        patterns: (glob pattern, priority) applied in order: the last one matching a file name sets its priority
+        returns the priority of each file, PRIORITY_NORMAL if no pattern matches it
+    """
+    priorities = []
+    for name in file_names:
+        priority = PRIORITY_NORMAL
+        for pattern, pattern_priority in patterns:
+            if fnmatch(name, pattern):
+                priority = pattern_priority
+        priorities.append(priority)
+    return priorities
 
 
-@dataclass
 class TorrentBlock:
-    piece_id: int
-    block_id: int
-    begin: int
-    length: int
-    absolute_begin: int
-    downloaded: bool = False
-    last_requested: int = None
-    data: bytes = None
+    """View over the state of a block, which is stored in its Torrent"""
+    __slots__ = ("torrent", "piece_id", "block_id")
+
+    def __init__(self, torrent: "Torrent", piece_id: int, block_id: int):
+        self.torrent = torrent
+        self.piece_id = piece_id
+        self.block_id = block_id
+
+    @property
+    def index(self) -> int:
+        return self.torrent.block_index(self.piece_id, self.block_id)
+
+    @property
+    def begin(self) -> int:
+        return self.block_id * BLOCK_SIZE
+
+    @property
+    def length(self) -> int:
+        return self.torrent.block_length(self.piece_id, self.block_id)
+
+    @property
+    def absolute_begin(self) -> int:
+        return self.piece_id * self.torrent.piece_length + self.begin
+
+    @property
+    def downloaded(self) -> bool:
+        return self.torrent.block_downloaded[self.index] != 0
+
+    @downloaded.setter
+    def downloaded(self, downloaded: bool):
+        self.torrent.set_block_downloaded(self.piece_id, self.block_id, downloaded)
+
+    @property
+    def last_requested(self) -> float | None:
+        return self.torrent.get_block_last_requested(self.index)
+
+    @last_requested.setter
+    def last_requested(self, last_requested: float | None):
+        self.torrent.set_block_last_requested(self.index, last_requested)
 
     @property
     def request_timedout(self):
-        return not self.last_requested or time.time() - self.last_requested > REQUEST_TIMEOUT
+        last_requested = self.last_requested
+        return not last_requested or time.time() - last_requested > REQUEST_TIMEOUT
+
+    def __eq__(self, other):
+        return (isinstance(other, TorrentBlock) and self.torrent is other.torrent and
+                self.piece_id == other.piece_id and self.block_id == other.block_id)
+
+    def __hash__(self):
+        return hash((self.piece_id, self.block_id))
+
+    def __repr__(self):
+        return f"TorrentBlock(piece_id={self.piece_id}, begin={self.begin}, length={self.length})"
 
 
-@dataclass
 class TorrentPiece:
-    piece_id: int
-    begin: int
-    length: int
-    sha1_hash: bytes
-    bytes_downloaded: int = 0
+    """View over the state of a piece, which is stored in its Torrent"""
+    __slots__ = ("torrent", "piece_id")
 
-    confirmed: bool = False
+    def __init__(self, torrent: "Torrent", piece_id: int):
+        self.torrent = torrent
+        self.piece_id = piece_id
 
-    blocks: list[TorrentBlock] = field(default_factory=list)
+    @property
+    def begin(self) -> int:
+        return self.piece_id * self.torrent.piece_length
 
     @property
-    def downloaded(self):
-        return all([block.downloaded for block in self.blocks])
+    def length(self) -> int:
+        return self.torrent.get_piece_length(self.piece_id)
 
     @property
     def end(self):
         return self.begin + self.length
 
+    @property
+    def sha1_hash(self) -> memoryview:
+        return self.torrent.piece_hash(self.piece_id)
+
+    @property
+    def confirmed(self) -> bool:
+        return self.torrent.piece_confirmed[self.piece_id] != 0
+
+    @confirmed.setter
+    def confirmed(self, confirmed: bool):
+        self.torrent.set_piece_confirmed(self.piece_id, confirmed)
+
+    @property
+    def bytes_downloaded(self) -> int:
+        return self.torrent.piece_bytes_downloaded[self.piece_id]
+
+    @property
+    def downloaded(self):
+        return self.bytes_downloaded == self.length
+
+    @property
+    def nr_blocks(self) -> int:
+        return ceil(self.length / BLOCK_SIZE)
+
+    @property
+    def blocks(self) -> list[TorrentBlock]:
+        return [TorrentBlock(self.torrent, self.piece_id, block_id) for block_id in range(self.nr_blocks)]
+
     def verify(self, data):
         return sha1(data).digest() == self.sha1_hash
 
-    def get_block(self, block_begin):
-        blocks = [block for block in self.blocks if block.begin == block_begin]
-        if blocks:
-            return blocks[0]
+    def get_block(self, block_begin) -> TorrentBlock | None:
+        if block_begin % BLOCK_SIZE == 0 and 0 <= block_begin < self.length:
+            return TorrentBlock(self.torrent, self.piece_id, block_begin // BLOCK_SIZE)
+
+    def __eq__(self, other):
+        return isinstance(other, TorrentPiece) and self.torrent is other.torrent and self.piece_id == other.piece_id
+
+    def __hash__(self):
+        return hash(self.piece_id)
+
+    def __repr__(self):
+        return f"TorrentPiece(piece_id={self.piece_id}, begin={self.begin}, length={self.length})"
+
+
+class PieceBuffer:
+    """Piece being downloaded: its blocks are assembled in memory and hashed as soon as they are contiguous"""
+    __slots__ = ("piece_id", "data", "hasher", "hashed")
+
+    def __init__(self, piece_id: int, length: int):
+        self.piece_id = piece_id
+        self.data = bytearray(length)
+        self.hasher = sha1()
+        # the first `hashed` bytes of data were fed to hasher
+        self.hashed = 0
+
+    def write(self, begin: int, data: bytes):
+        self.data[begin: begin + len(data)] = data
+
+    def update_hash(self, torrent: "Torrent"):
+        view = memoryview(self.data)
+        while (self.hashed < len(self.data) and
+               torrent.block_downloaded[torrent.block_index(self.piece_id, self.hashed // BLOCK_SIZE)]):
+            end = min(self.hashed + BLOCK_SIZE, len(self.data))
+            self.hasher.update(view[self.hashed: end])
+            self.hashed = end
+
+    @property
+    def complete(self) -> bool:
+        return self.hashed == len(self.data)
+
+
+class TorrentPieces(Sequence):
+    """Sequence of TorrentPiece views, created on access"""
+
+    def __init__(self, torrent: "Torrent"):
+        self.torrent = torrent
+
+    def __len__(self):
+        return self.torrent.nr_pieces
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("piece index out of range")
+        return TorrentPiece(self.torrent, index)
 
 
 @dataclass
@@ -123,48 +278,135 @@ class TorrentFile:
 
     downloaded: bool = False
 
-    fd: int = None
-    file_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    # pieces overlapping the file are [first_piece, end_piece[. set by the Torrent
+    first_piece: int = 0
+    end_piece: int = 0
+
+    path: str = None
+    priority: int = PRIORITY_NORMAL
+    """bytes of the file in confirmed pieces. updated by the Torrent"""
+    confirmed_bytes: int = 0
+    # set by the Torrent
+    disk_io: DiskIO = field(default=None, repr=False)
+    file_pool: FilePool = field(default=None, repr=False)
 
     progress_task: int = None
 
-    async def read_section(self, begin, length):
-        async with self.file_lock:
-            os.fsync(self.fd)
-            os.lseek(self.fd, begin, os.SEEK_SET)
-            return os.read(self.fd, length)
+    @property
+    def wanted(self) -> bool:
+        return self.priority != PRIORITY_SKIP
+
+    def read_section(self, begin, length) -> asyncio.Future:
+        return self.disk_io.read(self.path, begin, length)
+
+    def write_section(self, begin, data) -> asyncio.Future:
+        return self.disk_io.write(self.path, begin, data)
+
+    def write_sections(self, begin, buffers: list) -> asyncio.Future:
+        # consecutive buffers, in a single write
+        return self.disk_io.writev(self.path, begin, buffers)
 
-    async def write_section(self, begin, data):
-        async with self.file_lock:
-            os.lseek(self.fd, begin, os.SEEK_SET)
-            os.write(self.fd, data)
+    def read_section_blocking(self, begin, length) -> bytes | memoryview:
+        # for worker threads
+        with self.file_pool.open(self.path, create=False) as fd:
+            return os.pread(fd, length, begin) if fd is not None else b""
+
+    def preallocate(self, mode: str):
+        with self.file_pool.open(self.path) as fd:
+            preallocate(fd, self.length, mode)
+
+    def create(self):
+        # files are only created when written: empty ones never are
+        with self.file_pool.open(self.path):
+            pass
 
     def get_pieces(self, pieces):
-        return [
-            piece for piece in pieces
-            if self.includes_piece(piece)
-        ]
-
-    def downloaded_bytes(self, pieces):
-        total = 0
-        for piece in pieces:
-            if piece.confirmed:
-                intersect = get_intersections(piece.begin, piece.end, self.begin, self.begin + self.length)
-                if intersect is not None:
-                    total += intersect[0][1] - intersect[0][0]
-        return total
+        return [pieces[piece_id] for piece_id in range(self.first_piece, self.end_piece)]
 
     def includes_piece(self, piece: TorrentPiece) -> bool:
-        return get_intersections(self.begin, self.begin + self.length, piece.begin, piece.end) is not None
+        return self.first_piece <= piece.piece_id < self.end_piece
 
     def includes_block(self, block: TorrentBlock) -> bool:
         return get_intersections(self.begin, self.begin + self.length,
                                  block.absolute_begin, block.absolute_begin + block.length) is not None
 
+    async def sync(self):
+        await self.disk_io.sync(self.path)
+
+    def close(self):
+        self.file_pool.close(self.path)
+
+
+@dataclass
+class MappedTorrentFile(TorrentFile):
+    """TorrentFile mapped in memory: blocks are copied straight into the mapping, and sections are read as views of it
+    instead of new bytes objects. The file is mapped on first use, and extended (sparse) to its full length to be
+    mapped. It is unmapped when the file pool closes it, so that max_open_files also bounds the mappings"""
+    mm: mmap.mmap = field(default=None, repr=False)
+
+    def _map(self, create: bool) -> mmap.mmap | None:
+        if self.mm is None and self.length:
+            with self.file_pool.open(self.path, create) as fd:
+                if fd is None:
+                    return None
+                if os.fstat(fd).st_size < self.length:
+                    os.ftruncate(fd, self.length)
+                # the mapping stays valid without the file descriptor, until the pool evicts the file
+                self.mm = mmap.mmap(fd, self.length)
+                self.file_pool.on_close(self.path, self._unmap)
+        return self.mm
+
+    def _view(self, begin, length) -> memoryview:
+        mm = self._map(create=False)
+        if mm is None:
+            return memoryview(b"")
+        return memoryview(mm)[begin: begin + length]
+
+    def read_section(self, begin, length) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(self._view(begin, length))
+        return future
+
+    def write_section(self, begin, data) -> asyncio.Future:
+        self._map(create=True)[begin: begin + len(data)] = data
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+    def write_sections(self, begin, buffers: list) -> asyncio.Future:
+        mm = self._map(create=True)
+        for buffer in buffers:
+            mm[begin: begin + len(buffer)] = buffer
+            begin += len(buffer)
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+    def read_section_blocking(self, begin, length) -> memoryview:
+        return self._view(begin, length)
+
+    async def sync(self):
+        if self.mm is not None:
+            await asyncio.to_thread(self.mm.flush)
+
     def close(self):
-        if self.fd:
-            os.close(self.fd)
-            self.fd = None
+        self._unmap()
+        self.file_pool.close(self.path)
+
+    def _unmap(self):
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                # views of it are still referenced somewhere, it will be unmapped once they are released
+                pass
+            self.mm = None
+
+
+STORAGE_BACKENDS = {
+    "pread": TorrentFile,
+    "mmap": MappedTorrentFile,
+}
 
 
 @dataclass
@@ -172,93 +414,393 @@ class Torrent:
     name: str
     length: int
     piece_length: int
+    """concatenation of the 20-byte SHA1 hashes of all pieces"""
+    piece_hashes: bytes | memoryview = field(repr=False)
 
-    pieces: list[TorrentPiece] = field(default_factory=list)
     files: list[TorrentFile] = field(default_factory=list)
 
     downloaded: bool = False
-
-    def get_piece_files(self, piece_id) -> list[tuple[TorrentFile, int, int]]:
-        files = []
-        piece = self.pieces[piece_id]
+    """bytes of the write-back cache, 0 to disable it"""
+    write_cache_size: int = WRITE_CACHE_SIZE
+    """file descriptors kept open"""
+    max_open_files: int = MAX_OPEN_FILES
+    """where the parts of skipped files that share pieces with wanted files are stored. If None, they are written to
+    the skipped files"""
+    part_file_path: str = None
+    """bytes of the pieces kept in memory to upload them"""
+    read_cache_size: int = READ_CACHE_SIZE
+    closed: bool = field(default=False, init=False)
+    """bytes per second hashed by the last check_existing_data"""
+    verify_rate: float = field(default=0, init=False)
+
+    """state of pieces and blocks. blocks are indexed by piece_id * blocks_per_piece + block_id"""
+    nr_pieces: int = field(init=False)
+    blocks_per_piece: int = field(init=False)
+    block_downloaded: bytearray = field(init=False, repr=False)
+    """seconds between _requests_epoch and the last request of each block, 0 if never requested"""
+    block_last_requested: array = field(init=False, repr=False)
+    piece_confirmed: bytearray = field(init=False, repr=False)
+    piece_bytes_downloaded: array = field(init=False, repr=False)
+    """highest priority of the files of each piece. PRIORITY_SKIP if the piece is not wanted"""
+    piece_priority: bytearray = field(init=False, repr=False)
+    pieces: TorrentPieces = field(init=False, repr=False)
+    """opens the files when they are used"""
+    file_pool: FilePool = field(init=False, repr=False)
+    """runs the disk operations of all files off the event loop"""
+    disk_io: DiskIO = field(init=False, repr=False)
+    """pieces being downloaded. their downloaded blocks are only in memory"""
+    piece_buffers: dict[int, PieceBuffer] = field(default_factory=dict, init=False, repr=False)
+    """data written but not on disk yet. None if disabled"""
+    write_cache: WriteBackCache | None = field(default=None, init=False, repr=False)
+    """addressed by position in the "continuous stream" of data. None if there is no part_file_path"""
+    part_file: TorrentFile | None = field(default=None, init=False, repr=False)
+    """pieces read to be uploaded"""
+    read_cache: PieceReadCache = field(init=False, repr=False)
+
+    """counters, updated when blocks are marked downloaded and pieces confirmed or invalidated"""
+    downloaded_bytes: int = field(default=0, init=False)
+    confirmed_downloaded_bytes: int = field(default=0, init=False)
+    """same as above, only for the wanted pieces (see piece_priority)"""
+    wanted_downloaded_bytes: int = field(default=0, init=False)
+    wanted_confirmed_bytes: int = field(default=0, init=False)
+    wanted_pieces_confirmed: int = field(default=0, init=False)
+    wanted_pieces: int = field(default=0, init=False)
+    wanted_length: int = field(default=0, init=False)
+    """id(file) -> file, for the files whose confirmed_bytes or priority changed (see pop_changed_files)"""
+    _changed_files: dict[int, TorrentFile] = field(default_factory=dict, init=False, repr=False)
+
+    def __post_init__(self):
+        self.nr_pieces = ceil(self.length / self.piece_length)
+        self.blocks_per_piece = ceil(self.piece_length / BLOCK_SIZE)
+        nr_blocks = self.nr_pieces * self.blocks_per_piece
+        self.block_downloaded = bytearray(nr_blocks)
+        self.block_last_requested = array("f", bytes(4 * nr_blocks))
+        self._requests_epoch = time.time() - 1
+        self.piece_confirmed = bytearray(self.nr_pieces)
+        self.piece_bytes_downloaded = array("q", bytes(8 * self.nr_pieces))
+        self.piece_priority = bytearray([PRIORITY_NORMAL]) * self.nr_pieces
+        self.pieces = TorrentPieces(self)
+        # sorted file offsets, to find the files of a range by bisection
+        self._file_begins = array("q", [file.begin for file in self.files])
+        self.file_pool = FilePool(self.max_open_files)
+        # path -> file, written since the last sync
+        self._unsynced_files: dict[str, TorrentFile] = {}
+        self.disk_io = DiskIO(files=self.file_pool)
+        for file in self.files:
+            file.disk_io = self.disk_io
+            file.file_pool = self.file_pool
+            file.first_piece = file.begin // self.piece_length
+            file.end_piece = ceil((file.begin + file.length) / self.piece_length) if file.length else file.first_piece
+        if self.part_file_path is not None:
+            self.part_file = TorrentFile(name=PART_FILE_NAME, length=self.length, begin=0, path=self.part_file_path,
+                                         disk_io=self.disk_io, file_pool=self.file_pool)
+        if self.write_cache_size:
+            self.write_cache = WriteBackCache(self._write_range, max_size=self.write_cache_size)
+        self.read_cache = PieceReadCache(self.read_piece, max_size=self.read_cache_size)
+        self._count_wanted()
+
+    def get_piece_length(self, piece_id) -> int:
+        return min(self.piece_length, self.length - piece_id * self.piece_length)
+
+    def piece_hash(self, piece_id) -> memoryview:
+        return memoryview(self.piece_hashes)[piece_id * 20: (piece_id + 1) * 20]
+
+    def block_index(self, piece_id, block_id) -> int:
+        return piece_id * self.blocks_per_piece + block_id
+
+    def block_length(self, piece_id, block_id) -> int:
+        return min(BLOCK_SIZE, self.get_piece_length(piece_id) - block_id * BLOCK_SIZE)
+
+    def set_block_downloaded(self, piece_id, block_id, downloaded: bool):
+        index = self.block_index(piece_id, block_id)
+        if self.block_downloaded[index] != downloaded:
+            self.block_downloaded[index] = downloaded
+            length = self.block_length(piece_id, block_id)
+            if not downloaded:
+                length = -length
+            self.piece_bytes_downloaded[piece_id] += length
+            self.downloaded_bytes += length
+            if self.piece_priority[piece_id] != PRIORITY_SKIP:
+                self.wanted_downloaded_bytes += length
+
+    def set_piece_blocks_downloaded(self, piece_id, downloaded: bool):
+        for block_id in range(ceil(self.get_piece_length(piece_id) / BLOCK_SIZE)):
+            self.set_block_downloaded(piece_id, block_id, downloaded)
+
+    def set_piece_confirmed(self, piece_id, confirmed: bool):
+        if bool(self.piece_confirmed[piece_id]) == bool(confirmed):
+            return
+        self.piece_confirmed[piece_id] = confirmed
+        if not confirmed:
+            self.read_cache.invalidate(piece_id)
+        sign = 1 if confirmed else -1
+        piece_begin, piece_length = piece_id * self.piece_length, self.get_piece_length(piece_id)
+        self.confirmed_downloaded_bytes += sign * piece_length
+        if self.piece_priority[piece_id] != PRIORITY_SKIP:
+            self.wanted_confirmed_bytes += sign * piece_length
+            self.wanted_pieces_confirmed += sign
+        for file, _, length in self.get_files_in_range(piece_begin, piece_begin + piece_length):
+            file.confirmed_bytes += sign * length
+            self._changed_files[id(file)] = file
+
+    def set_file_priorities(self, priorities: list[int]):
+        for file, priority in zip(self.files, priorities):
+            file.priority = priority
+        self.piece_priority = bytearray(self.nr_pieces)
         for file in self.files:
-            # check intersection
-            intersects = get_intersections(piece.begin, piece.end, file.begin, file.begin + file.length)
-            if intersects is not None:
-                start, end = intersects[2]  # relative to the file itself
-                files.append((file, start, end - start))
+            for piece_id in range(file.first_piece, file.end_piece):
+                self.piece_priority[piece_id] = max(self.piece_priority[piece_id], file.priority)
+        self._count_wanted()
+
+    def _count_wanted(self):
+        # only when priorities change: O(pieces)
+        self.wanted_pieces = self.wanted_length = self.wanted_pieces_confirmed = 0
+        self.wanted_confirmed_bytes = self.wanted_downloaded_bytes = 0
+        for piece_id in range(self.nr_pieces):
+            if self.piece_priority[piece_id] == PRIORITY_SKIP:
+                continue
+            piece_length = self.get_piece_length(piece_id)
+            self.wanted_pieces += 1
+            self.wanted_length += piece_length
+            self.wanted_downloaded_bytes += self.piece_bytes_downloaded[piece_id]
+            if self.piece_confirmed[piece_id]:
+                self.wanted_pieces_confirmed += 1
+                self.wanted_confirmed_bytes += piece_length
+        self._changed_files.update((id(file), file) for file in self.files)
+
+    def piece_wanted(self, piece_id) -> bool:
+        return self.piece_priority[piece_id] != PRIORITY_SKIP
+
+    @property
+    def left_bytes(self) -> int:
+        # as sent to trackers
+        return self.wanted_length - self.wanted_confirmed_bytes
+
+    @property
+    def complete(self) -> bool:
+        """all wanted pieces are confirmed"""
+        return self.wanted_pieces_confirmed == self.wanted_pieces
+
+    def pop_changed_files(self) -> list[TorrentFile]:
+        """files whose confirmed_bytes or priority changed since the last call"""
+        files = list(self._changed_files.values())
+        self._changed_files.clear()
         return files
 
-    def get_block_files(self, block: TorrentBlock) -> list[tuple[TorrentFile, int, int]]:
+    def get_block_last_requested(self, index) -> float | None:
+        last_requested = self.block_last_requested[index]
+        return self._requests_epoch + last_requested if last_requested else None
+
+    def set_block_last_requested(self, index, last_requested: float | None):
+        self.block_last_requested[index] = last_requested - self._requests_epoch if last_requested else 0
+
+    def get_files_in_range(self, begin, end) -> list[tuple[TorrentFile, int, int]]:
+        """
+            Files overlapping [begin, end[ of the "continuous stream" of data, in O(log(files) + overlapping files)
+            returns (file, start relative to the file itself, length) for each of them, in order
+        """
         files = []
-        for file in self.files:
-            # check intersection
-            intersects = get_intersections(block.absolute_begin, block.absolute_begin + block.length,
-                                           file.begin, file.begin + file.length)
-            if intersects is not None:
-                start, end = intersects[2]  # relative to the file itself
-                files.append((file, start, end - start))
+        i = max(bisect_right(self._file_begins, begin) - 1, 0)
+        while i < len(self.files) and self.files[i].begin < end:
+            file = self.files[i]
+            start, stop = max(begin, file.begin), min(end, file.begin + file.length)
+            if start < stop:
+                files.append((file, start - file.begin, stop - start))
+            i += 1
         return files
 
-    @property
-    def confirmed_downloaded_bytes(self):
-        # only count confirmed pieces
-        return sum([piece.length for piece in self.pieces if piece.confirmed])
+    def get_piece_files(self, piece_id) -> list[tuple[TorrentFile, int, int]]:
+        piece_begin = piece_id * self.piece_length
+        return self.get_files_in_range(piece_begin, piece_begin + self.get_piece_length(piece_id))
 
-    @property
-    def downloaded_bytes(self):
-        return sum([piece.bytes_downloaded for piece in self.pieces])
+    def get_block_files(self, block: TorrentBlock) -> list[tuple[TorrentFile, int, int]]:
+        return self.get_files_in_range(block.absolute_begin, block.absolute_begin + block.length)
+
+    def get_storage_sections(self, begin, end) -> list[tuple[TorrentFile, int, int]]:
+        """
+            Like get_files_in_range, but the sections of skipped files are in the part file
+        """
+        sections = self.get_files_in_range(begin, end)
+        if self.part_file is None:
+            return sections
+        return [(file, start, length) if file.wanted else (self.part_file, file.begin + start, length)
+                for file, start, length in sections]
 
     async def read_piece(self, piece_id):
-        assert piece_id < len(self.pieces)
+        assert piece_id < self.nr_pieces
+        begin, length = piece_id * self.piece_length, self.get_piece_length(piece_id)
+        if self.write_cache is not None:
+            data = bytearray(length)
+            if self.write_cache.read_into(begin, data):
+                return data
         data = bytearray()
-        for file, begin, length in self.get_piece_files(piece_id):
-            data.extend(await file.read_section(begin, length))
+        for section in await asyncio.gather(*(file.read_section(file_begin, file_length)
+                                              for file, file_begin, file_length in
+                                              self.get_storage_sections(begin, begin + length))):
+            data.extend(section)
+        if self.write_cache is not None and self.write_cache.overlaps(begin, begin + length):
+            # parts of the piece are not on disk yet
+            data.extend(bytes(length - len(data)))
+            self.write_cache.overlay(begin, data)
         return data
 
     async def write_block(self, block: TorrentBlock, data: bytes):
-        data_begin = 0
-        for file, begin, length in self.get_block_files(block):
-            await file.write_section(begin, data[data_begin: data_begin + length])
-            data_begin += length
-
-    async def write_piece(self, piece: TorrentPiece):
-        data = bytearray()
-        for block in piece.blocks:
-            assert block.data is not None
-            data.extend(block.data)
-            block.data = None
-        data_begin = 0
-        for file, begin, length in self.get_piece_files(piece.piece_id):
-            await file.write_section(begin, data[data_begin: data_begin + length])
-            data_begin += length
+        await self._write(block.absolute_begin, data)
+
+    async def write_piece(self, piece_id, data: bytes):
+        await self._write(piece_id * self.piece_length, data)
+
+    async def _write(self, begin: int, data: bytes):
+        if self.write_cache is not None:
+            await self.write_cache.write(begin, data)
+        else:
+            await self._write_range(begin, [data])
+
+    async def _write_range(self, begin: int, buffers: list):
+        # consecutive buffers, split over the files they overlap. all sections are submitted at once
+        sections = self.get_storage_sections(begin, begin + sum(len(buffer) for buffer in buffers))
+        groups = split_buffers(buffers, [length for _, _, length in sections])
+        self._unsynced_files.update((file.path, file) for file, _, _ in sections)
+        await asyncio.gather(*(file.write_sections(file_begin, group)
+                               for (file, file_begin, _), group in zip(sections, groups)))
+
+    async def flush_write_cache(self):
+        if self.write_cache is not None:
+            await self.write_cache.flush()
+
+    async def receive_block(self, block: TorrentBlock, data: bytes) -> bool | None:
+        """
+            Copy a received block into the buffer of its piece. Once all blocks are there the piece is verified from
+            memory, and only written to disk if it is valid.
+            returns None while the piece is incomplete, otherwise whether it was valid
+        """
+        piece_id = block.piece_id
+        buffer = self.piece_buffers.get(piece_id)
+        if buffer is None:
+            buffer = PieceBuffer(piece_id, self.get_piece_length(piece_id))
+            if self.piece_bytes_downloaded[piece_id]:
+                # some blocks were flushed to disk by a previous session. the buffer is only shared once seeded with
+                # them, blocks written to it meanwhile would be overwritten
+                existing = await self.read_piece(piece_id)
+                buffer.write(0, existing[:len(buffer.data)])
+            # another block of the piece may have been received while reading
+            buffer = self.piece_buffers.setdefault(piece_id, buffer)
+        buffer.write(block.begin, data)
+        self.set_block_downloaded(piece_id, block.block_id, True)
+        buffer.update_hash(self)
+        if not buffer.complete:
+            return None
+        del self.piece_buffers[piece_id]
+        if buffer.hasher.digest() != self.piece_hash(piece_id):
+            self.set_piece_blocks_downloaded(piece_id, False)
+            # requestable again right away
+            for block_id in range(ceil(len(buffer.data) / BLOCK_SIZE)):
+                self.set_block_last_requested(self.block_index(piece_id, block_id), None)
+            return False
+        await self.write_piece(piece_id, buffer.data)
+        self.set_piece_confirmed(piece_id, True)
+        return True
+
+    async def flush_piece_buffers(self):
+        """
+            Write the downloaded blocks of incomplete pieces to disk, unverified, so that they can be resumed
+        """
+        writes = []
+        for piece_id, buffer in self.piece_buffers.items():
+            view = memoryview(buffer.data)
+            for block in self.pieces[piece_id].blocks:
+                if block.downloaded:
+                    writes.append(self.write_block(block, view[block.begin: block.begin + block.length]))
+        # adjacent blocks are merged by the write cache or DiskIO
+        await asyncio.gather(*writes)
+        self.piece_buffers.clear()
+
+    async def read_block(self, piece_id, begin, length) -> memoryview | None:
+        """
+            Read a block requested by a peer, through the read cache
+            returns None if the block is not in a confirmed piece, or is too long
+        """
+        if not (0 <= piece_id < self.nr_pieces and self.piece_confirmed[piece_id] and 0 < length <= MAX_REQUEST_LENGTH
+                and 0 <= begin and begin + length <= self.get_piece_length(piece_id)):
+            return None
+        data = await self.read_cache.get(piece_id)
+        if len(data) < begin + length:
+            # removed from the disk
+            return None
+        return memoryview(data)[begin: begin + length]
 
     async def verify_piece(self, piece_id) -> bool:
-        return self.pieces[piece_id].verify(await self.read_piece(piece_id))
-
-    async def check_existing_data(self):
-        pieces_check = True
-        for piece in tqdm(self.pieces, unit="piece", desc="verified"):
-            piece.confirmed = await self.verify_piece(piece.piece_id)
-            if not piece.confirmed:
-                pieces_check = False
-            if piece.downloaded and not piece.confirmed:
-                # marked as downloaded but invalid. mark for redownload
-                for block in piece.blocks:
-                    block.downloaded = False
-            elif not piece.downloaded and piece.confirmed:
-                # marked as not downloaded but actually correct. mark as downloaded
-                for block in piece.blocks:
-                    block.downloaded = True
-                    piece.bytes_downloaded += block.length
+        return sha1(await self.read_piece(piece_id)).digest() == self.piece_hash(piece_id)
+
+    def _verify_piece_data(self, piece_id) -> bool:
+        # runs on a verify worker thread: positional reads (or views of mapped files), no lock needed
+        hasher = sha1()
+        piece_begin = piece_id * self.piece_length
+        piece_end = piece_begin + self.get_piece_length(piece_id)
+        for file, begin, length in self.get_storage_sections(piece_begin, piece_end):
+            data = file.read_section_blocking(begin, length)
+            if len(data) != length:
+                return False
+            hasher.update(data)
+        return hasher.digest() == self.piece_hash(piece_id)
+
+    async def check_existing_data(self, piece_ids=None, workers: int = None):
+        """
+            Verify the data already on disk for the wanted pieces of piece_ids (defaults to all pieces). Pieces are
+            read and hashed on `workers` threads, with up to VERIFY_READ_AHEAD pieces per worker in flight.
+            returns whether all wanted pieces are confirmed
+        """
+        if piece_ids is None:
+            piece_ids = range(self.nr_pieces)
+        piece_ids = [piece_id for piece_id in piece_ids if self.piece_wanted(piece_id)]
+        workers = workers or VERIFY_WORKERS
+        # the workers read from disk
+        await self.flush_write_cache()
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+        total_bytes = sum(self.get_piece_length(piece_id) for piece_id in piece_ids)
+        with ThreadPoolExecutor(workers, thread_name_prefix="verify") as pool, \
+                tqdm(total=total_bytes, unit="B", unit_scale=True, desc="verified") as progress:
+            in_flight = deque()
+
+            async def process_next():
+                piece_id, future = in_flight.popleft()
+                confirmed = await future
+                self.set_piece_confirmed(piece_id, confirmed)
+                # invalid pieces are marked for redownload, correct ones as downloaded
+                self.set_piece_blocks_downloaded(piece_id, confirmed)
+                progress.update(self.get_piece_length(piece_id))
+
+            for piece_id in piece_ids:
+                if len(in_flight) >= workers * VERIFY_READ_AHEAD:
+                    await process_next()
+                in_flight.append((piece_id, loop.run_in_executor(pool, self._verify_piece_data, piece_id)))
+            while in_flight:
+                await process_next()
+        elapsed = time.time() - start_time
+        self.verify_rate = total_bytes / elapsed if elapsed else 0
         for file in self.files:
-            if all([piece.confirmed for piece in file.get_pieces(self.pieces)]):
+            if file.confirmed_bytes == file.length:
                 file.downloaded = True
-        return pieces_check
+        return self.complete
+
+    async def sync(self):
+        await self.flush_write_cache()
+        if self.complete:
+            for file in self.files:
+                if not file.length and file.wanted:
+                    file.create()
+        files, self._unsynced_files = self._unsynced_files, {}
+        await asyncio.gather(*(file.sync() for file in files.values()))
 
     def close(self):
+        self.disk_io.close()
         for file in self.files:
             file.close()
+        if self.part_file is not None:
+            self.part_file.close()
+        self.file_pool.close()
+        self.closed = True
 
 
 def get_intersections(a: int, b: int, c: int, d: int) -> tuple[tuple[int, int], tuple[int, int], tuple[int, int]]:
@@ -9,6 +9,7 @@ from dataclasses import dataclass
 from urllib.parse import urlencode, urlparse
 
 from guit_torrent.metainfo import TorrentMetaInfo
+from guit_torrent.peer.server import DEFAULT_PORT
 
 DEFAULT_ANNOUNCE_INTERVAL = 2 * 60
 
@@ -19,12 +20,18 @@ class TrackerError(Exception):
 
 class BaseTracker(ABC):
     def __init__(self, address: urllib.parse.ParseResult, torrent_metainfo: TorrentMetaInfo, peer_id,
-                 get_downloaded_cb=None, update_data_cb=None):
+                 get_downloaded_cb=None, update_data_cb=None, get_left_cb=None, get_uploaded_cb=None,
+                 port: int = DEFAULT_PORT):
         self.address = address
         self.peer_id = peer_id
         self.torrent_metainfo = torrent_metainfo
         self.get_downloaded_cb = get_downloaded_cb
         self.update_data_cb = update_data_cb
+        # bytes still to download. defaults to everything not downloaded
+        self.get_left_cb = get_left_cb
+        self.get_uploaded_cb = get_uploaded_cb
+        # where we accept connections from peers
+        self.port = port
 
         self.connected = False
 
@@ -43,7 +50,8 @@ class BaseTracker(ABC):
 
     @classmethod
     def from_url(cls, announce_url: str, torrent_metainfo: TorrentMetaInfo, peer_id: str,
-                 get_downloaded_cb=None, update_data_cb=None) -> "BaseTracker":
+                 get_downloaded_cb=None, update_data_cb=None, get_left_cb=None,
+                 get_uploaded_cb=None, port: int = DEFAULT_PORT) -> "BaseTracker":
         from guit_torrent.tracker.http import TrackerHTTP
         from guit_torrent.tracker.udp import TrackerUDP
         parsed_announce_url = urlparse(announce_url)
@@ -55,7 +63,8 @@ class BaseTracker(ABC):
         }
         if scheme not in protocols:
             raise ValueError('announce_url uses unknown protocol "{}"'.format(scheme))
-        return protocols[scheme](parsed_announce_url, torrent_metainfo, peer_id, get_downloaded_cb, update_data_cb)
+        return protocols[scheme](parsed_announce_url, torrent_metainfo, peer_id, get_downloaded_cb, update_data_cb,
+                                 get_left_cb, get_uploaded_cb, port)
 
     async def close(self):
         if self.future:
@@ -70,13 +79,14 @@ class BaseTracker(ABC):
 
     async def announce(self, event: str = None):
         downloaded = 0 if not self.get_downloaded_cb else self.get_downloaded_cb()
+        left = self.torrent_metainfo.info.total_length - downloaded if not self.get_left_cb else self.get_left_cb()
         params = TrackerRequestParameters(
             info_hash=self.torrent_metainfo.info_hash,
             peer_id=self.peer_id,
-            port=6888,
-            uploaded=0,
+            port=self.port,
+            uploaded=0 if not self.get_uploaded_cb else self.get_uploaded_cb(),
             downloaded=downloaded,
-            left=self.torrent_metainfo.info.total_length - downloaded,
+            left=left,
             event="started" if not self.last_update else event,
             trackerid=self.tracker_id
         )
@@ -5,14 +5,17 @@ import async_timeout
 
 from guit_torrent.bencoding import bendecode
 from guit_torrent.metainfo import TorrentMetaInfo
+from guit_torrent.peer.server import DEFAULT_PORT
 from guit_torrent.tracker.base import BaseTracker, TrackerResponse, TrackerRequestParameters
 from guit_torrent.utils import _format_keys
 
 
 class TrackerHTTP(BaseTracker):
     def __init__(self, address: urllib.parse.ParseResult, torrent_metainfo: TorrentMetaInfo, peer_id,
-                 get_downloaded_cb, update_data_cb=None):
-        super().__init__(address, torrent_metainfo, peer_id, get_downloaded_cb, update_data_cb)
+                 get_downloaded_cb, update_data_cb=None, get_left_cb=None, get_uploaded_cb=None,
+                 port: int = DEFAULT_PORT):
+        super().__init__(address, torrent_metainfo, peer_id, get_downloaded_cb, update_data_cb, get_left_cb,
+                         get_uploaded_cb, port)
         self._session = None
 
     async def close(self):
@@ -3,6 +3,7 @@ import random
 import string
 
 from guit_torrent.metainfo import TorrentMetaInfo
+from guit_torrent.peer.server import DEFAULT_PORT
 from guit_torrent.tracker.base import BaseTracker
 
 DEFAULT_ANNOUNCE_INTERVAL = 2 * 60
@@ -10,10 +11,12 @@ TRACKERS_TO_TRY = 20
 
 
 class TrackerManager:
-    def __init__(self, torrent_metadata: TorrentMetaInfo, get_downloaded_cb=None, updates=None):
+    def __init__(self, torrent_metadata: TorrentMetaInfo, get_downloaded_cb=None, updates=None, get_left_cb=None,
+                 get_uploaded_cb=None, port: int = DEFAULT_PORT):
         self.peer_id = _generate_peer_id()
         self.trackers = [
-            BaseTracker.from_url(announce_url, torrent_metadata, self.peer_id, get_downloaded_cb, self.update_data_cb)
+            BaseTracker.from_url(announce_url, torrent_metadata, self.peer_id, get_downloaded_cb, self.update_data_cb,
+                                 get_left_cb, get_uploaded_cb, port)
             for announce_url in torrent_metadata.get_announce_urls()
         ]
         self.nr_leechers = 0
@@ -5,6 +5,7 @@ import urllib.parse
 from asyncio import DatagramProtocol, Event
 
 from guit_torrent.metainfo import TorrentMetaInfo
+from guit_torrent.peer.server import DEFAULT_PORT
 from guit_torrent.tracker.base import BaseTracker, TrackerResponse, TrackerRequestParameters, TrackerError
 
 MAGIC_CONNECT_CONSTANT = 0x41727101980
@@ -16,9 +17,11 @@ def get_random_transaction_id():
 
 class TrackerUDP(BaseTracker):
     def __init__(self, address: urllib.parse.ParseResult, torrent_metainfo: TorrentMetaInfo, peer_id,
-                 get_downloaded_cb, update_data_cb=None):
-        super().__init__(address, torrent_metainfo, peer_id, get_downloaded_cb, update_data_cb)
-        self.host, self.port = address.hostname, address.port
+                 get_downloaded_cb, update_data_cb=None, get_left_cb=None, get_uploaded_cb=None,
+                 port: int = DEFAULT_PORT):
+        super().__init__(address, torrent_metainfo, peer_id, get_downloaded_cb, update_data_cb, get_left_cb,
+                         get_uploaded_cb, port)
+        self.tracker_host, self.tracker_port = address.hostname, address.port
         self._session = None
         self.transport = None
         self.protocol: TrackerUDPProtocol = None
@@ -48,7 +51,7 @@ class TrackerUDP(BaseTracker):
             loop = asyncio.get_running_loop()
 
             self.transport, self.protocol = await loop.create_datagram_endpoint(
-                lambda: TrackerUDPProtocol(), remote_addr=(self.host, self.port))
+                lambda: TrackerUDPProtocol(), remote_addr=(self.tracker_host, self.tracker_port))
         if not self.connection_id:
             await self._connect()
         # console.log("Sending announce to UDP tracker...")
@@ -73,19 +73,20 @@ def get_progress_task_for_file(file) -> int:
 
 
 def ui_update_files_progress(torrent):
-    for file in torrent.files:
-        if file.progress_task:
-            file_progress.update(file.progress_task, completed=file.downloaded_bytes(torrent.pieces),
-                                 filename=file.name)
+    # only the files that changed since the last update
+    for file in torrent.pop_changed_files():
+        if file.progress_task is not None:
+            file_progress.update(file.progress_task, completed=file.confirmed_bytes, filename=file.name,
+                                 visible=file.wanted)
 
 
 def ui_update_overall(client, available_pieces):
     torrent_progress.update(
-        torrent_task, description=client.torrent.name, completed=client.torrent.downloaded_bytes,
-        total=client.torrent.length, peers_alive=len([peer for peer in client.peers if peer.alive]),
+        torrent_task, description=client.torrent.name, completed=client.torrent.wanted_downloaded_bytes,
+        total=client.torrent.wanted_length, peers_alive=len([peer for peer in client.peers if peer.alive]),
         peers_conn=len(client.peers), peers_total=len(client.tracker_manager.peers),
-        pieces_downloaded=sum(piece.confirmed for piece in client.torrent.pieces),
-        pieces_available=available_pieces, pieces_total=len(client.torrent.pieces),
+        pieces_downloaded=client.torrent.wanted_pieces_confirmed,
+        pieces_available=available_pieces, pieces_total=client.torrent.wanted_pieces,
         trackers_conn=sum(tracker.connected and not tracker.error for tracker in client.tracker_manager.trackers),
         trackers_total=len(client.tracker_manager.trackers)
     )
@@ -1,19 +1,64 @@
 import asyncio
 from argparse import ArgumentParser
 
+from guit_torrent.cache import WRITE_CACHE_SIZE
 from guit_torrent.client import TorrentClient
+from guit_torrent.peer.peer import MIN_REQUEST_WINDOW, MAX_REQUEST_WINDOW
+from guit_torrent.peer.server import PeerServer, DEFAULT_PORT, DEFAULT_BIND
+from guit_torrent.storage import PREALLOCATE_MODES, MAX_OPEN_FILES
+from guit_torrent.torrentdata import STORAGE_BACKENDS, PRIORITY_SKIP, PRIORITY_NORMAL, PRIORITY_HIGH
 
 argparser = ArgumentParser("Launch download of a torrent file")
 argparser.add_argument("torrent", help="Path to a .torrent file", type=str)
 argparser.add_argument("-o", "--output", help="Main output folder. Defaults to downloads/", type=str,
                        default="downloads")
+argparser.add_argument("--verify-workers", help="Number of threads verifying existing data. Defaults to the number "
+                                                "of cpus", type=int)
+argparser.add_argument("--storage", help="How files are accessed: positional reads/writes on I/O threads, or memory "
+                                         "mapped. Defaults to pread", choices=list(STORAGE_BACKENDS), default="pread")
+argparser.add_argument("--write-cache", help="MiB of verified pieces kept in memory to be written in large sequential "
+                                             "writes. 0 to disable. Defaults to 64", type=int,
+                       default=WRITE_CACHE_SIZE // 2 ** 20)
+argparser.add_argument("--preallocate", help="Allocation of the output files: none (grow as data arrives), sparse "
+                                             "(full length, no blocks) or full (all blocks allocated up front, less "
+                                             "fragmentation). Defaults to none", choices=PREALLOCATE_MODES,
+                       default="none")
+argparser.add_argument("--skip", help="Do not download the files whose names match these glob patterns", nargs="+",
+                       default=[], metavar="PATTERN")
+argparser.add_argument("--only", help="Only download the files whose names match these glob patterns", nargs="+",
+                       default=[], metavar="PATTERN")
+argparser.add_argument("--high", help="Download the files whose names match these glob patterns first", nargs="+",
+                       default=[], metavar="PATTERN")
+argparser.add_argument("--max-open-files", help="Number of files kept open at once. Defaults to "
+                                                f"{MAX_OPEN_FILES}", type=int, default=MAX_OPEN_FILES)
+argparser.add_argument("--seed", help="Keep uploading to peers once the download is complete",
+                       action="store_true")
+argparser.add_argument("--port", help=f"Port where peers can connect to us, announced to the trackers. Defaults to "
+                                      f"{DEFAULT_PORT}", type=int, default=DEFAULT_PORT)
+argparser.add_argument("--bind", help=f"Address to listen on for peers. Defaults to {DEFAULT_BIND}", type=str,
+                       default=DEFAULT_BIND)
+argparser.add_argument("--request-window", help="Minimum and maximum number of blocks requested at once from a peer, "
+                                                "sized from its download rate and round trip time. Defaults to "
+                                                f"{MIN_REQUEST_WINDOW} {MAX_REQUEST_WINDOW}", type=int, nargs=2,
+                       default=[MIN_REQUEST_WINDOW, MAX_REQUEST_WINDOW], metavar=("MIN", "MAX"))
 
 
 if __name__ == "__main__":
     args = argparser.parse_args()
-    client = TorrentClient(args.torrent, args.output)
-
+    # later patterns take precedence
+    priority_patterns = ([("*", PRIORITY_SKIP)] if args.only else []) + \
+                        [(pattern, PRIORITY_NORMAL) for pattern in args.only] + \
+                        [(pattern, PRIORITY_SKIP) for pattern in args.skip] + \
+                        [(pattern, PRIORITY_HIGH) for pattern in args.high]
+    server = PeerServer(args.bind, args.port)
     loop = asyncio.get_event_loop()
+    # before the client, which announces the port (picked by the system if 0)
+    loop.run_until_complete(server.start())
+    client = TorrentClient(args.torrent, args.output, verify_workers=args.verify_workers, storage=args.storage,
+                           write_cache_size=args.write_cache * 2 ** 20, preallocate_mode=args.preallocate,
+                           max_open_files=args.max_open_files, priority_patterns=priority_patterns,
+                           seed=args.seed, server=server, request_window=tuple(args.request_window))
+
     main_task = asyncio.ensure_future(client.start())
     try:
         loop.run_until_complete(main_task)
@@ -21,3 +66,4 @@ if __name__ == "__main__":
         pass
     finally:
         loop.run_until_complete(client.stop())
+        loop.run_until_complete(server.close())
@@ -0,0 +1,37 @@
+from hashlib import sha1
+
+from guit_torrent.bencoding import bendecode, benencode, benencode_into, bendecode_view, decode_bytestrings
+from guit_torrent.metainfo import TorrentMetaInfo
+
+
+def test_decode_view():
+    data = benencode({"a": [1, -2, "xyz"], "b": {"c": b"\xff\x00"}, "d": 0})
+    decoded, spans = bendecode_view(data)
+    assert isinstance(decoded["a"][2], memoryview)
+    assert decoded["a"][2].obj is data
+    assert decode_bytestrings(decoded) == bendecode(data)
+    for key, (start, end) in spans.items():
+        assert data[start: end] == benencode(bendecode(data)[key])
+
+
+def test_info_hash_from_raw_bytes():
+    # keys out of canonical order: re-encoding the info dict would give a different hash
+    raw_info = b"d6:lengthi5e4:name5:a.txt12:piece lengthi16384e6:pieces20:" + bytes(20) + b"e"
+    raw_info = raw_info.replace(b"6:lengthi5e4:name5:a.txt", b"4:name5:a.txt6:lengthi5e")
+    data = b"d8:announce14:udp://host:80/4:info" + raw_info + b"e"
+    meta_info = TorrentMetaInfo.from_bytes(data)
+    assert meta_info.info_hash == sha1(raw_info).digest()
+    assert meta_info.info.name == "a.txt"
+    assert meta_info.info.length == 5
+
+
+def test_encode():
+    assert benencode({"b": [1, True, "é"], "a": {}, b"c": memoryview(b"xy")}) == b"d1:ade1:bli1ei1e2:\xc3\xa9e1:c2:xye"
+    buffer = bytearray(b"prefix")
+    benencode_into([bytearray(b"ab"), -3], buffer)
+    assert buffer == b"prefixl2:abi-3ee"
+    # deeper than the recursion limit
+    nested = [0]
+    for _ in range(5000):
+        nested = [nested]
+    assert benencode(nested) == b"l" * 5001 + b"i0e" + b"e" * 5001
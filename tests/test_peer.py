@@ -0,0 +1,147 @@
+import asyncio
+import time
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from guit_torrent.metainfo import load_torrent_metadata
+from guit_torrent.peer import peer as peer_module
+from guit_torrent.peer.messages import CancelMessage, RequestMessage, PieceMessage
+from guit_torrent.peer.peer import Peer, WINDOW_QUEUE_TIME, INITIAL_REQUEST_TIMEOUT, MIN_REQUEST_TIMEOUT
+from guit_torrent.torrentdata import BLOCK_SIZE, get_torrentdata_from_metainfo
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def deliver(peer, clock, blocks_per_round_trip, rtt, duration):
+    """requests blocks_per_round_trip blocks at once, which arrive rtt seconds later"""
+    begin = clock.now
+    while clock.now - begin < duration:
+        keys = [(int(clock.now * 1000), i * BLOCK_SIZE) for i in range(blocks_per_round_trip)]
+        for key in keys:
+            peer.requested[key] = (None, clock.now)
+        clock.now += rtt
+        for index, block_begin in keys:
+            peer.block_arrived(index, block_begin, BLOCK_SIZE)
+
+
+def test_request_window(monkeypatch):
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    clock = Clock()
+    monkeypatch.setattr(peer_module.time, "monotonic", clock)
+    peer = Peer(metadata, "-GT0000-" + "0" * 12, ("127.0.0.1", 1), None, min_window=4, max_window=300)
+    assert peer.window == 8
+    # fast peer: 10 blocks every 100ms
+    deliver(peer, clock, 10, 0.1, 5)
+    rate = 10 * BLOCK_SIZE / 0.1
+    assert peer.rate == pytest.approx(rate, rel=0.05) and peer.rtt == pytest.approx(0.1)
+    assert peer.window == pytest.approx(rate * (0.1 + WINDOW_QUEUE_TIME) / BLOCK_SIZE, rel=0.05)
+    # faster: capped
+    deliver(peer, clock, 100, 0.1, 10)
+    assert peer.window == 300
+    # slow peer: a block every 2 seconds
+    deliver(peer, clock, 1, 2, 60)
+    assert peer.window == 4
+    # unrequested blocks are not counted
+    downloaded = peer.downloaded
+    peer.block_arrived(0, 0, BLOCK_SIZE)
+    assert peer.downloaded == downloaded and not peer.requested
+    assert peer.stats()["window"] == 4
+
+
+def test_request_release(monkeypatch):
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    clock = Clock()
+    monkeypatch.setattr(peer_module.time, "monotonic", clock)
+    released = []
+    peer = Peer(metadata, "-GT0000-" + "0" * 12, ("127.0.0.1", 1), None, min_window=4, max_window=300,
+                requests_released_cb=lambda peer, blocks: released.append(peer))
+    with TemporaryDirectory() as tmpdir:
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir)
+        blocks = [block for piece in torrent.pieces for block in piece.blocks]
+        assert len(blocks) >= 6
+
+        def request(*requested_blocks):
+            for block in requested_blocks:
+                block.last_requested = time.time()
+                peer.requested[(block.piece_id, block.begin)] = (block, clock.now)
+
+        # no round trip measured yet
+        request(blocks[0])
+        clock.now += INITIAL_REQUEST_TIMEOUT - 1
+        request(blocks[1])
+        assert peer.expire_requests() == 0
+        clock.now += 1
+        assert peer.expire_requests() == 1 and list(peer.requested) == [(blocks[1].piece_id, blocks[1].begin)]
+        assert blocks[0].request_timedout and not blocks[1].request_timedout and released == [peer]
+        assert peer.window == 4
+        # answered quickly: shorter timeout
+        peer.block_arrived(blocks[1].piece_id, blocks[1].begin, blocks[1].length)
+        assert peer.request_timeout == MIN_REQUEST_TIMEOUT
+        # late answer to a request that timed out
+        downloaded = peer.downloaded
+        peer.block_arrived(blocks[0].piece_id, blocks[0].begin, blocks[0].length)
+        assert peer.downloaded == downloaded
+        # choked or disconnected: released at once, queued blocks included
+        request(blocks[2], blocks[3])
+        blocks[2].downloaded = True
+        peer.blocks_to_request.put_nowait(blocks[4])
+        blocks[4].last_requested = time.time()
+        peer.release_requests()
+        assert not peer.requested and peer.blocks_to_request.empty() and len(released) == 2
+        assert not blocks[2].request_timedout and blocks[3].request_timedout and blocks[4].request_timedout
+        assert peer.stats()["timeouts"] == 1 and peer.stats()["released"] == 4
+        torrent.close()
+
+
+class FakeConnection:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+    async def drain(self):
+        pass
+
+
+def test_cancel_request():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    peer = Peer(metadata, "-GT0000-" + "0" * 12, ("127.0.0.1", 1), None)
+    peer.connection = FakeConnection()
+    peer.alive = True
+    peer.requested[(3, BLOCK_SIZE)] = (None, 0.0)
+    assert not peer.cancel_request(3, 0, BLOCK_SIZE)
+    assert peer.cancel_request(3, BLOCK_SIZE, BLOCK_SIZE)
+    assert not peer.requested and peer.connection.sent == [CancelMessage(index=3, begin=BLOCK_SIZE, length=BLOCK_SIZE)]
+    assert peer.request_slot_available.is_set() and peer.stats()["cancelled"] == 1
+
+
+@pytest.mark.asyncio
+async def test_serve_requests_read_error():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+
+    async def read_block(piece_id, begin, length):
+        if piece_id == 0:
+            raise OSError("disk error")
+        return bytes(length)
+
+    peer = Peer(metadata, "-GT0000-" + "0" * 12, ("127.0.0.1", 1), None, read_block)
+    peer.connection = FakeConnection()
+    peer.alive = True
+    peer.requests_to_serve.extend([RequestMessage(index=0, begin=0, length=10),
+                                   RequestMessage(index=1, begin=0, length=10)])
+    peer.requests_available.set()
+    serve = asyncio.create_task(peer.serve_requests())
+    for _ in range(10):
+        await asyncio.sleep(0)
+    # the failed request is dropped, the next one is served
+    assert not serve.done() and peer.connection.sent == [PieceMessage(index=1, begin=0, block=bytes(10))]
+    assert peer.uploaded == 10
+    serve.cancel()
@@ -1,9 +1,13 @@
+import asyncio
 import secrets
+import socket
 
 import pytest
 
 from guit_torrent.peer.messages import read_msg, KeepAliveMessage, ChokeMessage, UnchokeMessage, InterestedMessage, \
-    NotInterestedMessage, HaveMessage, BitfieldMessage, RequestMessage, PieceMessage, CancelMessage, PortMessage
+    NotInterestedMessage, HaveMessage, BitfieldMessage, RequestMessage, PieceMessage, CancelMessage, PortMessage, \
+    Outbox
+from guit_torrent.peer.protocol import PeerProtocol
 
 
 class FakeStream:
@@ -35,3 +39,101 @@ async def test_encode_decode():
         encoded = msg.encode()
         parsed = await read_msg(FakeStream(encoded))
         assert encoded == parsed.encode()
+        outbox = Outbox(size=4)
+        outbox.append(b"x")
+        msg.encode_into(outbox)
+        assert outbox.buffer[:outbox.length] == b"x" + encoded
+
+
+class FakeTransport:
+    def __init__(self):
+        self.paused = False
+        self.written = []
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def is_closing(self):
+        return False
+
+    def pause_reading(self):
+        self.paused = True
+
+    def resume_reading(self):
+        self.paused = False
+
+
+@pytest.mark.asyncio
+async def test_protocol():
+    msgs = [PieceMessage(i, i * 100, secrets.token_bytes(60)) for i in range(5)] + [
+        KeepAliveMessage(), HaveMessage(3), BitfieldMessage(set(range(0, 2000, 3)), 250), RequestMessage(1, 2, 3)]
+    data = b"".join(msg.encode() for msg in msgs)
+    protocol = PeerProtocol(buffer_size=100)
+    transport = FakeTransport()
+    protocol.connection_made(transport)
+
+    async def feed():
+        # received in small chunks, whenever there is room
+        pos = 0
+        while pos < len(data):
+            await asyncio.sleep(0)
+            if transport.paused:
+                continue
+            buffer = protocol.get_buffer(-1)
+            n = min(len(buffer), 7, len(data) - pos)
+            buffer[:n] = data[pos: pos + n]
+            pos += n
+            protocol.buffer_updated(n)
+        protocol.eof_received()
+
+    feeding = asyncio.create_task(feed())
+    for msg in msgs:
+        parsed = await protocol.read_msg()
+        assert parsed.encode() == msg.encode()
+        if isinstance(parsed, PieceMessage):
+            # a view of the receive buffer
+            assert isinstance(parsed.block, memoryview)
+    await feeding
+    with pytest.raises(asyncio.IncompleteReadError):
+        await protocol.read_msg()
+    assert protocol.messages_received == len(msgs) and protocol.bytes_received == len(data)
+
+
+@pytest.mark.asyncio
+async def test_protocol_send():
+    protocol = PeerProtocol()
+    transport = FakeTransport()
+    protocol.connection_made(transport)
+    msgs = [RequestMessage(1, i * 100, 100) for i in range(50)] + [HaveMessage(2)]
+    for msg in msgs:
+        protocol.send(msg)
+    assert not transport.written
+    # a single write at the next iteration of the event loop
+    await asyncio.sleep(0)
+    assert transport.written == [b"".join(msg.encode() for msg in msgs)]
+    protocol.send(HaveMessage(3))
+    await protocol.drain()
+    assert transport.written[-1] == HaveMessage(3).encode() and protocol.writes == 2
+
+
+@pytest.mark.asyncio
+async def test_protocol_send_backed_up():
+    loop = asyncio.get_running_loop()
+    ours, theirs = socket.socketpair()
+    ours.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    theirs.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    theirs.setblocking(False)
+    _, protocol = await loop.create_connection(PeerProtocol, sock=ours)
+    # more than the socket takes while the other side does not read: the transport keeps the rest
+    msgs = [PieceMessage(i, 0, secrets.token_bytes(2 ** 14)) for i in range(40)]
+    for msg in msgs:
+        protocol.send(msg)
+        await asyncio.sleep(0)
+    assert protocol.transport.get_write_buffer_size() and protocol.writes == len(msgs)
+    expected = b"".join(msg.encode() for msg in msgs)
+    received = bytearray()
+    while len(received) < len(expected):
+        received += await loop.sock_recv(theirs, 2 ** 16)
+    assert received == expected
+    protocol.close()
+    theirs.close()
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from guit_torrent.metainfo import load_torrent_metadata
+from guit_torrent.peer.messages import HandshakeMessage, BitfieldMessage, RequestMessage, PieceMessage, read_msg
+from guit_torrent.peer.peer import Peer
+from guit_torrent.peer.server import PeerServer
+
+
+async def handshake(port, info_hash):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(HandshakeMessage(info_hash=info_hash, peer_id="-TEST-" + "0" * 14).encode())
+    return reader, writer, await reader.read(HandshakeMessage.len())
+
+
+@pytest.mark.asyncio
+async def test_peer_server():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    peers = []
+
+    async def read_block(piece_id, begin, length):
+        return bytes([piece_id]) * length
+
+    def accept(host, connection):
+        peer = Peer(metadata, "-GT0000-" + "0" * 12, host, None, read_block, lambda: {1})
+        peer.start(connection)
+        peers.append(peer)
+        return peer
+
+    server = PeerServer("127.0.0.1", 0)
+    await server.start()
+    server.register(metadata.info_hash, accept, max_connections=1)
+    reader, writer, data = await handshake(server.port, metadata.info_hash)
+    assert HandshakeMessage.decode(data).info_hash == metadata.info_hash
+    msg = await read_msg(reader)
+    assert isinstance(msg, BitfieldMessage) and msg.pieces == {1}
+    # served through the same message loop as outgoing connections
+    writer.write(RequestMessage(index=1, begin=0, length=100).encode())
+    while not isinstance(msg := await read_msg(reader), PieceMessage):
+        pass
+    assert (msg.index, msg.begin, msg.block) == (1, 0, bytes([1]) * 100)
+    assert peers[0].uploaded == 100
+    # over the limit of the torrent, or for a torrent we do not have
+    for info_hash in (metadata.info_hash, bytes(20)):
+        refused_reader, refused_writer, data = await handshake(server.port, info_hash)
+        assert data == b""
+        refused_writer.close()
+    assert server.stats() == {"connections": 1, "accepted": 1, "refused": 2}
+    writer.close()
+    await peers[0].close()
+    # handshake not sent yet: closed with the server
+    silent_reader, silent_writer = await asyncio.open_connection("127.0.0.1", server.port)
+    while not server._handshakes:
+        await asyncio.sleep(0.01)
+    await server.close()
+    assert not server._handshakes and await silent_reader.read() == b""
+    silent_writer.close()
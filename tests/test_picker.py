@@ -0,0 +1,70 @@
+import random
+import time
+
+from guit_torrent.picker import PiecePicker
+from guit_torrent.torrentdata import Torrent, TorrentFile, BLOCK_SIZE, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_SKIP
+
+
+def make_torrent(nr_pieces: int, nr_files: int = 1) -> Torrent:
+    piece_length = 2 * BLOCK_SIZE
+    file_length = nr_pieces * piece_length // nr_files
+    files = [TorrentFile(name=str(i), length=file_length, begin=i * file_length) for i in range(nr_files)]
+    return Torrent(name="t", length=nr_pieces * piece_length, piece_length=piece_length,
+                   piece_hashes=bytes(20 * nr_pieces), files=files)
+
+
+def test_availability():
+    torrent = make_torrent(10)
+    picker = PiecePicker(torrent, random.Random(0))
+    peers = [set(range(10)), {0, 1, 2}, {0, 1}, {0}]
+    for pieces in peers:
+        picker.add_pieces(pieces)
+    assert list(picker.availability) == [4, 3, 2] + [1] * 7 and picker.available_pieces == 10
+    # rarest first, ties in random order
+    assert list(picker.pick_pieces(set(range(10))))[-3:] == [2, 1, 0]
+    assert sorted(list(picker.pick_pieces(set(range(10))))[:7]) == list(range(3, 10))
+    orders = {tuple(picker.pick_pieces(set(range(3, 10)))) for _ in range(20)}
+    assert len(orders) > 1
+    # only pieces the peer has
+    assert list(picker.pick_pieces({1, 0})) == [1, 0]
+    # the first peer disconnects
+    picker.remove_pieces(peers[0])
+    assert list(picker.availability) == [3, 2, 1] + [0] * 7 and picker.available_pieces == 3
+    # pieces no peer has are never picked
+    assert list(picker.pick_pieces(set(range(10)))) == [2, 1, 0]
+
+
+def test_pick_blocks():
+    torrent = make_torrent(6, nr_files=3)
+    torrent.set_file_priorities([PRIORITY_NORMAL, PRIORITY_HIGH, PRIORITY_SKIP])
+    picker = PiecePicker(torrent, random.Random(0))
+    picker.add_pieces(range(6))
+    picker.add_pieces([0])
+    # high priority first, skipped pieces never
+    assert list(picker.pick_pieces(set(range(6))))[:2] in ([2, 3], [3, 2])
+    assert set(picker.pick_pieces(set(range(6)))) == {0, 1, 2, 3}
+    blocks = picker.pick_blocks(set(range(6)), 3)
+    assert len(blocks) == 3 and blocks[0].piece_id == blocks[1].piece_id
+    started = blocks[2].piece_id
+    for block in blocks:
+        block.last_requested = time.time()
+    # the piece started is finished first
+    block = picker.pick_blocks(set(range(6)), 1)[0]
+    assert block.piece_id == started
+    block.last_requested = time.time()
+    # all its blocks requested: left out of the picks, until some are released or time out
+    assert started in picker.exhausted and started not in set(picker.pick_pieces(set(range(6))))
+    assert started in set(picker.pieces_left())
+    picker.recheck_exhausted()
+    assert started in picker.exhausted
+    block.last_requested = None
+    picker.recheck_exhausted()
+    assert list(picker.pick_pieces(set(range(6))))[0] == started
+    assert picker.pick_blocks(set(range(6)), 1)[0].piece_id == started and started in picker.exhausted
+    picker.blocks_released([started])
+    assert list(picker.pick_pieces(set(range(6))))[0] == started
+    # confirmed pieces are not picked anymore
+    torrent.set_piece_confirmed(started, True)
+    picker.piece_confirmed(started)
+    assert started not in set(picker.pick_pieces(set(range(6)))) and started not in picker.pieces_left()
+    assert sorted(picker.pieces_left()) == sorted({0, 1, 2, 3} - {started})
@@ -0,0 +1,87 @@
+import os
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from guit_torrent.metainfo import load_torrent_metadata
+from guit_torrent.resume import ResumeData, pack_bits, unpack_bits, save_resume_data, load_resume_data
+from guit_torrent.torrentdata import get_torrentdata_from_metainfo, match_file_priorities, PRIORITY_SKIP
+
+
+def test_bits():
+    values = bytearray([1, 0, 0, 1, 1, 0, 1, 0, 1, 1, 0])
+    assert pack_bits(values) == bytes([0b10011010, 0b11000000])
+    assert unpack_bits(pack_bits(values), len(values)) == values
+
+
+@pytest.mark.asyncio
+async def test_resume():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    with TemporaryDirectory() as tmpdir:
+        # existing data: all files, read in the order of the torrent
+        for file in metadata.info.get_files():
+            with open(os.path.join("assets/torrent_files", file.name), "rb") as f_in, \
+                    open(os.path.join(tmpdir, file.name), "wb") as f_out:
+                f_out.write(f_in.read())
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir)
+        assert await torrent.check_existing_data()
+        # a partially downloaded piece
+        torrent.set_piece_confirmed(2, False)
+        torrent.set_piece_blocks_downloaded(2, False)
+        torrent.set_block_downloaded(2, 1, True)
+        await torrent.sync()
+        resume_path = os.path.join(tmpdir, "resume")
+        save_resume_data(resume_path, ResumeData.from_torrent(torrent, metadata.info_hash))
+        torrent.close()
+
+        resumed = get_torrentdata_from_metainfo(metadata, tmpdir)
+        resume_data = load_resume_data(resume_path)
+        assert resume_data.apply(resumed, b"another info_hash") is None
+        assert resume_data.apply(resumed, metadata.info_hash) == []
+        assert resumed.piece_confirmed == torrent.piece_confirmed
+        assert resumed.block_downloaded == torrent.block_downloaded
+        resumed.close()
+
+        # only the pieces of modified files are verified again
+        changed_file = resumed.files[-1]
+        os.utime(changed_file.path, ns=(0, 0))
+        resumed = get_torrentdata_from_metainfo(metadata, tmpdir)
+        assert resume_data.apply(resumed, metadata.info_hash) == list(range(changed_file.first_piece,
+                                                                            changed_file.end_piece))
+        resumed.close()
+
+
+@pytest.mark.asyncio
+async def test_resume_part_file():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    names = [file.name for file in metadata.info.get_files()]
+    files_raw_data = bytearray()
+    for name in names:
+        with open(os.path.join("assets/torrent_files", name), "rb") as f:
+            files_raw_data.extend(f.read())
+    priorities = match_file_priorities(names, [("*.png", PRIORITY_SKIP)])
+    with TemporaryDirectory() as tmpdir:
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir, file_priorities=priorities)
+        for piece in torrent.pieces:
+            if torrent.piece_wanted(piece.piece_id):
+                for block in piece.blocks:
+                    begin = piece.begin + block.begin
+                    await torrent.receive_block(block, files_raw_data[begin: begin + block.length])
+        await torrent.sync()
+        resume_path = os.path.join(tmpdir, "resume")
+        save_resume_data(resume_path, ResumeData.from_torrent(torrent, metadata.info_hash))
+        torrent.close()
+        resume_data = load_resume_data(resume_path)
+        assert resume_data.part_file is not None
+
+        resumed = get_torrentdata_from_metainfo(metadata, tmpdir, file_priorities=priorities)
+        assert resume_data.apply(resumed, metadata.info_hash) == []
+        assert resumed.piece_confirmed == torrent.piece_confirmed
+        resumed.close()
+
+        # the part file changed: the pieces with parts of the skipped file are verified again
+        os.remove(torrent.part_file_path)
+        skipped = resumed.files[names.index("shrek.png")]
+        resumed = get_torrentdata_from_metainfo(metadata, tmpdir, file_priorities=priorities)
+        assert resume_data.apply(resumed, metadata.info_hash) == list(range(skipped.first_piece, skipped.end_piece))
+        resumed.close()
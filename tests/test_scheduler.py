@@ -0,0 +1,219 @@
+import asyncio
+import random
+import time
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from guit_torrent.metainfo import load_torrent_metadata
+from guit_torrent.peer.peer import Peer
+from guit_torrent.picker import PiecePicker
+from guit_torrent.scheduler import RequestScheduler, ENDGAME_MAX_REQUESTS
+from guit_torrent.torrentdata import get_torrentdata_from_metainfo
+
+
+def make_peer(metadata, port: int, pieces: set[int], window: int, min_window: int = None,
+              requests_released_cb=None) -> Peer:
+    peer = Peer(metadata, "-GT0000-" + "0" * 12, ("127.0.0.1", port), None, min_window=min_window or window,
+                max_window=window, requests_released_cb=requests_released_cb)
+    peer.window = window
+    peer.alive = True
+    peer.am_not_choking.set()
+    peer.available_pieces = pieces
+    return peer
+
+
+def queued(peer: Peer) -> list:
+    blocks = []
+    while not peer.blocks_to_request.empty():
+        blocks.append(peer.blocks_to_request.get_nowait())
+    return blocks
+
+
+@pytest.mark.asyncio
+async def test_scheduler():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    with TemporaryDirectory() as tmpdir:
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir)
+        picker = PiecePicker(torrent, random.Random(0))
+        peers = [make_peer(metadata, 1, {0, 1, 2}, 3), make_peer(metadata, 2, {0, 1, 2}, 3)]
+        for peer in peers:
+            picker.add_pieces(peer.available_pieces)
+        scheduler = RequestScheduler(torrent, picker, lambda: peers)
+        # events of the same iteration are handled at once, for the peers concerned only
+        scheduler.peer_ready(peers[0])
+        scheduler.peer_ready(peers[0])
+        assert peers[0].blocks_to_request.empty()
+        await asyncio.sleep(0)
+        assert scheduler.refills == 1 and peers[0].blocks_to_request.qsize() == 3 and peers[1].blocks_to_request.empty()
+        # full window: nothing more
+        scheduler.peer_ready(peers[0])
+        await asyncio.sleep(0)
+        assert peers[0].blocks_to_request.qsize() == 3 and scheduler.refills == 1
+        # choking us: interest instead of blocks
+        peers[1].am_not_choking.clear()
+        peers[1].am_interested = True
+        scheduler.peer_ready(peers[1])
+        await asyncio.sleep(0)
+        assert peers[1].blocks_to_request.empty()
+        # unchoked: no block given twice
+        peers[1].am_not_choking.set()
+        scheduler.all_peers_ready()
+        await asyncio.sleep(0)
+        first, second = queued(peers[0]), queued(peers[1])
+        assert len(second) == 3 and not {(b.piece_id, b.begin) for b in first} & {(b.piece_id, b.begin) for b in second}
+        # every block requested: in endgame, the blocks left are requested from another peer too
+        for peer in peers:
+            peer.window = 20
+        scheduler.all_peers_ready()
+        await asyncio.sleep(0)
+        for peer, blocks in zip(peers, (first, second)):
+            for block in blocks + queued(peer):
+                peer.requested[(block.piece_id, block.begin)] = (block, 0.0)
+        assert len(peers[0].requested) + len(peers[1].requested) == 10
+        scheduler.check_endgame()
+        assert scheduler.endgame
+        await asyncio.sleep(0)
+        assert len(queued(peers[0])) == len(peers[1].requested) and len(queued(peers[1])) == len(peers[0].requested)
+        torrent.close()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_timeout():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    with TemporaryDirectory() as tmpdir:
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir)
+        picker = PiecePicker(torrent, random.Random(0))
+        peers = []
+        scheduler = RequestScheduler(torrent, picker, lambda: peers)
+        slow = make_peer(metadata, 1, {0}, 4, min_window=1,
+                         requests_released_cb=scheduler.blocks_released)
+        peers.append(slow)
+        picker.add_pieces(slow.available_pieces)
+        scheduler.peer_ready(slow)
+        await asyncio.sleep(0)
+        # two requested, two waiting in the queue: the window is full
+        for _ in range(2):
+            block = slow.blocks_to_request.get_nowait()
+            slow.requested[(block.piece_id, block.begin)] = (block, time.monotonic() - 100)
+        scheduler.peer_ready(slow)
+        await asyncio.sleep(0)
+        assert slow.blocks_to_request.qsize() == 2 and scheduler.refills == 1
+        # timed out: the window shrinks to 1, the queued block that does not fit goes to another peer right away
+        fast = make_peer(metadata, 2, {0}, 10)
+        peers.append(fast)
+        picker.add_pieces(fast.available_pieces)
+        assert slow.expire_requests() == 2
+        assert slow.window == 1 and slow.blocks_to_request.qsize() == 1
+        await asyncio.sleep(0)
+        kept = slow.blocks_to_request.get_nowait()
+        given = queued(fast)
+        assert len(given) == 3 and (kept.piece_id, kept.begin) not in {(b.piece_id, b.begin) for b in given}
+        torrent.close()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_endgame_cap():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    with TemporaryDirectory() as tmpdir:
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir)
+        picker = PiecePicker(torrent, random.Random(0))
+        peers = [make_peer(metadata, port, {0, 1, 2}, 20) for port in range(1, ENDGAME_MAX_REQUESTS + 4)]
+        for peer in peers:
+            picker.add_pieces(peer.available_pieces)
+        scheduler = RequestScheduler(torrent, picker, lambda: peers)
+        scheduler.peer_ready(peers[0])
+        await asyncio.sleep(0)
+        for block in queued(peers[0]):
+            peers[0].requested[(block.piece_id, block.begin)] = (block, 0.0)
+        assert len(peers[0].requested) == 10
+        scheduler.check_endgame()
+        await asyncio.sleep(0)
+        # more peers than copies allowed, refilled at once: queued copies count too
+        scheduler.peer_ready(peers[1])
+        await asyncio.sleep(0)
+        copies = {}
+        for peer in peers:
+            blocks = [(block.piece_id, block.begin) for block in peer.queued_blocks()]
+            # never twice on the same peer
+            assert len(blocks) == len(set(blocks)) and not set(blocks) & set(peer.requested)
+            for key in set(blocks) | set(peer.requested):
+                copies[key] = copies.get(key, 0) + 1
+        assert len(copies) == 10 and set(copies.values()) == {ENDGAME_MAX_REQUESTS}
+        torrent.close()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_refill_threshold():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    with TemporaryDirectory() as tmpdir:
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir)
+        picker = PiecePicker(torrent, random.Random(0))
+        peers = []
+        scheduler = RequestScheduler(torrent, picker, lambda: peers)
+        peer = make_peer(metadata, 1, {0, 1, 2}, 8)
+        peer.can_request_cb = scheduler.peer_ready
+        peers.append(peer)
+        picker.add_pieces(peer.available_pieces)
+        scheduler.peer_ready(peer)
+        await asyncio.sleep(0)
+        blocks = queued(peer)
+        for block in blocks:
+            peer.requested[(block.piece_id, block.begin)] = (block, time.monotonic())
+        assert len(blocks) == 8 and scheduler.refills == 1
+        # refilled once a quarter of the window is free, not on every block
+        peer.block_arrived(blocks[0].piece_id, blocks[0].begin, blocks[0].length)
+        assert not scheduler._pending
+        peer.block_arrived(blocks[1].piece_id, blocks[1].begin, blocks[1].length)
+        assert scheduler._pending == {peer}
+        await asyncio.sleep(0)
+        assert scheduler.refills == 2 and peer.blocks_to_request.qsize() == 2
+        torrent.close()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_piece_failed():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    with TemporaryDirectory() as tmpdir:
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir)
+        picker = PiecePicker(torrent, random.Random(0))
+        peer = make_peer(metadata, 1, {0}, 10)
+        picker.add_pieces(peer.available_pieces)
+        scheduler = RequestScheduler(torrent, picker, lambda: [peer])
+        scheduler.peer_ready(peer)
+        await asyncio.sleep(0)
+        blocks = queued(peer)
+        for i, block in enumerate(blocks):
+            assert await torrent.receive_block(block, bytes(block.length)) is (False if i == len(blocks) - 1 else None)
+        # invalid: requested again right away
+        scheduler.piece_failed(0)
+        await asyncio.sleep(0)
+        assert len(queued(peer)) == len(blocks)
+        torrent.close()
+
+
+@pytest.mark.asyncio
+async def test_scheduler_endgame_release():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    with TemporaryDirectory() as tmpdir:
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir)
+        picker = PiecePicker(torrent, random.Random(0))
+        peers = []
+        scheduler = RequestScheduler(torrent, picker, lambda: peers)
+        peers.extend(make_peer(metadata, port, {0, 1, 2}, 10, requests_released_cb=scheduler.blocks_released)
+                     for port in (1, 2))
+        picker.add_pieces({0, 1, 2})
+        scheduler.peer_ready(peers[0])
+        await asyncio.sleep(0)
+        blocks = queued(peers[0])
+        for peer in peers:
+            for block in blocks:
+                peer.requested[(block.piece_id, block.begin)] = (block, time.monotonic())
+        scheduler.check_endgame()
+        assert scheduler.endgame
+        # duplicates released by one peer stay requested from the other
+        peers[0].release_requests()
+        assert not any(block.request_timedout for block in blocks) and picker.exhausted == {0, 1, 2}
+        peers[1].release_requests()
+        assert all(block.request_timedout for block in blocks) and not picker.exhausted
+        torrent.close()
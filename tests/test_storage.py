@@ -0,0 +1,151 @@
+import asyncio
+import os
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from guit_torrent.cache import WriteBackCache, PieceReadCache, split_buffers
+from guit_torrent.storage import DiskIO, FilePool, StorageError, check_free_space
+
+
+@pytest.mark.asyncio
+async def test_disk_io():
+    disk_io = DiskIO(threads=2)
+    with TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "folder", "file")
+        assert await disk_io.read(path, 0, 10) == b"" and not os.path.exists(path)
+        data = os.urandom(10 * 1000)
+        # adjacent writes, submitted together
+        writes = [disk_io.write(path, begin, memoryview(data)[begin: begin + 1000])
+                  for begin in range(0, len(data), 1000)]
+        for write in writes:
+            await write
+        await disk_io.sync(path)
+        assert await disk_io.read(path, 0, len(data) + 10) == data
+        assert await disk_io.read(path, 500, 1000) == data[500: 1500]
+        stats = disk_io.stats()
+        assert stats["queue_depth"] == 0 and stats["completed"] == len(writes) + 4
+        assert stats["bytes_written"] == len(data) and stats["writes"] == len(writes)
+        assert stats["write_syscalls"] < len(writes)
+        with pytest.raises(OSError):
+            await disk_io.read(tmpdir, 0, 10)
+        # invalid operations fail alone, the lanes keep running
+        with pytest.raises(TypeError):
+            await disk_io.write(path, 0, "not bytes")
+        with pytest.raises(TypeError):
+            await disk_io.read(path, 0, "10")
+        assert await disk_io.read(path, 0, 10) == data[:10]
+    disk_io.close()
+
+
+def test_check_free_space(monkeypatch):
+    with TemporaryDirectory() as tmpdir:
+        monkeypatch.chdir(tmpdir)
+        # relative, not created yet
+        check_free_space(os.path.join("downloads", "some_torrent"), 10)
+        assert not os.path.exists("downloads")
+        with pytest.raises(StorageError):
+            check_free_space("downloads", 2 ** 80)
+
+
+def test_file_pool():
+    pool = FilePool(max_open=2)
+    with TemporaryDirectory() as tmpdir:
+        paths = [os.path.join(tmpdir, str(i)) for i in range(3)]
+        with pool.open(paths[0], create=False) as fd:
+            assert fd is None and not os.path.exists(paths[0])
+        with pool.open(paths[0]) as fd_0, pool.open(paths[1]), pool.open(paths[2]):
+            # in use: none of them can be closed
+            assert pool.stats()["open"] == 3 and pool.stats()["evictions"] == 0
+            with pool.open(paths[0]) as fd:
+                assert fd == fd_0
+        # closed once unused: paths[2] was released first
+        assert pool.stats()["open"] == 2 and pool.stats()["evictions"] == 1
+        with pool.open(paths[0]):
+            pass
+        # paths[1] is the least recently used
+        with pool.open(paths[2]):
+            pass
+        assert pool.stats() == {"open": 2, "hits": 2, "misses": 5, "evictions": 2}
+        pool.close()
+        assert pool.stats()["open"] == 0
+
+
+@pytest.mark.asyncio
+async def test_write_back_cache():
+    written = []
+
+    async def write_range(begin, buffers):
+        written.append((begin, b"".join(buffers)))
+
+    cache = WriteBackCache(write_range, max_size=100)
+    # out of order, with a gap at 30
+    for begin in (10, 0, 20, 40):
+        await cache.write(begin, bytes([begin]) * 10)
+    buffer = bytearray(15)
+    assert cache.read_into(5, buffer) and buffer == bytes([0]) * 5 + bytes([10]) * 10
+    buffer = bytearray(b"x" * 20)
+    assert not cache.read_into(25, buffer) and buffer == bytes([20]) * 5 + b"x" * 10 + bytes([40]) * 5
+    assert not written
+    # overlapping an entry: what is cached is written first
+    await cache.write(15, b"y" * 10)
+    assert written == [(0, bytes([0]) * 10 + bytes([10]) * 10 + bytes([20]) * 10), (40, bytes([40]) * 10)]
+    # size limit
+    await cache.write(25, b"z" * 90)
+    assert written[-1] == (15, b"y" * 10 + b"z" * 90) and cache.size == 0
+    stats = cache.stats()
+    assert stats["flushes"] == 2 and stats["runs_written"] == 3 and stats["bytes_flushed"] == 140
+    assert stats["read_hits"] == 1 and stats["read_misses"] == 1 and stats["coalescing"] == 2
+    assert split_buffers([b"abc", b"de", b"f"], [1, 3, 0, 2]) == [[b"a"], [b"bc", b"d"], [], [b"e", b"f"]]
+
+
+@pytest.mark.asyncio
+async def test_write_back_cache_rewrite():
+    written = []
+    disk = asyncio.Event()
+
+    async def write_range(begin, buffers):
+        await disk.wait()
+        written.append((begin, b"".join(buffers)))
+
+    cache = WriteBackCache(write_range)
+    await cache.write(0, b"a" * 10)
+    flush = asyncio.create_task(cache.flush())
+    await asyncio.sleep(0)
+    # rewritten while the old data is being written: only cached once that is on disk
+    write = asyncio.create_task(cache.write(5, b"b" * 10))
+    await asyncio.sleep(0)
+    buffer = bytearray(15)
+    assert not cache.read_into(0, buffer) and buffer == b"a" * 10 + bytes(5)
+    disk.set()
+    await asyncio.gather(flush, write)
+    buffer = bytearray(10)
+    assert cache.read_into(5, buffer) and buffer == b"b" * 10
+    await cache.flush()
+    assert written == [(0, b"a" * 10), (5, b"b" * 10)]
+
+
+@pytest.mark.asyncio
+async def test_piece_read_cache():
+    reads = []
+
+    async def read_piece(piece_id):
+        reads.append(piece_id)
+        await asyncio.sleep(0)
+        return bytes([piece_id]) * 10
+
+    cache = PieceReadCache(read_piece, max_size=20)
+    # concurrent requests share a single read
+    assert await asyncio.gather(cache.get(0), cache.get(0)) == [bytes(10)] * 2 and reads == [0]
+    await cache.get(1)
+    assert await cache.get(0) == bytes(10) and reads == [0, 1]
+    # 1 is the least recently used
+    await cache.get(2)
+    await cache.get(0)
+    await cache.get(1)
+    assert reads == [0, 1, 2, 1]
+    cache.invalidate(1)
+    await cache.get(1)
+    assert reads == [0, 1, 2, 1, 1]
+    stats = cache.stats()
+    assert stats["hits"] == 3 and stats["misses"] == 5 and stats["evictions"] == 2 and stats["size"] == 20
@@ -1,9 +1,12 @@
 import os
 from hashlib import sha1
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
 
 import pytest
 
-from guit_torrent.metainfo import MultiFileInfo, IndividualFileInfo, TorrentMetaInfo, load_torrent_metadata
+from guit_torrent.creator import create_torrent
+from guit_torrent.metainfo import MultiFileInfo, IndividualFileInfo, TorrentMetaInfo, load_torrent_metadata, FileTable
 
 
 @pytest.mark.asyncio
@@ -37,3 +40,38 @@ async def test_torrent_file_creation():
     loaded.info_hash = None
     assert loaded == meta_info
 
+
+
+def test_file_table():
+    files = [IndividualFileInfo(name=f"dir/file_{i}", length=i * 100, md5sum="ab" * 16 if i == 3 else None)
+             for i in range(10)]
+    info = MultiFileInfo(name="some_files", files=files, piece_length=2 ** 14, pieces=bytes(range(20)) * 3)
+    assert isinstance(info.files, FileTable)
+    assert info.files == files
+    assert info.files[-1] == files[-1]
+    assert info.total_length == sum(file.length for file in files)
+    assert list(info.files.offsets) == [sum(file.length for file in files[:i]) for i in range(len(files) + 1)]
+    assert info.nr_pieces == 3
+    assert info.piece_hash(2) == bytes(range(20))
+    assert FileTable.from_dicts(info.to_dict()["files"]) == info.files
+
+
+def test_create_torrent():
+    piece_length = 2 ** 14
+    files_raw_data = bytearray()
+    for file in sorted(os.listdir("assets/torrent_files")):
+        with open(os.path.join("assets/torrent_files", file), "rb") as f:
+            files_raw_data.extend(f.read())
+    # small tasks so that pieces spanning files are hashed by different processes
+    with patch("guit_torrent.creator.HASH_TASK_SIZE", 2 * piece_length):
+        meta_info = create_torrent("assets/torrent_files", "udp://someplace:80/announce", piece_length=piece_length,
+                                   workers=2)
+    assert meta_info.info.total_length == len(files_raw_data)
+    assert meta_info.info.pieces == b"".join(
+        sha1(files_raw_data[begin: begin + piece_length]).digest()
+        for begin in range(0, len(files_raw_data), piece_length)
+    )
+    with TemporaryDirectory() as tmpdir:
+        with open(os.path.join(tmpdir, "created.torrent"), "wb") as f:
+            f.write(meta_info.encode())
+        assert load_torrent_metadata(os.path.join(tmpdir, "created.torrent")) == meta_info
@@ -1,11 +1,17 @@
+import asyncio
 import os
+import shutil
+import time
 from hashlib import sha1
 from tempfile import TemporaryDirectory
 
 import pytest
 
 from guit_torrent.metainfo import MultiFileInfo, IndividualFileInfo, TorrentMetaInfo, load_torrent_metadata
-from guit_torrent.torrentdata import get_torrentdata_from_metainfo
+from guit_torrent.storage import PREALLOCATE_MODES, StorageError
+from guit_torrent.torrentdata import get_torrentdata_from_metainfo, BLOCK_SIZE, Torrent, TorrentFile, \
+    match_file_priorities, PRIORITY_SKIP, PRIORITY_NORMAL, PRIORITY_HIGH, \
+    MAX_REQUEST_LENGTH, get_intersections
 
 
 def load_block(data, piece_length, piece, begin, length):
@@ -33,11 +39,252 @@ async def test_pieces_creation():
             assert (await torrent.read_piece(piece.piece_id) ==
                     files_raw_data[piece.piece_id * piece_length: (piece.piece_id + 1) * piece_length])
             assert await torrent.verify_piece(piece.piece_id)
-        for file in torrent.files:
-            os.fsync(file.fd)
+        # written through the write cache
+        await torrent.sync()
 
         written_data = bytearray()
         for file in os.listdir(tmpdir):
             with open(os.path.join(tmpdir, file), "rb") as f:
                 written_data.extend(f.read())
         assert written_data == files_raw_data
+
+
+def test_block_state():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    with TemporaryDirectory() as tmpdir:
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir)
+        assert sum(piece.length for piece in torrent.pieces) == torrent.length
+        piece = torrent.pieces[-1]
+        assert sum(block.length for block in piece.blocks) == piece.length
+        block = piece.get_block(BLOCK_SIZE)
+        assert block == piece.blocks[1] and piece.get_block(BLOCK_SIZE + 1) is None
+        assert block.request_timedout
+        block.last_requested = time.time()
+        assert not block.request_timedout and piece.blocks[0].request_timedout
+        for block in piece.blocks:
+            block.downloaded = True
+            block.downloaded = True
+        assert piece.downloaded and piece.bytes_downloaded == piece.length == torrent.downloaded_bytes
+        torrent.set_piece_blocks_downloaded(piece.piece_id, False)
+        assert not any(torrent.block_downloaded) and torrent.downloaded_bytes == 0
+        torrent.close()
+
+
+def test_progress_counters():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    with TemporaryDirectory() as tmpdir:
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir)
+        assert len(torrent.pop_changed_files()) == len(torrent.files) and not torrent.pop_changed_files()
+
+        def check():
+            confirmed = [piece for piece in torrent.pieces if piece.confirmed]
+            assert torrent.confirmed_downloaded_bytes == sum(piece.length for piece in confirmed)
+            assert torrent.downloaded_bytes == sum(torrent.piece_bytes_downloaded)
+            assert torrent.complete == all(torrent.piece_confirmed)
+            for file in torrent.files:
+                assert file.confirmed_bytes == sum(
+                    intersection[0][1] - intersection[0][0] for piece in confirmed
+                    if (intersection := get_intersections(file.begin, file.begin + file.length,
+                                                          piece.begin, piece.end)) is not None)
+
+        for piece in torrent.pieces:
+            torrent.set_piece_blocks_downloaded(piece.piece_id, True)
+            torrent.set_piece_confirmed(piece.piece_id, True)
+            # no change
+            torrent.set_piece_confirmed(piece.piece_id, True)
+            check()
+        assert torrent.complete and torrent.left_bytes == 0
+        assert {file.name for file in torrent.pop_changed_files()} == {file.name for file in torrent.files}
+        # invalidated
+        torrent.set_piece_confirmed(0, False)
+        torrent.set_piece_blocks_downloaded(0, False)
+        check()
+        assert torrent.left_bytes == torrent.pieces[0].length
+        assert [file.name for file in torrent.pop_changed_files()] == [file.name for file, _, _ in
+                                                                       torrent.get_piece_files(0)]
+        # counters of wanted pieces follow priority changes
+        torrent.set_file_priorities([PRIORITY_SKIP if file.includes_piece(torrent.pieces[0]) else PRIORITY_NORMAL
+                                     for file in torrent.files])
+        assert torrent.complete == all(torrent.piece_confirmed[piece_id] for piece_id in range(torrent.nr_pieces)
+                                       if torrent.piece_wanted(piece_id))
+        assert torrent.wanted_downloaded_bytes == sum(torrent.piece_bytes_downloaded[piece_id]
+                                                      for piece_id in range(torrent.nr_pieces)
+                                                      if torrent.piece_wanted(piece_id))
+        torrent.close()
+
+
+def test_files_in_range():
+    lengths = [0, 5, 100, 0, 0, 1, 37, 0, 2 ** 15, 3, 0]
+    files = []
+    for i, length in enumerate(lengths):
+        files.append(TorrentFile(name=str(i), length=length, begin=sum(lengths[:i])))
+    torrent = Torrent(name="t", length=sum(lengths), piece_length=64, piece_hashes=bytes(20 * 600), files=files)
+    for begin in range(0, torrent.length, 7):
+        for end in (begin + 1, begin + 50, begin + 2 ** 15):
+            expected = []
+            for file in files:
+                intersects = get_intersections(begin, end, file.begin, file.begin + file.length)
+                # empty files are skipped
+                if intersects is not None and file.length:
+                    expected.append((file, intersects[2][0], intersects[2][1] - intersects[2][0]))
+            assert torrent.get_files_in_range(begin, end) == expected
+    for file in files:
+        assert file.get_pieces(torrent.pieces) == [piece for piece in torrent.pieces if file.length and
+                                                   get_intersections(file.begin, file.begin + file.length,
+                                                                     piece.begin, piece.end) is not None]
+
+
+@pytest.mark.asyncio
+async def test_receive_blocks():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    with TemporaryDirectory() as tmpdir:
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir)
+        files_raw_data = bytearray()
+        for file in metadata.info.get_files():
+            with open(os.path.join("assets/torrent_files", file.name), "rb") as f:
+                files_raw_data.extend(f.read())
+
+        piece = torrent.pieces[1]
+        blocks = piece.blocks
+        # corrupted piece: not written to disk, its blocks can be requested again at once
+        for block in blocks:
+            block.last_requested = time.time()
+            data = load_block(files_raw_data, torrent.piece_length, block.piece_id, block.begin, block.length)
+            assert await torrent.receive_block(block, bytes(len(data)) if block.block_id == 1 else data) is \
+                   (False if block == blocks[-1] else None)
+        assert not piece.confirmed and piece.bytes_downloaded == 0
+        assert all(block.request_timedout for block in blocks)
+        assert await torrent.read_piece(piece.piece_id) == b""
+        # out of order, flushed to disk in between
+        for i, block in enumerate(reversed(blocks)):
+            if i == 1:
+                await torrent.flush_piece_buffers()
+            data = load_block(files_raw_data, torrent.piece_length, block.piece_id, block.begin, block.length)
+            assert await torrent.receive_block(block, data) is (True if block == blocks[0] else None)
+        assert piece.confirmed and not torrent.piece_buffers
+        assert await torrent.verify_piece(piece.piece_id)
+        # served to peers
+        block = await torrent.read_block(piece.piece_id, 3, 100)
+        assert block == files_raw_data[piece.begin + 3: piece.begin + 103]
+        for piece_id, begin, length in ((0, 0, 100), (piece.piece_id, piece.length - 1, 2),
+                                        (piece.piece_id, 0, MAX_REQUEST_LENGTH + 1), (torrent.nr_pieces, 0, 1)):
+            assert await torrent.read_block(piece_id, begin, length) is None
+        torrent.close()
+
+
+@pytest.mark.asyncio
+async def test_receive_blocks_resumed():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    with TemporaryDirectory() as tmpdir:
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir)
+        files_raw_data = bytearray()
+        for file in metadata.info.get_files():
+            with open(os.path.join("assets/torrent_files", file.name), "rb") as f:
+                files_raw_data.extend(f.read())
+
+        def receive(block):
+            data = load_block(files_raw_data, torrent.piece_length, block.piece_id, block.begin, block.length)
+            return torrent.receive_block(block, data)
+
+        piece = torrent.pieces[0]
+        blocks = piece.blocks
+        # partially written to disk by a previous session
+        for block in blocks[:2]:
+            assert await receive(block) is None
+        await torrent.flush_piece_buffers()
+        # the rest received at once, while the blocks on disk are read
+        assert await asyncio.gather(*(receive(block) for block in blocks[2:])) == [None, True]
+        assert piece.confirmed and not torrent.piece_buffers
+        torrent.close()
+
+
+@pytest.mark.asyncio
+async def test_mmap_storage():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    with TemporaryDirectory() as tmpdir:
+        # mappings are bounded like open files
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir, storage="mmap", max_open_files=1)
+        files_raw_data = bytearray()
+        for file in metadata.info.get_files():
+            with open(os.path.join("assets/torrent_files", file.name), "rb") as f:
+                files_raw_data.extend(f.read())
+        for piece in torrent.pieces:
+            for block in piece.blocks:
+                block_data = load_block(files_raw_data, torrent.piece_length, block.piece_id, block.begin,
+                                        block.length)
+                await torrent.receive_block(block, block_data)
+                assert sum(file.mm is not None for file in torrent.files) <= 1
+        assert all(torrent.piece_confirmed) and torrent.file_pool.stats()["evictions"] > 0
+        await torrent.sync()
+        torrent.close()
+        assert await get_torrentdata_from_metainfo(metadata, tmpdir, storage="mmap").check_existing_data()
+        written_data = bytearray()
+        for file in metadata.info.get_files():
+            with open(os.path.join(tmpdir, file.name), "rb") as f:
+                written_data.extend(f.read())
+        assert written_data == files_raw_data
+
+
+def test_preallocation(monkeypatch):
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    with TemporaryDirectory() as tmpdir:
+        for mode in PREALLOCATE_MODES:
+            folder = os.path.join(tmpdir, mode)
+            torrent = get_torrentdata_from_metainfo(metadata, folder, preallocate_mode=mode)
+            for file in torrent.files:
+                if mode == "none":
+                    # created when first written
+                    assert not os.path.exists(file.path)
+                    continue
+                stat = os.stat(file.path)
+                assert stat.st_size == file.length
+                if mode == "full":
+                    assert stat.st_blocks * 512 >= file.length
+            torrent.close()
+        monkeypatch.setattr(shutil, "disk_usage", lambda path: shutil._ntuple_diskusage(10, 10, 0))
+        with pytest.raises(StorageError):
+            get_torrentdata_from_metainfo(metadata, os.path.join(tmpdir, "no_space"))
+        # fully allocated files need no more space
+        get_torrentdata_from_metainfo(metadata, os.path.join(tmpdir, "full")).close()
+
+
+@pytest.mark.asyncio
+async def test_file_priorities():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    names = [file.name for file in metadata.info.get_files()]
+    assert match_file_priorities(["a.txt", "b.png", "some.txt"], [
+        ("*", PRIORITY_SKIP), ("*.txt", PRIORITY_NORMAL), ("some*", PRIORITY_HIGH)
+    ]) == [PRIORITY_NORMAL, PRIORITY_SKIP, PRIORITY_HIGH]
+    files_raw_data = bytearray()
+    for name in names:
+        with open(os.path.join("assets/torrent_files", name), "rb") as f:
+            files_raw_data.extend(f.read())
+    with TemporaryDirectory() as tmpdir:
+        priorities = match_file_priorities(names, [("*.png", PRIORITY_SKIP)])
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir, file_priorities=priorities)
+        skipped = torrent.files[names.index("shrek.png")]
+        # pieces only in the skipped file are not wanted
+        wanted = [any(file.includes_piece(piece) for file in torrent.files if file.wanted and file.length)
+                  for piece in torrent.pieces]
+        assert [torrent.piece_wanted(piece_id) for piece_id in range(torrent.nr_pieces)] == wanted and not all(wanted)
+        assert torrent.left_bytes == torrent.wanted_length == sum(piece.length for piece in torrent.pieces
+                                                                  if wanted[piece.piece_id])
+        for piece in torrent.pieces:
+            if torrent.piece_wanted(piece.piece_id):
+                for block in piece.blocks:
+                    await torrent.receive_block(block, load_block(files_raw_data, torrent.piece_length,
+                                                                  block.piece_id, block.begin, block.length))
+        assert torrent.complete and torrent.left_bytes == 0
+        await torrent.sync()
+        torrent.close()
+        assert not os.path.exists(skipped.path) and os.path.exists(torrent.part_file_path)
+        for file in torrent.files:
+            if file.wanted:
+                with open(file.path, "rb") as f:
+                    assert f.read() == files_raw_data[file.begin: file.begin + file.length]
+
+        # the parts of the skipped file are verified from the part file
+        torrent = get_torrentdata_from_metainfo(metadata, tmpdir, file_priorities=priorities)
+        assert await torrent.check_existing_data()
+        assert list(torrent.piece_confirmed) == wanted
+        torrent.close()
@@ -0,0 +1,43 @@
+import asyncio
+import struct
+
+import pytest
+
+from guit_torrent.metainfo import load_torrent_metadata
+from guit_torrent.tracker.base import BaseTracker
+
+
+class FakeUDPTracker(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.announces = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        connection_id, action, transaction_id = struct.unpack("!QII", data[:16])
+        if action == 0:
+            self.transport.sendto(struct.pack("!IIQ", 0, transaction_id, 1234), addr)
+        else:
+            self.announces.append(data)
+            self.transport.sendto(struct.pack("!5I", 1, transaction_id, 1800, 0, 0), addr)
+
+
+@pytest.mark.asyncio
+async def test_udp_announce():
+    metadata = load_torrent_metadata("assets/some_files.torrent")
+    transport, tracker_protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+        FakeUDPTracker, local_addr=("127.0.0.1", 0))
+    tracker_port = transport.get_extra_info("sockname")[1]
+    tracker = BaseTracker.from_url(f"udp://127.0.0.1:{tracker_port}/announce", metadata, "-GT0000-" + "0" * 12,
+                                   get_uploaded_cb=lambda: 42, port=51413)
+    await tracker.announce()
+    assert tracker.error is None and len(tracker_protocol.announces) == 1
+    announce = tracker_protocol.announces[0]
+    assert len(announce) == 98 and announce[16:36] == metadata.info_hash
+    assert struct.unpack("!Q", announce[72:80])[0] == 42
+    # the port we accept connections on, not the tracker's
+    assert struct.unpack("!H", announce[96:98])[0] == 51413
+    await tracker.close()
+    transport.close()